@@ -0,0 +1,152 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import discord
+
+from log_sink import GuildLog
+from rest_scheduler import LOG, rest_priority
+
+
+class AuditLogCache:
+    """
+    attributes logged events to the member who caused them, using the audit log
+
+    entries are cached by (action, target id), pushed by the gateway when it can (audit log entry create
+    events) and otherwise fetched: a fetch waits window seconds so a burst of events (a nuke deleting
+    50 channels) is covered by one request, events which happened while a request was in flight
+    trigger at most one more
+
+    when entries are pushed, an event waits window seconds for its entry and nothing is fetched, most events
+    without an entry (members deleting their own messages) have none at all
+    """
+
+    def __init__(self, window: float = 2.0, max_age: float = 60.0, limit: int = 100, pushed: bool = False):
+        """
+        :param window: seconds a fetch waits for more events of the burst, or an event waits for its pushed entry
+        :param max_age: entries older than that (seconds) aren't attributed to new events
+        :param limit: number of entries fetched at once, and kept per guild
+        :param pushed: whether the gateway pushes new entries (moderation intent)
+        """
+        self.window = window
+        self.max_age = max_age
+        self.limit = limit
+        self.pushed = pushed
+        # guild id -> event set by the next entry pushed for the guild
+        self.arrivals: dict[int, asyncio.Event] = {}
+        # oldest entries first, so the ones evicted past limit are the oldest
+        self.entries: dict[int, OrderedDict[tuple[discord.AuditLogAction, int], discord.AuditLogEntry]] = {}
+        self.fetches: dict[int, asyncio.Task] = {}
+        # monotonic time the last request of the guild was sent
+        self.fetched: dict[int, float] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self.requests = 0
+
+    def add(self, entry: discord.AuditLogEntry) -> None:
+        target_id = getattr(entry.target, 'id', None)
+        if target_id is None:
+            return
+        entries = self.entries.get(entry.guild.id)
+        if entries is None:
+            entries = self.entries[entry.guild.id] = OrderedDict()
+        key = entry.action, target_id
+        cached = entries.get(key)
+        if cached is not None and cached.id > entry.id:
+            # a fetch doesn't replace a newer entry pushed by the gateway meanwhile
+            return
+        entries[key] = entry
+        entries.move_to_end(key)
+        if len(entries) > self.limit:
+            entries.popitem(last=False)
+        arrival = self.arrivals.pop(entry.guild.id, None)
+        if arrival is not None:
+            arrival.set()
+
+    def lookup(self, guild_id: int, action: discord.AuditLogAction, target_id: int) -> discord.AuditLogEntry | None:
+        entry = self.entries.get(guild_id, {}).get((action, target_id))
+        if entry is None or (discord.utils.utcnow() - entry.created_at).total_seconds() > self.max_age:
+            return None
+        return entry
+
+    async def find(self, guild: discord.Guild, action: discord.AuditLogAction, target_id: int,
+                   fetch: bool = True) -> discord.AuditLogEntry | None:
+        """
+        :param guild: guild
+        :param action: action of the event
+        :param target_id: id of the target of the event
+        :param fetch: whether the audit log may be fetched when entries aren't pushed
+        :return: audit log entry of the event, None if there is none or it can't be read
+        """
+        happened = time.monotonic()
+        while True:
+            entry = self.lookup(guild.id, action, target_id)
+            if entry is not None or self.fetched.get(guild.id, 0) >= happened:
+                return entry
+            if not guild.me.guild_permissions.view_audit_log:
+                return None
+            if self.pushed:
+                return await self.wait_for_push(guild.id, action, target_id, happened + self.window)
+            if not fetch:
+                return None
+            task = self.fetches.get(guild.id)
+            if task is None:
+                task = self.fetches[guild.id] = asyncio.create_task(self.fetch(guild))
+            await asyncio.shield(task)
+
+    async def wait_for_push(self, guild_id: int, action: discord.AuditLogAction, target_id: int,
+                            deadline: float) -> discord.AuditLogEntry | None:
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return None
+            arrival = self.arrivals.get(guild_id)
+            if arrival is None:
+                arrival = self.arrivals[guild_id] = asyncio.Event()
+            try:
+                await asyncio.wait_for(arrival.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            entry = self.lookup(guild_id, action, target_id)
+            if entry is not None:
+                return entry
+
+    async def fetch(self, guild: discord.Guild) -> None:
+        try:
+            await asyncio.sleep(self.window)
+            self.fetched[guild.id] = time.monotonic()
+            self.requests += 1
+            entries = [entry async for entry in guild.audit_logs(limit=self.limit)]
+            # the audit log comes newest first
+            for entry in reversed(entries):
+                self.add(entry)
+        except (discord.HTTPException, discord.RateLimited) as e:
+            print(f'Failed to fetch audit log of {guild}: {e}')
+        finally:
+            del self.fetches[guild.id]
+
+    def enrich(self, log: GuildLog, guild: discord.Guild, action: discord.AuditLogAction, target_id: int,
+               content: str, check=None, fetch: bool = True) -> None:
+        """
+        log who caused the event once the audit log tells, without delaying the log of the event itself
+        :param log: sink of the guild
+        :param guild: guild
+        :param action: action of the event
+        :param target_id: id of the target of the event
+        :param content: description of the event, followed by the actor and reason
+        :param check: function telling whether the entry matches the event (for actions with extra data)
+        :param fetch: whether a missing entry may be fetched, False for events which usually have none
+        :return:
+        """
+        task = asyncio.create_task(self.attribute(log, guild, action, target_id, content, check, fetch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def attribute(self, log: GuildLog, guild: discord.Guild, action: discord.AuditLogAction, target_id: int,
+                        content: str, check, fetch: bool) -> None:
+        # fetches started from here are made for logs
+        rest_priority.set(LOG)
+        entry = await self.find(guild, action, target_id, fetch)
+        if entry is None or entry.user is None or (check is not None and not check(entry)):
+            return
+        reason = f'. Reason: **{entry.reason}**' if entry.reason else ''
+        log.put(f'{content} by {entry.user.mention}{reason}')
@@ -0,0 +1,85 @@
+import asyncio
+from collections.abc import Callable
+
+import discord
+
+from ratelimit import TokenBucket
+from rest_scheduler import AUTOROLE, rest_priority
+
+
+class AutoroleWorker:
+    """
+    assigns autoroles from per-guild queues, one task per guild with pending members
+
+    role assignments of a guild share one rate limit bucket, so they are paced by a token bucket instead
+    of hitting 429s, members who left before their turn are skipped
+    """
+
+    def __init__(self, resolve: Callable[[discord.Member], discord.Role | None], rate: float = 1.0,
+                 burst: int = 10):
+        """
+        :param resolve: function returning role the member should get (or None)
+        :param rate: assignments per second per guild
+        :param burst: assignments allowed at once per guild
+        """
+        self.resolve = resolve
+        self.rate = rate
+        self.burst = burst
+        # guild id -> members waiting for the role by id, in join order
+        self.pending: dict[int, dict[int, discord.Member]] = {}
+        self.buckets: dict[int, TokenBucket] = {}
+        self.tasks: dict[int, asyncio.Task] = {}
+        self.assigned = 0
+        self.skipped = 0
+        self.failed = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(map(len, self.pending.values()))
+
+    def put(self, member: discord.Member) -> None:
+        """
+        queue member for autorole, queuing the same member again is a no-op
+        :param member: recently joined member
+        :return:
+        """
+        guild = member.guild
+        self.pending.setdefault(guild.id, {})[member.id] = member
+        if guild.id not in self.tasks:
+            self.tasks[guild.id] = asyncio.create_task(self.run(guild))
+
+    def discard(self, guild_id: int, member_id: int) -> None:
+        """
+        forget member who left before getting the role
+        :param guild_id: id of the guild
+        :param member_id: id of the member who left
+        :return:
+        """
+        pending = self.pending.get(guild_id)
+        if pending is not None:
+            pending.pop(member_id, None)
+
+    async def run(self, guild: discord.Guild) -> None:
+        rest_priority.set(AUTOROLE)
+        bucket = self.buckets.get(guild.id)
+        if bucket is None:
+            bucket = self.buckets[guild.id] = TokenBucket(self.rate, self.burst)
+        pending = self.pending[guild.id]
+        try:
+            while pending:
+                member = pending.pop(next(iter(pending)))
+                role = self.resolve(member)
+                if role is None or role in member.roles:
+                    self.skipped += 1
+                    continue
+                await bucket.acquire()
+                try:
+                    await member.add_roles(role, reason='Autorole')
+                    self.assigned += 1
+                except discord.HTTPException as e:
+                    self.failed += 1
+                    print(f'Failed to add autorole to {member}: {e}')
+        finally:
+            del self.tasks[guild.id]
+            if not pending:
+                self.pending.pop(guild.id, None)
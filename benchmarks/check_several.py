@@ -0,0 +1,69 @@
+"""
+microbenchmark of the guild update collection diff
+
+run from the repository root: python -m benchmarks.check_several
+"""
+import random
+import timeit
+
+from diff import check_several
+
+
+class Member:
+    __slots__ = ('id',)
+
+    def __init__(self, id: int):
+        self.id = id
+
+    def __eq__(self, other):
+        return isinstance(other, Member) and other.id == self.id
+
+    def __hash__(self):
+        return self.id >> 22
+
+    @property
+    def mention(self) -> str:
+        return f'<@{self.id}>'
+
+
+def quadratic_check_several(before, after, name: str) -> str:
+    """
+    previous implementation, kept for comparison
+    """
+    log = ''
+    if before != after:
+        removed = [getattr(item, "mention", str(item)) for item in before if item not in after]
+        added = [getattr(item, "mention", str(item)) for item in after if item not in before]
+        if len(removed) > 0:
+            log += f'{name} removed: {f", ".join(removed)}\n'
+        if len(added) > 0:
+            log += f'{name} added: {f", ".join(added)}\n'
+    return log
+
+
+def members(count: int) -> list[Member]:
+    return [Member(random.getrandbits(63)) for _ in range(count)]
+
+
+def measure(function, before, after) -> float:
+    number, total = timeit.Timer(lambda: function(before, after, 'Members')).autorange()
+    return total / number
+
+
+def main():
+    print(f'{"members":>8} {"case":<10} {"id-indexed":>12} {"quadratic":>12}')
+    for count in (1_000, 100_000, 500_000):
+        before = members(count)
+        cases = {
+            'unchanged': list(before),
+            'joined': before + members(1),
+            'left': before[1:],
+        }
+        for case, after in cases.items():
+            new = measure(check_several, before, after)
+            old = f'{measure(quadratic_check_several, before, after) * 1e3:10.3f}ms' if count <= 1_000 else 'skipped'
+            print(f'{count:>8} {case:<10} {new * 1e3:10.3f}ms {old:>12}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""
+benchmark of the logging handlers on synthetic discord.py objects, without a connection to Discord
+
+run from the repository root: python -m benchmarks.handlers [--members N] [--roles N] [--channels N]
+    --save                store results as the baseline (benchmarks/baseline.json by default)
+    --threshold 0.25      fail when ns/op or bytes/op grow by more than 25% over the baseline
+
+logs go to a capturing sink instead of the outbox, results are ns per call and peak bytes allocated per call
+"""
+import argparse
+import copy
+import gc
+import json
+import os
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import discord
+from discord.state import ConnectionState
+
+from diff import check_several, check_single
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+GUILD_ID = 1
+LOG_CHANNEL_ID = GUILD_ID * 10_000_000 + 1
+REPEAT = 5
+
+
+class CaptureLog:
+    """
+    sink counting log lines instead of sending them, only the last one is kept
+    """
+    channel_id = LOG_CHANNEL_ID
+    mask = -1
+
+    def __init__(self):
+        self.count = 0
+        self.last = None
+
+    def put(self, content: str) -> None:
+        self.count += 1
+        self.last = content
+
+
+def guild_payload(members: int, roles: int, channels: int) -> dict:
+    member_ids = [GUILD_ID * 10_000_000 + 100_000 + i for i in range(members)]
+    role_ids = [GUILD_ID * 10_000_000 + 50_000 + i for i in range(roles)]
+    overwrites = [{'id': str(role_id), 'type': 0, 'allow': '1024', 'deny': '2048'} for role_id in role_ids[:10]]
+    return {
+        'id': str(GUILD_ID), 'name': 'guild', 'member_count': members, 'emojis': [], 'stickers': [], 'features': [],
+        'owner_id': str(member_ids[0]),
+        'roles': [{'id': str(GUILD_ID), 'name': '@everyone', 'permissions': '1071698660929', 'position': 0,
+                   'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}] +
+                 [{'id': str(role_id), 'name': f'role{i}', 'permissions': str(1 << (i % 40)), 'position': i + 1,
+                   'color': i, 'hoist': False, 'managed': False, 'mentionable': False}
+                  for i, role_id in enumerate(role_ids)],
+        'channels': [{'id': str(LOG_CHANNEL_ID + i), 'type': 0, 'name': f'channel{i}', 'position': i,
+                      'permission_overwrites': overwrites, 'topic': None, 'nsfw': False}
+                     for i in range(channels)],
+        'members': [{'user': {'id': str(member_id), 'username': f'user{member_id}', 'discriminator': '0',
+                              'global_name': None, 'avatar': None},
+                     'nick': None, 'roles': [str(role_id) for role_id in role_ids[i % roles:i % roles + 3]],
+                     'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0}
+                    for i, member_id in enumerate(member_ids)],
+    }
+
+
+def message_payload(message_id: int, channel_id: int, author: discord.Member, content: str) -> dict:
+    return {
+        'id': str(message_id), 'channel_id': str(channel_id), 'guild_id': str(GUILD_ID), 'type': 0,
+        'content': content, 'tts': False, 'pinned': False, 'mention_everyone': False, 'mentions': [],
+        'mention_roles': [], 'attachments': [], 'embeds': [], 'timestamp': '2024-01-01T00:00:00+00:00',
+        'edited_timestamp': None,
+        'author': {'id': str(author.id), 'username': author.name, 'discriminator': '0', 'global_name': None,
+                   'avatar': None},
+    }
+
+
+def run(coroutine) -> None:
+    """
+    run coroutine which never suspends, without an event loop
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration:
+        return
+    raise RuntimeError('handler suspended')
+
+
+def unwrap(handler):
+    # handlers are wrapped by metrics
+    return getattr(handler, '__wrapped__', handler)
+
+
+def cases(main, members: int, roles: int, channels: int) -> dict:
+    """
+    :return: case name -> function running it once
+    """
+    state = ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={}, http=None,
+                            intents=discord.Intents.all(), member_cache_flags=discord.MemberCacheFlags.all())
+    # the bot is the owner, guild.me needs the logged in user
+    state.user = discord.ClientUser(state=state, data={'id': str(GUILD_ID * 10_000_000 + 100_000),
+                                                       'username': 'bot', 'discriminator': '0', 'avatar': None,
+                                                       'bot': True})
+    state._add_guild_from_data(guild_payload(members, roles, channels))
+    guild = state._get_guild(GUILD_ID)
+    sink = CaptureLog()
+    main.log_resolver.sinks[GUILD_ID] = sink
+
+    member = guild.members[len(guild.members) // 2]
+    role = guild.roles[-1]
+    channel = guild.text_channels[-1]
+    # unchanged copies, like the ones discord.py passes as before
+    same_guild, same_member, same_role, same_channel = map(copy.copy, (guild, member, role, channel))
+    renamed_guild = copy.copy(guild)
+    renamed_guild.name = 'renamed'
+
+    promoted = copy.copy(member)
+    promoted._roles = discord.utils.SnowflakeList([*member._roles, guild.roles[-1].id])
+
+    granted = copy.copy(role)
+    granted._permissions = role._permissions | discord.Permissions.administrator.flag
+
+    locked = copy.copy(channel)
+    locked._overwrites = [*channel._overwrites[1:], copy.copy(channel._overwrites[0])]
+    locked._overwrites[-1].deny |= discord.Permissions.send_messages.flag
+
+    message = discord.Message(state=state, channel=channel,
+                              data=message_payload(GUILD_ID * 10_000_000 + 900_000, channel.id, member, 'hello ' * 40))
+
+    # the unchanged cases measure the fast path only if nothing is reported for them
+    for spec, before, after in ((main.guild_spec, same_guild, guild), (main.member_spec, same_member, member),
+                                (main.role_spec, same_role, role), (main.guild_channel_spec, same_channel, channel)):
+        assert not spec.changed(before, after), f'unchanged copy of {after!r} is reported as changed'
+
+    many_before = list(guild.members)
+    many_after = many_before[1:] + many_before[:1]
+    on_guild_update = unwrap(main.bot.on_guild_update)
+    on_member_update = unwrap(main.bot.on_member_update)
+    on_guild_role_update = unwrap(main.bot.on_guild_role_update)
+    on_guild_channel_update = unwrap(main.bot.on_guild_channel_update)
+    on_message = unwrap(main.bot.on_message)
+
+    return {
+        'on_guild_update unchanged': lambda: run(on_guild_update(guild, same_guild)),
+        'on_guild_update name': lambda: run(on_guild_update(guild, renamed_guild)),
+        'on_member_update unchanged': lambda: run(on_member_update(member, same_member)),
+        'on_member_update roles': lambda: run(on_member_update(member, promoted)),
+        'on_guild_role_update unchanged': lambda: run(on_guild_role_update(role, same_role)),
+        'on_guild_role_update permissions': lambda: run(on_guild_role_update(role, granted)),
+        'on_guild_channel_update unchanged': lambda: run(on_guild_channel_update(channel, same_channel)),
+        'on_guild_channel_update overwrites': lambda: run(on_guild_channel_update(channel, locked)),
+        'on_message': lambda: run(on_message(message)),
+        'check_single': lambda: check_single(guild.name, renamed_guild.name, 'Name'),
+        'check_several same': lambda: check_several(many_before, many_before, 'Members'),
+        'check_several reordered': lambda: check_several(many_before, many_after, 'Members'),
+        'parse_duration': lambda: main.parse_duration('1d12h30m15s'),
+    }
+
+
+def measure(function) -> tuple[float, float]:
+    """
+    :return: (ns per call, peak bytes allocated per call)
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    # the fastest of several runs is the least disturbed by the rest of the machine
+    total = min(timer.repeat(REPEAT, number))
+    calls = max(1, min(number, 100))
+    gc.collect()
+    tracemalloc.start()
+    peak = 0
+    for _ in range(calls):
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        function()
+        peak += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return total / number * 1e9, peak / calls
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    :return: descriptions of results which regressed beyond the threshold
+    """
+    regressions = []
+    for name, (ns, allocated) in results.items():
+        if name not in baseline:
+            continue
+        base_ns, base_allocated = baseline[name]
+        if ns > base_ns * (1 + threshold):
+            regressions.append(f'{name}: {ns:.0f} ns/op, baseline {base_ns:.0f} ns/op')
+        if allocated > base_allocated * (1 + threshold) + 64:
+            regressions.append(f'{name}: {allocated:.0f} B/op, baseline {base_allocated:.0f} B/op')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark logging handlers on synthetic objects')
+    parser.add_argument('--members', type=int, default=10_000, help='members of the synthetic guild')
+    parser.add_argument('--roles', type=int, default=250, help='roles of the synthetic guild')
+    parser.add_argument('--channels', type=int, default=500, help='channels of the synthetic guild')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file')
+    parser.add_argument('--save', action='store_true', help='save results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative regression')
+    args = parser.parse_args()
+
+    # main opens its config store in the working directory, keep it away from the real one
+    sys.path.insert(0, ROOT)
+    os.chdir(tempfile.mkdtemp())
+    import main as bot_main
+
+    results = {}
+    print(f'{"case":<40} {"ns/op":>12} {"B/op":>10}')
+    for name, function in cases(bot_main, args.members, args.roles, args.channels).items():
+        ns, allocated = measure(function)
+        results[name] = (ns, allocated)
+        print(f'{name:<40} {ns:12.0f} {allocated:10.0f}')
+    bot_main.config.close()
+
+    if args.save:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return
+    if not os.path.exists(args.baseline):
+        print('No baseline to compare with, run with --save first')
+        return
+    with open(args.baseline) as file:
+        regressions = compare(results, json.load(file), args.threshold)
+    for regression in regressions:
+        print(f'Regression: {regression}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
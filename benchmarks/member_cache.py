@@ -0,0 +1,87 @@
+"""
+memory benchmark of the member cache modes on a synthetic population
+
+run from the repository root: python -m benchmarks.member_cache [--guilds N] [--members N]
+(defaults to 100 guilds with 10 000 members each, 1M members in total)
+"""
+import argparse
+import gc
+import random
+import tracemalloc
+
+import discord
+from discord.state import ConnectionState
+
+from features import DEFAULT_FEATURES, feature_intents, feature_member_cache_flags
+
+VOICE_SHARE = 0.01
+PRESENCE_SHARE = 0.3
+
+
+def member_payload(member_id: int) -> dict:
+    return {
+        'user': {'id': str(member_id), 'username': f'user{member_id}', 'discriminator': '0',
+                 'global_name': None, 'avatar': None},
+        'nick': None, 'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False, 'mute': False, 'flags': 0,
+    }
+
+
+def guild_payload(guild_id: int, members: int, presences: bool) -> dict:
+    member_ids = [guild_id * 10_000_000 + i for i in range(members)]
+    voice_channel = str(guild_id * 10_000_000 - 1)
+    return {
+        'id': str(guild_id), 'name': f'guild{guild_id}', 'member_count': members, 'roles': [], 'emojis': [],
+        'stickers': [], 'features': [], 'owner_id': str(member_ids[0]),
+        'channels': [{'id': voice_channel, 'type': 2, 'name': 'voice', 'position': 0, 'permission_overwrites': [],
+                      'bitrate': 64000, 'user_limit': 0}],
+        'members': [member_payload(member_id) for member_id in member_ids],
+        'voice_states': [{'user_id': str(member_id), 'channel_id': voice_channel, 'session_id': '',
+                          'deaf': False, 'mute': False, 'self_deaf': False, 'self_mute': False,
+                          'self_video': False, 'suppress': False}
+                         for member_id in random.sample(member_ids, int(members * VOICE_SHARE))],
+        'presences': [{'user': {'id': str(member_id)}, 'status': 'online', 'client_status': {'desktop': 'online'},
+                       'activities': [{'name': 'Game', 'type': 0}]}
+                      for member_id in random.sample(member_ids, int(members * PRESENCE_SHARE))] if presences else [],
+    }
+
+
+def measure(intents: discord.Intents, flags: discord.MemberCacheFlags, guilds: int, members: int) -> tuple[int, int]:
+    """
+    :return: (bytes held by the cache, number of cached members)
+    """
+    gc.collect()
+    tracemalloc.start()
+    state = ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={}, http=None, intents=intents,
+                            member_cache_flags=flags)
+    for guild_id in range(1, guilds + 1):
+        state._add_guild_from_data(guild_payload(guild_id, members, intents.presences))
+        gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    cached = sum(len(guild._members) for guild in state.guilds)
+    del state
+    gc.collect()
+    return size, cached
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure memory of the member cache modes')
+    parser.add_argument('--guilds', type=int, default=100, help='number of synthetic guilds')
+    parser.add_argument('--members', type=int, default=10_000, help='members of every guild')
+    args = parser.parse_args()
+    guilds, members = args.guilds, args.members
+    intents = feature_intents(DEFAULT_FEATURES)
+    modes = {
+        'Intents.all()': (discord.Intents.all(), discord.MemberCacheFlags.all()),
+        'features': (intents, feature_member_cache_flags(intents, lean=False)),
+        'features, lean cache': (intents, feature_member_cache_flags(intents, lean=True)),
+    }
+    print(f'{guilds} guild(s) x {members} member(s)')
+    print(f'{"mode":<22} {"cached members":>15} {"memory":>12} {"per member":>12}')
+    for name, (mode_intents, flags) in modes.items():
+        size, cached = measure(mode_intents, flags, guilds, members)
+        print(f'{name:<22} {cached:>15} {size / 2 ** 20:10.1f}MB {size / (guilds * members):10.0f}B')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+replay recorded gateway traffic through the bot's dispatch path, with REST calls answered by a stub
+
+record traffic by running the bot with DLBOT_RECORD_DIR set, then from the repository root:
+
+    python -m benchmarks.replay recordings/ [--speed 1] [--rest-latency 0.05] [--config config.db]
+
+--speed 1 replays in real time, 10 ten times faster, 0 as fast as possible, the report shows throughput,
+the largest backlog of handler tasks and queues, REST calls the handlers made and handler latencies
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import discord
+from discord.http import Route
+
+from recorder import read
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_EVERY = 100
+DRAIN_TIMEOUT = 30.0
+
+
+class StubREST:
+    """
+    answers requests of discord.py's HTTP client locally, with payloads just complete enough for the bot
+    """
+
+    def __init__(self, user: dict, latency: float):
+        """
+        :param user: payload of the bot user, author of sent messages
+        :param latency: seconds every request takes
+        """
+        self.user = user
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+        self.ids = itertools.count(int(time.time() * 1000 - discord.utils.DISCORD_EPOCH) << 22)
+
+    def count(self, key: str) -> None:
+        self.calls[key] = self.calls.get(key, 0) + 1
+
+    async def request(self, route: Route, *, files=None, form=None, **kwargs):
+        self.count(f'{route.method} {route.path}')
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        body = kwargs.get('json') or {}
+        if route.path == '/channels/{channel_id}/messages' and route.method == 'POST':
+            return self.message(route.channel_id, body.get('content', ''))
+        if route.path == '/users/@me/channels':
+            return {'id': str(next(self.ids)), 'type': 1, 'recipients': [{'id': str(body.get('recipient_id')),
+                                                                           'username': 'user', 'discriminator': '0',
+                                                                           'avatar': None}]}
+        if route.path == '/guilds/{guild_id}/channels' and route.method == 'POST':
+            return {'id': str(next(self.ids)), 'guild_id': str(route.guild_id), 'position': 0,
+                    'permission_overwrites': [], **body}
+        if route.method == 'GET':
+            return []
+        return {}
+
+    def message(self, channel_id: int, content: str) -> dict:
+        return {'id': str(next(self.ids)), 'channel_id': str(channel_id), 'type': 0, 'content': content,
+                'author': self.user, 'tts': False, 'pinned': False, 'mention_everyone': False, 'mentions': [],
+                'mention_roles': [], 'attachments': [], 'embeds': [], 'edited_timestamp': None,
+                'timestamp': discord.utils.utcnow().isoformat()}
+
+
+class StubWebhook:
+    """
+    logs webhook, sends are counted by the stub instead of going through a webhook session
+    """
+
+    def __init__(self, rest: StubREST):
+        self.rest = rest
+
+    async def send(self, **kwargs) -> None:
+        self.rest.count('POST /webhooks/{webhook_id}/{webhook_token}')
+        if self.rest.latency:
+            await asyncio.sleep(self.rest.latency)
+
+
+async def replay(main, paths: list[str], speed: float, latency: float) -> None:
+    bot = main.bot
+    state = bot._connection
+    # there is no websocket to request members with
+    state._chunk_guilds = False
+    rest = StubREST({'id': '0', 'username': 'bot', 'discriminator': '0', 'avatar': None, 'bot': True}, latency)
+    bot.http.request = rest.request
+
+    async def webhook(channel: discord.TextChannel) -> StubWebhook:
+        return StubWebhook(rest)
+
+    main.log_resolver.webhook = webhook
+    outbox = main.log_resolver.outbox
+
+    async with bot:
+        await bot.setup_hook()
+        baseline = len(asyncio.all_tasks())
+        events = 0
+        backlog = queued = lanes = 0
+        first = start = None
+        for timestamp, event_type, data in read(paths):
+            if event_type == 'READY':
+                rest.user = data['user']
+            if first is None:
+                first, start = timestamp, time.perf_counter()
+            if speed > 0:
+                delay = (timestamp - first) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            parser = state.parsers.get(event_type)
+            if parser is not None:
+                try:
+                    parser(data)
+                except Exception as e:
+                    print(f'Failed to parse {event_type}: {e!r}')
+            events += 1
+            if events % SAMPLE_EVERY == 0:
+                backlog = max(backlog, len(asyncio.all_tasks()) - baseline)
+                queued = max(queued, sum(map(len, outbox.queues.values())))
+                lanes = max(lanes, main.ingest.depth)
+                await asyncio.sleep(0)
+        if start is None:
+            print('Nothing to replay')
+            return
+        fed = time.perf_counter() - start
+        deadline = time.perf_counter() + DRAIN_TIMEOUT
+        while ((len(asyncio.all_tasks()) > baseline or main.ingest.depth)
+               and time.perf_counter() < deadline):
+            await asyncio.sleep(0.01)
+        await outbox.flush()
+        drained = time.perf_counter() - start
+
+    print(f'{events} event(s) fed in {fed:.2f}s ({events / max(fed, 1e-9):.0f}/s), drained after {drained:.2f}s')
+    print(f'Largest backlog: {backlog} handler task(s), {lanes} queued handler call(s), {queued} queued log line(s), '
+          f'{main.dm_outbox.depth} DM(s) left')
+    print(f'Ingest: {main.ingest.stats()}')
+    print('REST calls:')
+    for key, count in sorted(rest.calls.items(), key=lambda item: -item[1]):
+        print(f'  {key}: {count}')
+    print(main.metrics.summary())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded gateway traffic offline')
+    parser.add_argument('paths', nargs='+', help='segment files or directories containing them')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 for as fast as possible')
+    parser.add_argument('--rest-latency', type=float, default=0.0, help='seconds every stubbed REST call takes')
+    parser.add_argument('--config', help='config store to replay with (copied, log channels etc.)')
+    args = parser.parse_args()
+    paths = [os.path.abspath(path) for path in args.paths]
+
+    # main opens its config store in the working directory, keep it away from the real one
+    sys.path.insert(0, ROOT)
+    directory = tempfile.mkdtemp()
+    if args.config is not None:
+        shutil.copy(args.config, os.path.join(directory, 'config.db'))
+    os.chdir(directory)
+    os.environ.pop('DLBOT_RECORD_DIR', None)
+    import main as bot_main
+
+    asyncio.run(replay(bot_main, paths, args.speed, args.rest_latency))
+    bot_main.config.close()
+
+
+if __name__ == '__main__':
+    main()
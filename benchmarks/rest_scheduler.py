@@ -0,0 +1,169 @@
+"""
+load test of the REST scheduler against a local fake of Discord's REST API which emits 429s
+
+run from the repository root: python -m benchmarks.rest_scheduler [--logs 600] [--rate 50]
+
+an incident is simulated: a flood of log messages, DMs and autorole assignments, then a few bans,
+once with discord.py alone and once with the scheduler in front of it, the report shows how long
+the requests of every class took
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import aiohttp
+import discord
+from aiohttp import web
+from discord.http import HTTPClient, Route
+
+from rest_scheduler import AUTOROLE, DM, LOG, MODERATION, PRIORITY_NAMES, RestScheduler, rest_priority
+
+ROUTE_LIMIT = 5
+ROUTE_WINDOW = 1.0
+
+
+class FakeDiscord:
+    """
+    answers every request with {} within a global limit and per-route buckets, like Discord does
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.window_start = time.monotonic()
+        self.global_count = 0
+        self.routes: dict[str, tuple[float, int]] = {}
+        self.served = 0
+        self.limited = 0
+
+    def limited_response(self, retry_after: float, scope: str, headers: dict) -> web.Response:
+        self.limited += 1
+        headers = dict(headers, **{'Retry-After': f'{retry_after:.3f}', 'X-RateLimit-Scope': scope})
+        if scope == 'global':
+            headers['X-RateLimit-Global'] = 'true'
+        return web.json_response({'message': 'You are being rate limited.', 'retry_after': retry_after,
+                                  'global': scope == 'global'}, status=429, headers=headers)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        now = time.monotonic()
+        # Discord's responses come through a proxy, discord.py treats 429s without it as a ban
+        headers = {'Via': '1.1 google'}
+        if now - self.window_start >= 1.0:
+            self.window_start, self.global_count = now, 0
+        if self.global_count >= self.rate:
+            return self.limited_response(1.0 - (now - self.window_start), 'global', headers)
+        self.global_count += 1
+        key = f'{request.method} {request.path}'
+        start, count = self.routes.get(key, (now, 0))
+        if now - start >= ROUTE_WINDOW:
+            start, count = now, 0
+        reset_after = ROUTE_WINDOW - (now - start)
+        headers.update({'X-RateLimit-Limit': str(ROUTE_LIMIT), 'X-RateLimit-Bucket': key,
+                        'X-RateLimit-Reset-After': f'{reset_after:.3f}',
+                        'X-RateLimit-Reset': f'{time.time() + reset_after:.3f}'})
+        if count >= ROUTE_LIMIT:
+            headers['X-RateLimit-Remaining'] = '0'
+            return self.limited_response(reset_after, 'user', headers)
+        self.routes[key] = (start, count + 1)
+        headers['X-RateLimit-Remaining'] = str(ROUTE_LIMIT - count - 1)
+        self.served += 1
+        await asyncio.sleep(0.02)
+        return web.json_response({}, headers=headers)
+
+
+async def client(port: int, scheduler: RestScheduler | None) -> tuple[HTTPClient, aiohttp.ClientSession]:
+    trace = aiohttp.TraceConfig()
+    if scheduler is not None:
+        scheduler.trace(trace)
+    http = HTTPClient(asyncio.get_running_loop())
+    session = aiohttp.ClientSession(trace_configs=[trace])
+    http._HTTPClient__session = session
+    http.token = 'token'
+    # normally done by static_login, which would call the real API
+    http._global_over = asyncio.Event()
+    http._global_over.set()
+    if scheduler is not None:
+        scheduler.attach(http)
+        scheduler.start()
+    return http, session
+
+
+async def incident(http: HTTPClient, logs: int) -> dict[int, list[float]]:
+    """
+    :return: seconds every request took by priority class, NaN for failed ones
+    """
+    durations: dict[int, list[float]] = {priority: [] for priority in range(len(PRIORITY_NAMES))}
+
+    async def call(priority: int, route: Route, **kwargs):
+        rest_priority.set(priority)
+        start = time.perf_counter()
+        try:
+            await http.request(route, **kwargs)
+            durations[priority].append(time.perf_counter() - start)
+        except (discord.HTTPException, discord.RateLimited):
+            durations[priority].append(float('nan'))
+
+    tasks = []
+    for i in range(logs):
+        tasks.append(asyncio.create_task(call(LOG, Route('POST', '/channels/{channel_id}/messages',
+                                                         channel_id=i % 20), json={'content': 'log'})))
+    for i in range(logs // 10):
+        tasks.append(asyncio.create_task(call(DM, Route('POST', '/channels/{channel_id}/messages',
+                                                        channel_id=1000 + i), json={'content': 'dm'})))
+        route = Route('PUT', '/guilds/{guild_id}/members/{user_id}/roles/{role_id}', guild_id=i % 3, user_id=i,
+                      role_id=1)
+        tasks.append(asyncio.create_task(call(AUTOROLE, route)))
+    await asyncio.sleep(1.0)
+    for i in range(10):
+        tasks.append(asyncio.create_task(call(MODERATION, Route('PUT', '/guilds/{guild_id}/bans/{user_id}',
+                                                                guild_id=1, user_id=5000 + i))))
+    await asyncio.gather(*tasks)
+    return durations
+
+
+def report(name: str, durations: dict[int, list[float]]) -> None:
+    print(name)
+    print(f'  {"class":<12} {"requests":>9} {"failed":>7} {"median":>9} {"max":>9}')
+    for priority, values in durations.items():
+        done = [value for value in values if value == value]
+        if not values:
+            continue
+        median = f'{statistics.median(done):8.2f}s' if done else '-'
+        longest = f'{max(done):8.2f}s' if done else '-'
+        print(f'  {PRIORITY_NAMES[priority]:<12} {len(values):>9} {len(values) - len(done):>7} {median:>9} '
+              f'{longest:>9}')
+
+
+async def run(logs: int, rate: float) -> None:
+    for name, scheduler in (('discord.py alone', None),
+                            ('with scheduler', RestScheduler(rate=rate, max_delay=10.0))):
+        fake = FakeDiscord(rate)
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', fake.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        Route.BASE = f'http://127.0.0.1:{port}/api/v10'
+        http, session = await client(port, scheduler)
+        start = time.perf_counter()
+        durations = await incident(http, logs)
+        report(f'{name}: {time.perf_counter() - start:.1f}s, {fake.served} served, {fake.limited} 429s', durations)
+        if scheduler is not None:
+            print(f'  shed: {scheduler.stats()["log"]["shed"]} log request(s)')
+            scheduler.task.cancel()
+        await session.close()
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the REST scheduler')
+    parser.add_argument('--logs', type=int, default=600, help='number of log messages of the incident')
+    parser.add_argument('--rate', type=float, default=50, help='global rate limit of the fake server')
+    args = parser.parse_args()
+    asyncio.run(run(args.logs, args.rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import asyncio
+import datetime
+import re
+import time
+from collections.abc import Awaitable, Callable, Iterable
+
+import discord
+
+id_regex = re.compile(r'\d{15,20}')
+
+
+def parse_members(guild: discord.Guild, text: str) -> list[discord.Member]:
+    """
+    find members mentioned (or referenced by id) in text
+    :param guild: guild to look members up in
+    :param text: mentions and/or ids separated by anything
+    :return: members in the order of appearance, without duplicates and members not in the guild
+    """
+    members = {}
+    for member_id in map(int, id_regex.findall(text)):
+        member = guild.get_member(member_id)
+        if member is not None:
+            members[member_id] = member
+    return list(members.values())
+
+
+def recent_members(guild: discord.Guild, minutes: int) -> list[discord.Member]:
+    """
+    :param guild: guild
+    :param minutes: length of the window
+    :return: members who joined the guild in the last minutes
+    """
+    since = discord.utils.utcnow() - datetime.timedelta(minutes=minutes)
+    return [member for member in guild.members if member.joined_at is not None and member.joined_at >= since]
+
+
+class BulkResult:
+    def __init__(self, total: int):
+        self.total = total
+        self.succeeded = 0
+        self.failed: list[tuple[discord.abc.Snowflake, Exception]] = []
+
+    @property
+    def done(self) -> int:
+        return self.succeeded + len(self.failed)
+
+    def summary(self, action: str) -> str:
+        content = f'{action} {self.succeeded}/{self.total} member(s)'
+        if self.failed:
+            content += f', {len(self.failed)} failed: ' + ', '.join(
+                f'**{target}** ({type(error).__name__})' for target, error in self.failed[:20])
+            if len(self.failed) > 20:
+                content += ', ...'
+        return content
+
+
+async def run_bulk(targets: Iterable, action: Callable[[object], Awaitable], concurrency: int = 4,
+                   progress: Callable[[BulkResult], Awaitable] | None = None,
+                   progress_interval: float = 2.0) -> BulkResult:
+    """
+    run action for every target with at most concurrency actions in flight
+
+    discord.py already waits out per-route rate limits, the bound keeps a large batch from queueing
+    hundreds of requests on the same bucket and starving everything else
+    :param targets: targets of the action
+    :param action: coroutine function called with every target
+    :param concurrency: maximum number of actions running at the same time
+    :param progress: coroutine function called with the current result at most once per progress_interval
+    :param progress_interval: seconds between progress reports
+    :return: result
+    """
+    targets = list(targets)
+    result = BulkResult(len(targets))
+    semaphore = asyncio.Semaphore(concurrency)
+    reported = time.monotonic()
+
+    async def run(target):
+        nonlocal reported
+        async with semaphore:
+            try:
+                await action(target)
+                result.succeeded += 1
+            except (discord.HTTPException, asyncio.TimeoutError) as e:
+                result.failed.append((target, e))
+        if progress is not None and time.monotonic() - reported >= progress_interval:
+            reported = time.monotonic()
+            # a failed report (expired interaction token, deleted message) must not abort the remaining actions
+            try:
+                await progress(result)
+            except discord.HTTPException as e:
+                print(f'Failed to report bulk progress: {e}')
+
+    await asyncio.gather(*(run(target) for target in targets))
+    return result
@@ -0,0 +1,229 @@
+"""
+run the bot as several processes (clusters), each one owning a range of shards
+
+    python cluster.py --clusters 4 --shards 16
+    python cluster.py --clusters 3 --shards 6 --fake    # local test without Discord
+
+clusters share configuration through the SQLite config store (a guild belongs to exactly one shard,
+so its rows are only ever written by one process) and talk to each other through the hub run by the launcher
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+from collections.abc import Awaitable, Callable
+
+HUB_HOST = '127.0.0.1'
+HUB_PORT = 7435
+REQUEST_TIMEOUT = 5.0
+
+
+def shard_ranges(shard_count: int, clusters: int) -> list[list[int]]:
+    """
+    split shards into contiguous ranges of (almost) equal size
+    :param shard_count: total number of shards
+    :param clusters: number of clusters
+    :return: shard ids of every cluster
+    """
+    size, extra = divmod(shard_count, clusters)
+    ranges = []
+    start = 0
+    for cluster in range(clusters):
+        end = start + size + (cluster < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def send(writer: asyncio.StreamWriter, message: dict) -> None:
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+
+
+class Hub:
+    """
+    message hub of the launcher, relays broadcast requests of a cluster to every cluster and collects replies
+    """
+
+    def __init__(self):
+        self.clusters: dict[int, asyncio.StreamWriter] = {}
+        self.pending: dict[int, asyncio.Future] = {}
+        self.ids = itertools.count()
+        self.connected = asyncio.Event()
+        self.expected = 0
+
+    async def serve(self, host: str = HUB_HOST, port: int = HUB_PORT) -> asyncio.Server:
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        hello = json.loads(await reader.readline())
+        cluster = hello['cluster']
+        self.clusters[cluster] = writer
+        if len(self.clusters) >= self.expected:
+            self.connected.set()
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if message['op'] == 'broadcast':
+                    asyncio.create_task(self.relay(writer, message))
+                elif message['op'] == 'reply':
+                    future = self.pending.get(message['id'])
+                    if future is not None and not future.done():
+                        future.set_result(message['data'])
+        except ConnectionError:
+            pass
+        finally:
+            if self.clusters.get(cluster) is writer:
+                del self.clusters[cluster]
+
+    async def broadcast(self, name: str, data=None) -> dict[int, object]:
+        """
+        send request to every cluster
+        :param name: name of the request
+        :param data: request data
+        :return: replies by cluster id, clusters which didn't reply in time are missing
+        """
+        requests = {}
+        for cluster, writer in list(self.clusters.items()):
+            request_id = next(self.ids)
+            future = self.pending[request_id] = asyncio.get_running_loop().create_future()
+            requests[cluster] = (request_id, future)
+            try:
+                await send(writer, {'op': 'request', 'id': request_id, 'name': name, 'data': data})
+            except ConnectionError:
+                future.cancel()
+        replies = {}
+        for cluster, (request_id, future) in requests.items():
+            try:
+                replies[cluster] = await asyncio.wait_for(future, REQUEST_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+            finally:
+                self.pending.pop(request_id, None)
+        return replies
+
+    async def relay(self, writer: asyncio.StreamWriter, message: dict) -> None:
+        replies = await self.broadcast(message['name'], message['data'])
+        await send(writer, {'op': 'reply', 'id': message['id'], 'data': {str(k): v for k, v in replies.items()}})
+
+
+class ClusterClient:
+    """
+    connection of a cluster to the hub, answers requests with registered handlers
+    """
+
+    def __init__(self, cluster: int, host: str = HUB_HOST, port: int = HUB_PORT):
+        self.cluster = cluster
+        self.host = host
+        self.port = port
+        self.handlers: dict[str, Callable[[object], Awaitable]] = {}
+        self.pending: dict[int, asyncio.Future] = {}
+        self.ids = itertools.count()
+        self.writer: asyncio.StreamWriter | None = None
+        self.task: asyncio.Task | None = None
+
+    def handler(self, name: str):
+        """
+        decorator registering coroutine function answering requests with the name
+        """
+        def decorator(function):
+            self.handlers[name] = function
+            return function
+        return decorator
+
+    async def connect(self) -> None:
+        reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        await send(self.writer, {'cluster': self.cluster})
+        self.task = asyncio.create_task(self.listen(reader))
+
+    async def listen(self, reader: asyncio.StreamReader) -> None:
+        while line := await reader.readline():
+            message = json.loads(line)
+            if message['op'] == 'request':
+                asyncio.create_task(self.answer(message))
+            elif message['op'] == 'reply':
+                future = self.pending.pop(message['id'], None)
+                if future is not None and not future.done():
+                    future.set_result({int(k): v for k, v in message['data'].items()})
+
+    async def answer(self, message: dict) -> None:
+        handler = self.handlers.get(message['name'])
+        data = None if handler is None else await handler(message['data'])
+        await send(self.writer, {'op': 'reply', 'id': message['id'], 'data': data})
+
+    async def broadcast(self, name: str, data=None) -> dict[int, object]:
+        """
+        send request to every cluster (including this one)
+        :param name: name of the request
+        :param data: request data
+        :return: replies by cluster id
+        """
+        request_id = next(self.ids)
+        future = self.pending[request_id] = asyncio.get_running_loop().create_future()
+        await send(self.writer, {'op': 'broadcast', 'id': request_id, 'name': name, 'data': data})
+        try:
+            return await asyncio.wait_for(future, 2 * REQUEST_TIMEOUT)
+        finally:
+            self.pending.pop(request_id, None)
+
+
+def cluster_from_env() -> tuple[ClusterClient | None, list[int] | None, int | None]:
+    """
+    read the cluster configuration the launcher passes to its workers
+    :return: (client, shard ids, shard count), all None when not running in a cluster
+    """
+    if 'DLBOT_CLUSTER_ID' not in os.environ:
+        return None, None, None
+    host, port = os.environ.get('DLBOT_HUB', f'{HUB_HOST}:{HUB_PORT}').rsplit(':', 1)
+    client = ClusterClient(int(os.environ['DLBOT_CLUSTER_ID']), host, int(port))
+    shard_ids = [int(shard_id) for shard_id in os.environ['DLBOT_SHARD_IDS'].split(',')]
+    return client, shard_ids, int(os.environ['DLBOT_SHARD_COUNT'])
+
+
+async def supervise(cluster: int, shard_ids: list[int], shard_count: int, port: int, fake: bool) -> None:
+    """
+    run worker process and restart it when it crashes
+    """
+    env = dict(os.environ, DLBOT_CLUSTER_ID=str(cluster), DLBOT_SHARD_IDS=','.join(map(str, shard_ids)),
+               DLBOT_SHARD_COUNT=str(shard_count), DLBOT_HUB=f'{HUB_HOST}:{port}')
+    if fake:
+        env['DLBOT_FAKE_GATEWAY'] = '1'
+    main = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, main, env=env)
+        code = await process.wait()
+        print(f'Cluster {cluster} (shards {shard_ids[0]}-{shard_ids[-1]}) exited with code {code}')
+        if code == 0:
+            return
+        await asyncio.sleep(5)
+
+
+async def launch(clusters: int, shard_count: int, port: int, fake: bool) -> None:
+    hub = Hub()
+    hub.expected = clusters
+    server = await hub.serve(port=port)
+    workers = [asyncio.create_task(supervise(cluster, shard_ids, shard_count, port, fake))
+               for cluster, shard_ids in enumerate(shard_ranges(shard_count, clusters))]
+    async with server:
+        if fake:
+            await asyncio.wait_for(hub.connected.wait(), 60)
+            for cluster, stats in sorted((await hub.broadcast('stats')).items()):
+                print(f'Cluster {cluster}: {stats}')
+            await hub.broadcast('shutdown')
+        await asyncio.gather(*workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the bot as several processes')
+    parser.add_argument('--clusters', type=int, default=os.cpu_count(), help='number of processes')
+    parser.add_argument('--shards', type=int, required=True, help='total number of shards')
+    parser.add_argument('--port', type=int, default=HUB_PORT, help='port of the hub')
+    parser.add_argument('--fake', action='store_true', help="run workers without connecting to Discord")
+    args = parser.parse_args()
+    asyncio.run(launch(min(args.clusters, args.shards), args.shards, args.port, args.fake))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import hashlib
+import json
+
+import discord
+from discord import app_commands
+
+from config_store import ConfigTable
+
+# scope id of global commands in the hash table
+GLOBAL_SCOPE = 0
+
+
+def tree_hash(tree: app_commands.CommandTree, guild: discord.abc.Snowflake | None = None) -> int:
+    """
+    stable hash of the commands tree as it is sent to Discord
+    :param tree: commands tree
+    :param guild: guild of guild commands, None for global commands
+    :return: first 8 bytes of sha256 of the serialized commands
+    """
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands(guild=guild)),
+                     key=lambda command: (command.get('type', 1), command['name']))
+    digest = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+async def sync_tree(tree: app_commands.CommandTree, hashes: ConfigTable, guild: discord.abc.Snowflake | None = None,
+                    force: bool = False) -> bool:
+    """
+    sync commands tree only if it changed since the last sync of the scope
+    :param tree: commands tree
+    :param hashes: scope id -> hash of the last synced tree
+    :param guild: guild to sync commands of, None for global commands
+    :param force: sync even if the tree didn't change
+    :return: whether the tree was synced
+    """
+    scope = GLOBAL_SCOPE if guild is None else guild.id
+    current = tree_hash(tree, guild)
+    if not force and hashes.get(scope) == current:
+        return False
+    await tree.sync(guild=guild)
+    await hashes.set(scope, current)
+    return True
@@ -0,0 +1,164 @@
+import asyncio
+import os
+import pickle
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+MISSING = object()
+
+
+class ConfigStore:
+    """
+    durable bot configuration in SQLite (WAL mode)
+
+    reads go through a per-table cache and hit the database only on the first lookup of a guild,
+    writes commit one row at a time on a dedicated thread, so the event loop is never blocked by fsync
+    """
+
+    def __init__(self, path: str = 'config.db'):
+        """
+        :param path: path to the database file
+        """
+        self.path = path
+        self.reader = self.connect()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='config-store')
+        self.writer = self.executor.submit(self.connect).result()
+        self.tables: dict[str, ConfigTable] = {}
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def table(self, name: str, *columns: str, key: str = 'guild_id') -> 'ConfigTable':
+        """
+        get (and create if needed) table keyed by an id (guild id by default)
+        :param name: name of the table
+        :param columns: names of the value columns
+        :param key: name of the key column
+        :return: table
+        """
+        table = self.tables.get(name)
+        if table is None:
+            definition = ', '.join(f'{column} INTEGER' for column in columns)
+            self.reader.execute(f'CREATE TABLE IF NOT EXISTS {name} ({key} INTEGER PRIMARY KEY, {definition})')
+            table = self.tables[name] = ConfigTable(self, name, columns, key)
+        return table
+
+    async def write(self, sql: str, parameters: tuple = ()) -> int:
+        """
+        execute single statement on the writer thread, it is committed before returning
+        :param sql: statement
+        :param parameters: statement parameters
+        :return: rowid of the inserted row (for inserts)
+        """
+        cursor = await asyncio.get_running_loop().run_in_executor(self.executor, self.writer.execute, sql,
+                                                                  parameters)
+        return cursor.lastrowid
+
+    def execute_many(self, sql: str, rows: list[tuple]) -> None:
+        self.writer.execute('BEGIN')
+        try:
+            self.writer.executemany(sql, rows)
+        except BaseException:
+            self.writer.execute('ROLLBACK')
+            raise
+        self.writer.execute('COMMIT')
+
+    async def write_many(self, sql: str, rows: list[tuple]) -> None:
+        """
+        execute statement for every row on the writer thread, in a single transaction (one fsync)
+        :param sql: statement
+        :param rows: parameters of every execution
+        :return:
+        """
+        if rows:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.execute_many, sql, rows)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+        self.writer.close()
+        self.reader.close()
+
+
+class ConfigTable:
+    """
+    dict-like view of a table keyed by guild id (or another id), values are loaded lazily per key
+    """
+
+    def __init__(self, store: ConfigStore, name: str, columns: tuple[str, ...], key: str = 'guild_id'):
+        self.store = store
+        self.name = name
+        self.columns = columns
+        self.cache: dict[int, object] = {}
+        self.select = f'SELECT {", ".join(columns)} FROM {name} WHERE {key} = ?'
+        self.select_all = f'SELECT {key}, {", ".join(columns)} FROM {name}'
+        self.upsert = (f'INSERT OR REPLACE INTO {name} ({key}, {", ".join(columns)}) '
+                       f'VALUES (?, {", ".join("?" * len(columns))})')
+        self.remove = f'DELETE FROM {name} WHERE {key} = ?'
+
+    def load(self, guild_id: int):
+        row = self.store.reader.execute(self.select, (guild_id,)).fetchone()
+        if row is not None and len(self.columns) == 1:
+            row = row[0]
+        self.cache[guild_id] = row
+        return row
+
+    def items(self) -> list[tuple[int, object]]:
+        """
+        load the whole table, meant for startup reconciliation of small tables
+        :return: list of (key, value)
+        """
+        items = []
+        for key, *row in self.store.reader.execute(self.select_all):
+            value = row[0] if len(self.columns) == 1 else tuple(row)
+            self.cache[key] = value
+            items.append((key, value))
+        return items
+
+    def get(self, guild_id: int, default=None):
+        value = self.cache.get(guild_id, MISSING)
+        if value is MISSING:
+            value = self.load(guild_id)
+        return default if value is None else value
+
+    def __getitem__(self, guild_id: int):
+        value = self.get(guild_id)
+        if value is None:
+            raise KeyError(guild_id)
+        return value
+
+    def __contains__(self, guild_id: int) -> bool:
+        return self.get(guild_id) is not None
+
+    async def set(self, guild_id: int, value) -> None:
+        """
+        store value of the guild, only this row is written
+        :param guild_id: id of the guild
+        :param value: single value or tuple of values (one per column)
+        :return:
+        """
+        self.cache[guild_id] = value
+        values = value if isinstance(value, tuple) else (value,)
+        await self.store.write(self.upsert, (guild_id, *values))
+
+    async def delete(self, guild_id: int) -> None:
+        self.cache[guild_id] = None
+        await self.store.write(self.remove, (guild_id,))
+
+    def import_pickle(self, path: str) -> None:
+        """
+        one-time migration of the old pickled dict, the file is renamed afterwards
+        :param path: path to the pickle file
+        :return:
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as file:
+            data = pickle.load(file)
+        rows = [(guild_id, *(value if isinstance(value, tuple) else (value,))) for guild_id, value in data.items()]
+        self.store.reader.execute('BEGIN')
+        self.store.reader.executemany(self.upsert, rows)
+        self.store.reader.execute('COMMIT')
+        os.replace(path, f'{path}.migrated')
@@ -0,0 +1,240 @@
+from collections.abc import Callable
+from operator import attrgetter
+from typing import NamedTuple
+
+import discord
+
+get_id = attrgetter('id')
+
+
+def item_keys(items: list) -> list:
+    """
+    keys used to match items of a collection, discord objects are matched by id, everything else by value
+    """
+    try:
+        return list(map(get_id, items))
+    except AttributeError:
+        return items
+
+
+def diff_several(before, after) -> tuple[list, list]:
+    """
+    find items removed from and added to a collection in O(n + m)
+    :param before: collection before update
+    :param after: collection after update
+    :return: (removed items, added items), both in their original order
+    """
+    if before is after:
+        return [], []
+    before = list(before)
+    after = list(after)
+    if before == after:
+        return [], []
+    before_keys = item_keys(before)
+    after_keys = item_keys(after)
+    before_set = set(before_keys)
+    after_set = set(after_keys)
+    removed_keys = before_set - after_set
+    added_keys = after_set - before_set
+    removed = [item for item, key in zip(before, before_keys) if key in removed_keys] if removed_keys else []
+    added = [item for item, key in zip(after, after_keys) if key in added_keys] if added_keys else []
+    return removed, added
+
+
+def mention(value) -> str:
+    return getattr(value, 'mention', str(value))
+
+
+def render_scalar(label: str, before, after) -> list[str]:
+    return [f'{label}: {mention(before)} -> {mention(after)}']
+
+
+def render_collection(label: str, before, after) -> list[str]:
+    removed, added = diff_several(before, after)
+    lines = []
+    if len(removed) > 0:
+        lines.append(f'{label} removed: {", ".join(map(mention, removed))}')
+    if len(added) > 0:
+        lines.append(f'{label} added: {", ".join(map(mention, added))}')
+    return lines
+
+
+def check_single(before, after, name: str = None) -> str:
+    if name is None:
+        name = after.__name__
+    if before == after:
+        return ''
+    return ''.join(f'{line}\n' for line in render_scalar(name, before, after))
+
+
+def check_several(before, after, name: str = None) -> str:
+    if name is None:
+        name = f'{after.__name__}s'
+    return ''.join(f'{line}\n' for line in render_collection(name, before, after))
+
+
+# ----------------------------------------------------------------------------------------------------
+# Diff specs
+
+def flag_names(flags: type[discord.flags.BaseFlags]) -> dict[int, str]:
+    """
+    precompute bit -> name table of a flags class, aliases are used only for bits without their own name
+    :param flags: flags class (Permissions, SystemChannelFlags, ...)
+    :return: table
+    """
+    table = {}
+    for name, value in flags.VALID_FLAGS.items():
+        if not isinstance(getattr(flags, name), discord.flags.alias_flag_value):
+            table[value] = name
+    for name, value in flags.VALID_FLAGS.items():
+        table.setdefault(value, name)
+    return table
+
+
+PERMISSION_NAMES = flag_names(discord.Permissions)
+
+
+def bit_names(table: dict[int, str], value: int) -> list[str]:
+    """
+    names of the set bits, costs one iteration per set bit
+    """
+    names = []
+    while value:
+        bit = value & -value
+        names.append(table.get(bit, str(bit)))
+        value ^= bit
+    return names
+
+
+def bold_names(table: dict[int, str], value: int) -> str:
+    return f'**{"**, **".join(bit_names(table, value))}**'
+
+
+def render_permissions(label: str, before: int, after: int) -> list[str]:
+    lines = []
+    removed = before & ~after
+    added = after & ~before
+    if removed:
+        lines.append(f'{label} removed: {bold_names(PERMISSION_NAMES, removed)}')
+    if added:
+        lines.append(f'{label} added: {bold_names(PERMISSION_NAMES, added)}')
+    return lines
+
+
+def overwrite_values(overwrites: list) -> dict[int, tuple[int, int, int]]:
+    """
+    :param overwrites: raw overwrites of a channel (discord.abc.GuildChannel._overwrites)
+    :return: {target id: (target type, allowed bits, denied bits)}
+    """
+    return {overwrite.id: (overwrite.type, overwrite.allow, overwrite.deny) for overwrite in overwrites}
+
+
+def render_overwrites(label: str, before: dict, after: dict) -> list[str]:
+    lines = []
+    for target in [*before, *(target for target in after if target not in before)]:
+        target_type, before_allow, before_deny = before.get(target, (None, 0, 0))
+        target_type, after_allow, after_deny = after.get(target, (target_type, 0, 0))
+        changes = []
+        allowed = after_allow & ~before_allow
+        denied = after_deny & ~before_deny
+        reset = (before_allow | before_deny) & ~(after_allow | after_deny)
+        if allowed:
+            changes.append(f'allowed {bold_names(PERMISSION_NAMES, allowed)}')
+        if denied:
+            changes.append(f'denied {bold_names(PERMISSION_NAMES, denied)}')
+        if reset:
+            changes.append(f'reset {bold_names(PERMISSION_NAMES, reset)}')
+        if changes:
+            mention = f'<@&{target}>' if target_type == 0 else f'<@{target}>'
+            lines.append(f'{label} for {mention}: {"; ".join(changes)}')
+    return lines
+
+
+class Field(NamedTuple):
+    get: Callable
+    label: str
+    render: Callable[[str, object, object], list[str]]
+
+
+def scalar(attribute: str, label: str) -> Field:
+    return Field(attrgetter(attribute), label, render_scalar)
+
+
+def collection(attribute: str, label: str) -> Field:
+    """
+    collection compared as a tuple, discord.py returns some of them as a SequenceProxy which never compares equal
+    """
+    get = attrgetter(attribute)
+    return Field(lambda obj: tuple(get(obj)), label, render_collection)
+
+
+def permissions(attribute: str, label: str) -> Field:
+    """
+    permission set compared by its raw integer value
+    """
+    return Field(attrgetter(f'{attribute}.value'), label, render_permissions)
+
+
+def flags(attribute: str, label: str, flags_class: type[discord.flags.BaseFlags]) -> Field:
+    """
+    flags compared by their raw integer value, changed flags are reported with their new state
+    """
+    table = flag_names(flags_class)
+
+    def render(label: str, before: int, after: int) -> list[str]:
+        after_flags = flags_class._from_value(after)
+        return [f'{label}: {name} -> {getattr(after_flags, name)}' for name in bit_names(table, before ^ after)]
+
+    return Field(attrgetter(f'{attribute}.value'), label, render)
+
+
+def overwrites(attribute: str, label: str) -> Field:
+    """
+    per-target permission overwrites, the attribute must hold the raw overwrite list of the channel
+    """
+    get = attrgetter(attribute)
+    return Field(lambda channel: overwrite_values(get(channel)), label, render_overwrites)
+
+
+class DiffSpec:
+    """
+    declaration of the fields tracked for an update event, compiled into a list of getters once
+    """
+
+    def __init__(self, header: Callable[[object], str], *fields: Field):
+        """
+        :param header: function rendering the first line of the log from the updated object
+        :param fields: tracked fields, see scalar, collection, permissions and overwrites
+        """
+        self.header = header
+        self.fields = fields
+
+    def changed(self, before, after) -> bool:
+        """
+        fast path: check whether any tracked field changed without rendering anything
+        """
+        for field in self.fields:
+            if field.get(before) != field.get(after):
+                return True
+        return False
+
+    def diff(self, before, after) -> list[str]:
+        """
+        :return: log lines of every changed field
+        """
+        lines = []
+        for get, label, render in self.fields:
+            before_value = get(before)
+            after_value = get(after)
+            if before_value is not after_value and before_value != after_value:
+                lines.extend(render(label, before_value, after_value))
+        return lines
+
+    def render(self, before, after) -> str | None:
+        """
+        :return: complete log message, or None if no tracked field changed
+        """
+        lines = self.diff(before, after)
+        if len(lines) == 0:
+            return None
+        return '\n'.join((self.header(after), *lines))
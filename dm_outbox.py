@@ -0,0 +1,119 @@
+import asyncio
+from collections import OrderedDict
+
+import discord
+
+from rest_scheduler import DM, rest_priority
+
+
+class DMOutbox:
+    """
+    queue of direct messages delivered by a pool of background workers
+
+    DM channels are cached, server errors and rate limits are retried with exponential backoff,
+    messages to users who don't accept DMs (Forbidden) are dropped
+    """
+
+    def __init__(self, workers: int = 4, retries: int = 3, backoff: float = 1.0, cache_size: int = 10_000):
+        """
+        :param workers: number of workers
+        :param retries: attempts after the first failed one
+        :param backoff: delay before the first retry in seconds, doubled on every next one
+        :param cache_size: maximum number of cached DM channels
+        """
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.cache_size = cache_size
+        self.queue: asyncio.Queue[tuple[discord.abc.User, str, asyncio.Future]] = asyncio.Queue()
+        self.channels: OrderedDict[int, discord.DMChannel] = OrderedDict()
+        self.tasks: list[asyncio.Task] = []
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retried = 0
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def stats(self) -> dict[str, int]:
+        return {'depth': self.depth, 'sent': self.sent, 'dropped': self.dropped, 'failed': self.failed,
+                'retried': self.retried}
+
+    def start(self) -> None:
+        self.tasks = [task for task in self.tasks if not task.done()]
+        while len(self.tasks) < self.workers:
+            self.tasks.append(asyncio.create_task(self.work()))
+
+    def put(self, user: discord.abc.User, content: str) -> asyncio.Future:
+        """
+        queue direct message
+        :param user: recipient
+        :param content: message content
+        :return: future resolved with True when the message is delivered, False when it is dropped
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((user, content, future))
+        return future
+
+    async def send(self, user: discord.abc.User, content: str, timeout: float) -> bool:
+        """
+        queue direct message and wait for its delivery at most timeout seconds
+
+        used when the message has to arrive before an action makes it impossible (kick, ban)
+        :param user: recipient
+        :param content: message content
+        :param timeout: maximum waiting time in seconds
+        :return: whether the message was delivered in time
+        """
+        try:
+            return await asyncio.wait_for(asyncio.shield(self.put(user, content)), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    async def channel(self, user: discord.abc.User) -> discord.DMChannel:
+        channel = self.channels.get(user.id)
+        if channel is not None:
+            self.channels.move_to_end(user.id)
+            return channel
+        channel = user.dm_channel or await user.create_dm()
+        self.channels[user.id] = channel
+        if len(self.channels) > self.cache_size:
+            self.channels.popitem(last=False)
+        return channel
+
+    async def work(self) -> None:
+        rest_priority.set(DM)
+        while True:
+            user, content, future = await self.queue.get()
+            try:
+                delivered = await self.deliver(user, content)
+            except Exception as e:
+                print(f'Failed to send direct message to {user}: {e}')
+                self.failed += 1
+                delivered = False
+            finally:
+                self.queue.task_done()
+            if not future.done():
+                future.set_result(delivered)
+
+    async def deliver(self, user: discord.abc.User, content: str) -> bool:
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                channel = await self.channel(user)
+                await channel.send(content)
+                self.sent += 1
+                return True
+            except discord.Forbidden:
+                self.dropped += 1
+                return False
+            except discord.HTTPException as e:
+                if (e.status != 429 and e.status < 500) or attempt == self.retries:
+                    self.failed += 1
+                    return False
+            self.retried += 1
+            await asyncio.sleep(delay)
+            delay *= 2
+        return False
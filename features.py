@@ -0,0 +1,130 @@
+import asyncio
+import os
+
+import discord
+
+# gateway intents every feature needs, 'guilds' and 'webhooks' are always enabled
+FEATURE_INTENTS = {
+    'log_members': ('members',),
+    'log_messages': ('guild_messages', 'message_content'),
+    'log_voice': ('voice_states',),
+    'log_bans': ('moderation',),
+    'log_guild': ('emojis_and_stickers', 'guild_scheduled_events'),
+    'log_automod': ('auto_moderation_configuration', 'auto_moderation_execution'),
+    'log_typing': ('guild_typing',),
+    'autorole': ('members',),
+    'temp_voice': ('voice_states',),
+    # bulk moderation requests member chunks, purge filters read the content of messages it pages through
+    'moderation': ('members', 'message_content'),
+}
+DEFAULT_FEATURES = frozenset(FEATURE_INTENTS) - {'log_typing'}
+# commands which can't work without a feature, they aren't registered while it is disabled
+FEATURE_COMMANDS = {
+    'autorole': ('autorole',),
+    'moderation': ('bulk', 'purge', 'purge_cancel'),
+}
+
+
+def env_features(name: str = 'DLBOT_FEATURES') -> frozenset[str]:
+    """
+    read enabled features from environment variable (comma separated), all but typing logs by default
+    :param name: name of the environment variable
+    :return: enabled features
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return DEFAULT_FEATURES
+    features = frozenset(feature.strip() for feature in value.split(',') if feature.strip())
+    unknown = features - FEATURE_INTENTS.keys()
+    if unknown:
+        raise ValueError(f'Unknown features: {", ".join(sorted(unknown))}')
+    return features
+
+
+def env_flag(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def feature_intents(features: frozenset[str]) -> discord.Intents:
+    """
+    :param features: enabled features
+    :return: the smallest set of intents the features need
+    """
+    intents = discord.Intents.none()
+    intents.guilds = True
+    # logs are delivered through webhooks, their updates invalidate the cached webhook
+    intents.webhooks = True
+    for feature in features:
+        for intent in FEATURE_INTENTS[feature]:
+            setattr(intents, intent, True)
+    return intents
+
+
+def remove_disabled_commands(tree: discord.app_commands.CommandTree, features: frozenset[str]) -> list[str]:
+    """
+    remove commands of disabled features from the tree, before it is synced
+    :param tree: commands tree
+    :param features: enabled features
+    :return: names of the removed commands
+    """
+    removed = []
+    for feature, names in FEATURE_COMMANDS.items():
+        if feature not in features:
+            for name in names:
+                if tree.remove_command(name) is not None:
+                    removed.append(name)
+    return removed
+
+
+def feature_member_cache_flags(intents: discord.Intents, lean: bool) -> discord.MemberCacheFlags:
+    """
+    :param intents: intents of the bot
+    :param lean: cache only members in voice channels (needed by temporary voice channels), other members
+    are cached only after their guild is chunked by ensure_chunked
+    :return: member cache flags
+    """
+    if not lean:
+        return discord.MemberCacheFlags.from_intents(intents)
+    flags = discord.MemberCacheFlags.none()
+    flags.voice = intents.voice_states
+    return flags
+
+
+chunk_locks: dict[int, asyncio.Lock] = {}
+# guild id -> guild object whose members were requested, guild.chunked turns False with the next join when joined
+# members aren't cached, and a new session replaces the guild object with one without members
+chunked_guilds: dict[int, discord.Guild] = {}
+
+
+def is_chunked(guild: discord.Guild) -> bool:
+    return guild.chunked or chunked_guilds.get(guild.id) is guild
+
+
+async def ensure_chunked(guild: discord.Guild) -> None:
+    """
+    request all members of the guild once, concurrent callers share the same request
+    :param guild: guild
+    :return:
+    """
+    if is_chunked(guild):
+        return
+    lock = chunk_locks.setdefault(guild.id, asyncio.Lock())
+    async with lock:
+        if not is_chunked(guild):
+            await guild.chunk(cache=True)
+            chunked_guilds[guild.id] = guild
+    chunk_locks.pop(guild.id, None)
+
+
+def cache_joined(member: discord.Member) -> None:
+    """
+    keep the member list of a chunked guild complete with the lean member cache, which doesn't cache joins
+    :param member: recently joined member
+    :return:
+    """
+    guild = member.guild
+    if chunked_guilds.get(guild.id) is guild and guild.get_member(member.id) is None:
+        guild._add_member(member)
@@ -0,0 +1,136 @@
+import asyncio
+import datetime
+import time
+
+from config_store import ConfigStore
+
+# kinds of infractions
+ACTION_KICK = 1
+ACTION_BAN = 2
+ACTION_UNBAN = 3
+ACTION_MUTE = 4
+ACTION_UNMUTE = 5
+ACTION_PURGE = 6
+ACTION_NAMES = {ACTION_KICK: 'Kick', ACTION_BAN: 'Ban', ACTION_UNBAN: 'Unban', ACTION_MUTE: 'Mute',
+                ACTION_UNMUTE: 'Unmute', ACTION_PURGE: 'Purge'}
+
+PAGE_SIZE = 10
+REASON_LENGTH = 100
+INSERT = ('INSERT INTO infractions (guild_id, user_id, moderator_id, action, created, duration, channel_id, reason) '
+          'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+
+
+class InfractionLog:
+    """
+    history of moderation actions in the config store, one row per action and member
+
+    rows are indexed by (guild, user, time), so a page of a member's history is an index range scan no matter
+    how large the table is, and pages are fetched by keyset ((time, id) of the last row shown) instead of
+    OFFSET, which would scan every skipped row
+
+    records are buffered and written in one transaction every interval seconds, so a bulk ban of hundreds
+    of members costs one fsync
+    """
+
+    def __init__(self, store: ConfigStore, interval: float = 1.0):
+        """
+        :param store: config store the table lives in
+        :param interval: seconds records are buffered for at most
+        """
+        self.store = store
+        self.interval = interval
+        store.reader.execute('CREATE TABLE IF NOT EXISTS infractions (id INTEGER PRIMARY KEY, '
+                             'guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, moderator_id INTEGER NOT NULL, '
+                             'action INTEGER NOT NULL, created REAL NOT NULL, duration REAL, channel_id INTEGER, '
+                             'reason TEXT)')
+        store.reader.execute('CREATE INDEX IF NOT EXISTS infractions_member ON infractions (guild_id, user_id, '
+                             'created)')
+        self.buffer: list[tuple] = []
+        self.ready = asyncio.Event()
+        self.written = 0
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def add(self, guild_id: int, user_id: int, moderator_id: int, action: int, reason: str = '',
+            duration: datetime.timedelta | None = None, channel_id: int | None = None) -> None:
+        """
+        record moderation action, written with the next batch
+        :param guild_id: id of the guild
+        :param user_id: id of the member the action was taken against (0 for a purge of everyone's messages)
+        :param moderator_id: id of the moderator
+        :param action: one of the ACTION_ constants
+        :param reason: reason given by the moderator
+        :param duration: duration of a temporary action
+        :param channel_id: channel of a purge
+        :return:
+        """
+        self.buffer.append((guild_id, user_id, moderator_id, action, time.time(),
+                            None if duration is None else duration.total_seconds(), channel_id, reason or None))
+        self.ready.set()
+
+    async def run(self) -> None:
+        while True:
+            await self.ready.wait()
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f'Failed to write infractions: {e!r}')
+
+    async def flush(self) -> None:
+        self.ready.clear()
+        rows = self.buffer
+        if not rows:
+            return
+        self.buffer = []
+        await self.store.write_many(INSERT, rows)
+        self.written += len(rows)
+
+    def close(self) -> None:
+        """
+        write what is left, before the store is closed
+        :return:
+        """
+        if self.buffer:
+            self.store.executor.submit(self.store.execute_many, INSERT, self.buffer).result()
+            self.buffer = []
+
+    async def page(self, guild_id: int, user_id: int, before: tuple[float, int] | None = None,
+                   limit: int = PAGE_SIZE) -> list[tuple]:
+        """
+        :param guild_id: id of the guild
+        :param user_id: id of the member
+        :param before: (created, id) of the last row of the previous page, None for the first page
+        :param limit: number of rows
+        :return: rows (id, created, moderator id, action, duration, channel id, reason), newest first
+        """
+        if self.buffer:
+            # the newest records are part of the history as well
+            await self.flush()
+        created, row_id = before if before is not None else (float('inf'), 0)
+        # the first condition alone lets SQLite seek the index, the second one breaks ties of the same time
+        return self.store.reader.execute(
+            'SELECT id, created, moderator_id, action, duration, channel_id, reason FROM infractions '
+            'WHERE guild_id = ? AND user_id = ? AND created <= ? AND (created < ? OR id < ?) '
+            'ORDER BY created DESC, id DESC LIMIT ?',
+            (guild_id, user_id, created, created, row_id, limit)).fetchall()
+
+
+def describe(row: tuple) -> str:
+    """
+    :param row: row returned by InfractionLog.page
+    :return: line of the history command
+    """
+    row_id, created, moderator_id, action, duration, channel_id, reason = row
+    line = f'`#{row_id}` <t:{int(created)}:f> **{ACTION_NAMES.get(action, action)}** by <@{moderator_id}>'
+    if duration is not None:
+        line += f' for **{datetime.timedelta(seconds=round(duration))}**'
+    if channel_id is not None:
+        line += f' in <#{channel_id}>'
+    if reason:
+        # a page has to fit in a message
+        line += f': {reason if len(reason) <= REASON_LENGTH else reason[:REASON_LENGTH - 3] + "..."}'
+    return line
@@ -0,0 +1,234 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from collections.abc import Callable, Hashable
+
+import discord
+
+# what a full lane does with a new event
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+BLOCK = 'block'
+
+# handlers which always get their own task, whatever the load (commands don't go through dispatch at all)
+CRITICAL_EVENTS = frozenset({
+    'on_member_join', 'on_member_remove', 'on_raw_member_remove', 'on_member_ban', 'on_member_unban',
+    'on_audit_log_entry_create', 'on_automod_action', 'on_interaction', 'on_ready', 'on_resumed',
+    'on_guild_join', 'on_guild_remove', 'on_guild_available', 'on_guild_unavailable',
+})
+
+
+def update_key(event: str, args: tuple) -> Hashable:
+    """
+    :param event: handler name
+    :param args: (before, after) of an update event
+    :return: (handler, guild id, object id) of the updated object
+    """
+    after = args[-1]
+    guild = getattr(after, 'guild', None)
+    return event, guild.id if guild is not None else None, after.id
+
+
+class Lane:
+    """
+    bounded queue of handler calls of a class of events, run by a few worker tasks
+
+    a full lane sheds its oldest call (DROP_OLDEST), merges calls with the same key, shedding the oldest
+    for a new key (COALESCE), or pauses the gateway until there is space again (BLOCK)
+
+    with a window, calls are held that long after the first one of their key, so a flapping object is
+    handled once with its net change, filters drop (before, after) calls which net out to no change
+    """
+
+    def __init__(self, name: str, timeouts: dict[str, float], limit: int, policy: str, workers: int = 4,
+                 key: Callable[[str, tuple], Hashable] = update_key, window: float = 0.0):
+        """
+        :param name: name of the lane
+        :param timeouts: handler name -> seconds the handler may run before it is cancelled
+        :param limit: number of queued calls
+        :param policy: DROP_OLDEST, COALESCE or BLOCK
+        :param workers: number of calls run at once
+        :param key: function of (handler name, arguments) returning the key calls are coalesced by, for (before,
+        after) events: the first before and the last after are kept
+        :param window: seconds calls are held before they run
+        """
+        if policy not in (DROP_OLDEST, COALESCE, BLOCK):
+            raise ValueError(f'Unknown overflow policy: {policy}')
+        self.name = name
+        self.timeouts = timeouts
+        self.limit = limit
+        self.policy = policy
+        self.workers = workers
+        self.key = key
+        self.window = window
+        # handler name -> function of (before, after) telling whether anything the handler uses changed
+        self.filters: dict[str, Callable[[object, object], bool]] = {}
+        # deque of (handler, event, args, kwargs, monotonic time it is due), or key -> the same when coalescing
+        self.queue: deque | OrderedDict = OrderedDict() if policy == COALESCE else deque()
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.shed = 0
+        self.coalesced = 0
+        self.unchanged = 0
+        self.timed_out = 0
+        self.tasks: list[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue)
+
+    def stats(self) -> dict[str, int]:
+        return {'depth': self.depth, 'shed': self.shed, 'coalesced': self.coalesced, 'unchanged': self.unchanged,
+                'timed_out': self.timed_out}
+
+    def put(self, handler, event: str, args: tuple, kwargs: dict) -> None:
+        if self.policy == COALESCE:
+            key = self.key(event, args)
+            queued = self.queue.get(key)
+            if queued is not None:
+                self.coalesced += 1
+                self.queue[key] = (handler, event, (queued[2][0], *args[1:]) if len(args) > 1 else args, kwargs,
+                                   queued[4])
+                return
+            if len(self.queue) >= self.limit:
+                self.queue.popitem(last=False)
+                self.shed += 1
+            self.queue[key] = (handler, event, args, kwargs, time.monotonic() + self.window)
+        else:
+            if self.policy == DROP_OLDEST and len(self.queue) >= self.limit:
+                self.queue.popleft()
+                self.shed += 1
+            # blocking lanes stop the gateway instead, calls dispatched by one message go over the limit
+            self.queue.append((handler, event, args, kwargs, time.monotonic() + self.window))
+            if len(self.queue) >= self.limit:
+                self.space.clear()
+        self.ready.set()
+
+    def head(self) -> tuple:
+        return next(iter(self.queue.values())) if self.policy == COALESCE else self.queue[0]
+
+    def get(self) -> tuple:
+        item = self.queue.popitem(last=False)[1] if self.policy == COALESCE else self.queue.popleft()
+        if len(self.queue) < self.limit:
+            self.space.set()
+        return item
+
+
+class Ingest:
+    """
+    bounded stage between gateway dispatch and event handlers
+
+    handlers of events assigned to a lane are queued there instead of getting a task each, so an event storm
+    costs at most the lane limits in memory, every other handler (CRITICAL_EVENTS among them) is scheduled as
+    usual and is never shed
+
+    the gate is checked first for every event, calls it rejects (logs of a category the guild doesn't log) are
+    neither scheduled nor queued
+    """
+
+    def __init__(self, lanes: list[Lane], max_block: float = 10.0, gate: Callable[[str, tuple], bool] | None = None):
+        """
+        :param lanes: lanes, an event belongs to one lane at most
+        :param max_block: seconds the gateway is paused at most by full blocking lanes, Discord closes the
+        connection when heartbeats aren't acknowledged for too long
+        :param gate: function of (handler name, arguments) telling whether the handler has anything to do
+        """
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.routes: dict[str, Lane] = {}
+        for lane in lanes:
+            for event in lane.timeouts:
+                if event in CRITICAL_EVENTS:
+                    raise ValueError(f'{event} is critical and can\'t be queued')
+                if event in self.routes:
+                    raise ValueError(f'{event} belongs to lanes {self.routes[event].name} and {lane.name}')
+                self.routes[event] = lane
+        self.blocking = [lane for lane in lanes if lane.policy == BLOCK]
+        self.max_block = max_block
+        self.blocked = 0.0
+        self.gate = gate
+        self.gated = 0
+        self.bot: discord.Client | None = None
+
+    @property
+    def depth(self) -> int:
+        return sum(lane.depth for lane in self.lanes.values())
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+    def attach(self, bot: discord.Client) -> None:
+        """
+        route dispatched events of the bot through the lanes, and pause its gateway while blocking lanes are full
+        :param bot: bot
+        :return:
+        """
+        self.bot = bot
+        schedule = bot._schedule_event
+        update_references = bot._connection._update_references
+
+        def schedule_event(handler, event: str, *args, **kwargs):
+            if self.gate is not None and not self.gate(event, args):
+                self.gated += 1
+                return
+            lane = self.routes.get(event)
+            if lane is None:
+                return schedule(handler, event, *args, **kwargs)
+            lane.put(handler, event, args, kwargs)
+
+        def references(ws) -> None:
+            # called with every new gateway connection, before it is polled
+            update_references(ws)
+            if self.blocking:
+                poll_event = ws.poll_event
+
+                async def poll():
+                    await self.wait_for_space()
+                    return await poll_event()
+                ws.poll_event = poll
+
+        bot._schedule_event = schedule_event
+        bot._connection._update_references = references
+
+    async def wait_for_space(self) -> None:
+        for lane in self.blocking:
+            if not lane.space.is_set():
+                start = time.monotonic()
+                try:
+                    await asyncio.wait_for(lane.space.wait(), self.max_block)
+                except asyncio.TimeoutError:
+                    pass
+                self.blocked += time.monotonic() - start
+
+    def start(self) -> None:
+        for lane in self.lanes.values():
+            lane.tasks = [task for task in lane.tasks if not task.done()]
+            while len(lane.tasks) < lane.workers:
+                lane.tasks.append(asyncio.create_task(self.work(lane)))
+
+    async def work(self, lane: Lane) -> None:
+        while True:
+            while not lane.queue:
+                lane.ready.clear()
+                await lane.ready.wait()
+            if lane.window:
+                # calls are queued in the order they are due
+                delay = lane.head()[4] - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+            handler, event, args, kwargs, _ = lane.get()
+            changed = lane.filters.get(event)
+            if changed is not None and len(args) == 2 and not changed(*args):
+                lane.unchanged += 1
+                continue
+            try:
+                await asyncio.wait_for(handler(*args, **kwargs), lane.timeouts[event])
+            except asyncio.TimeoutError:
+                lane.timed_out += 1
+                print(f'{event} timed out after {lane.timeouts[event]}s')
+            except Exception:
+                try:
+                    await self.bot.on_error(event, *args, **kwargs)
+                except Exception as e:
+                    print(f'on_error raised an exception: {e!r}')
@@ -0,0 +1,165 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Iterable
+
+import discord
+
+from rest_scheduler import LOG, rest_priority
+
+MESSAGE_LIMIT = 2000
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBED_TOTAL_LIMIT = 6000
+EMBEDS_PER_MESSAGE = 10
+
+
+def split_line(line: str, limit: int) -> list[str]:
+    """
+    split a single log line into chunks not longer than limit, preferring line breaks
+    :param line: log line
+    :param limit: maximum chunk length
+    :return: list of chunks
+    """
+    chunks = []
+    while len(line) > limit:
+        cut = line.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(line[:cut])
+        line = line[cut:].lstrip('\n')
+    if len(line) > 0:
+        chunks.append(line)
+    return chunks
+
+
+def pack_content(lines: Iterable[str], limit: int = MESSAGE_LIMIT) -> list[str]:
+    """
+    pack log lines into as few message contents as possible
+    :param lines: rendered log lines
+    :param limit: maximum message length
+    :return: list of message contents
+    """
+    messages = []
+    current = []
+    size = 0
+    for line in lines:
+        for chunk in split_line(line.rstrip('\n'), limit):
+            extra = len(chunk) + (1 if current else 0)
+            if size + extra > limit:
+                messages.append('\n'.join(current))
+                current = []
+                size = 0
+                extra = len(chunk)
+            current.append(chunk)
+            size += extra
+    if current:
+        messages.append('\n'.join(current))
+    return messages
+
+
+def pack_embeds(lines: Iterable[str]) -> list[list[discord.Embed]]:
+    """
+    pack log lines into embeds, grouped into messages within Discord's embed limits
+    :param lines: rendered log lines
+    :return: list of messages, each one is a list of embeds
+    """
+    messages = []
+    current = []
+    size = 0
+    for description in pack_content(lines, EMBED_DESCRIPTION_LIMIT):
+        if len(current) == EMBEDS_PER_MESSAGE or size + len(description) > EMBED_TOTAL_LIMIT:
+            messages.append(current)
+            current = []
+            size = 0
+        current.append(discord.Embed(description=description))
+        size += len(description)
+    if current:
+        messages.append(current)
+    return messages
+
+
+class LogOutbox:
+    """
+    per-guild queue of rendered log lines, flushed by a background task in as few messages as possible
+    """
+
+    def __init__(self, resolve: Callable[[int], Awaitable[discord.abc.Messageable | discord.Webhook | None]],
+                 interval: float = 1.0, embeds: bool = False, invalidate: Callable[[int], None] | None = None):
+        """
+        :param resolve: coroutine function returning log channel or webhook of the guild (or None if there is none)
+        :param interval: seconds between flushes
+        :param embeds: send logs as embeds instead of plain messages
+        :param invalidate: function called when the resolved target of the guild is gone, it is resolved once more
+        """
+        self.resolve = resolve
+        self.interval = interval
+        self.embeds = embeds
+        self.invalidate = invalidate
+        self.shed = 0
+        self.queues: dict[int, list[str]] = {}
+        self.task: asyncio.Task | None = None
+
+    def put(self, guild_id: int, content: str) -> None:
+        """
+        queue log line, it will be sent on the next flush
+        :param guild_id: id of the guild the log belongs to
+        :param content: rendered log line
+        :return:
+        """
+        queue = self.queues.get(guild_id)
+        if queue is None:
+            self.queues[guild_id] = [content]
+        else:
+            queue.append(content)
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        rest_priority.set(LOG)
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        send everything queued so far, guilds are flushed concurrently
+        :return:
+        """
+        if not self.queues:
+            return
+        queues, self.queues = self.queues, {}
+        # one guild failing must not stop the task shared by every guild
+        results = await asyncio.gather(*(self.flush_guild(guild_id, lines) for guild_id, lines in queues.items()),
+                                       return_exceptions=True)
+        for guild_id, result in zip(queues, results):
+            if isinstance(result, Exception):
+                print(f'Failed to send logs of guild {guild_id}: {result!r}')
+
+    async def flush_guild(self, guild_id: int, lines: list[str]) -> None:
+        if self.embeds:
+            messages = [dict(embeds=embeds) for embeds in pack_embeds(lines)]
+        else:
+            messages = [dict(content=content) for content in pack_content(lines)]
+        retry = self.invalidate is not None
+        while messages:
+            target = await self.resolve(guild_id)
+            if target is None:
+                return
+            try:
+                while messages:
+                    await target.send(**messages[0])
+                    messages.pop(0)
+            except (discord.NotFound, discord.Forbidden) as e:
+                # deleted webhook or channel, or missing permissions, resolve the target again once
+                if not retry:
+                    print(f'Failed to send logs of guild {guild_id}: {e}')
+                    return
+                retry = False
+                self.invalidate(guild_id)
+            except discord.HTTPException as e:
+                print(f'Failed to send logs of guild {guild_id}: {e}')
+                return
+            except discord.RateLimited:
+                # shed by the REST scheduler to make room for more important requests
+                self.shed += len(messages)
+                return
@@ -0,0 +1,252 @@
+from collections.abc import Callable
+from operator import attrgetter
+
+import discord
+from discord.ext import commands
+
+from config_store import ConfigTable
+from log_outbox import LogOutbox
+
+WEBHOOK_NAME = 'DLBot logs'
+# channel types logs can be sent to through a webhook
+WEBHOOK_CHANNELS = (discord.TextChannel, discord.VoiceChannel, discord.StageChannel)
+
+# categories of logs a guild can subscribe to, stored as a bitmask
+LOG_COMMANDS = 1 << 0
+LOG_AUTOMOD = 1 << 1
+LOG_CHANNELS = 1 << 2
+LOG_GUILD = 1 << 3
+LOG_MEMBERS = 1 << 4
+LOG_BANS = 1 << 5
+LOG_MESSAGES = 1 << 6
+LOG_ROLES = 1 << 7
+LOG_THREADS = 1 << 8
+LOG_VOICE = 1 << 9
+LOG_TYPING = 1 << 10
+LOG_CATEGORIES = {
+    'commands': LOG_COMMANDS,
+    'automod': LOG_AUTOMOD,
+    'channels': LOG_CHANNELS,
+    'guild': LOG_GUILD,
+    'members': LOG_MEMBERS,
+    'bans': LOG_BANS,
+    'messages': LOG_MESSAGES,
+    'roles': LOG_ROLES,
+    'threads': LOG_THREADS,
+    'voice': LOG_VOICE,
+    'typing': LOG_TYPING,
+}
+LOG_ALL = sum(LOG_CATEGORIES.values())
+DEFAULT_CATEGORIES = LOG_ALL & ~LOG_TYPING
+
+
+def guild_id_of(obj) -> int | None:
+    guild = obj.guild
+    return None if guild is None else guild.id
+
+
+def first(get: Callable) -> Callable[[tuple], int | None]:
+    return lambda args: get(args[0])
+
+
+def last(get: Callable) -> Callable[[tuple], int | None]:
+    # (before, after) events, the guild id is read from after
+    return lambda args: get(args[-1])
+
+
+# handler name -> (LOG_* category, function of the event arguments returning the guild id), the handlers of
+# these events only log, so they aren't even scheduled when the category is disabled (see LogResolver.admits),
+# handlers which do more than logging check their category themselves
+EVENT_CATEGORIES: dict[str, tuple[int, Callable[[tuple], int | None]]] = {
+    'on_raw_app_command_permissions_update': (LOG_COMMANDS, first(attrgetter('guild.id'))),
+    'on_app_command_completion': (LOG_COMMANDS, first(attrgetter('guild_id'))),
+    'on_automod_rule_create': (LOG_AUTOMOD, first(attrgetter('guild.id'))),
+    'on_automod_rule_delete': (LOG_AUTOMOD, first(attrgetter('guild.id'))),
+    'on_automod_rule_update': (LOG_AUTOMOD, first(attrgetter('guild.id'))),
+    'on_automod_rule_action': (LOG_AUTOMOD, first(attrgetter('guild.id'))),
+    'on_guild_channel_create': (LOG_CHANNELS, first(attrgetter('guild.id'))),
+    'on_guild_channel_update': (LOG_CHANNELS, last(attrgetter('guild.id'))),
+    'on_guild_channel_pins_update': (LOG_CHANNELS, first(attrgetter('guild.id'))),
+    'on_typing': (LOG_TYPING, first(guild_id_of)),
+    'on_guild_available': (LOG_GUILD, first(attrgetter('id'))),
+    'on_guild_unavailable': (LOG_GUILD, first(attrgetter('id'))),
+    'on_guild_update': (LOG_GUILD, last(attrgetter('id'))),
+    'on_member_remove': (LOG_MEMBERS, first(attrgetter('guild.id'))),
+    'on_member_update': (LOG_MEMBERS, last(attrgetter('guild.id'))),
+    'on_member_ban': (LOG_BANS, first(attrgetter('id'))),
+    'on_member_unban': (LOG_BANS, first(attrgetter('id'))),
+    'on_message': (LOG_MESSAGES, first(guild_id_of)),
+    'on_raw_message_edit': (LOG_MESSAGES, first(attrgetter('guild_id'))),
+    'on_raw_message_delete': (LOG_MESSAGES, first(attrgetter('guild_id'))),
+    'on_raw_bulk_message_delete': (LOG_MESSAGES, first(attrgetter('guild_id'))),
+    'on_guild_role_create': (LOG_ROLES, first(attrgetter('guild.id'))),
+    'on_guild_role_delete': (LOG_ROLES, first(attrgetter('guild.id'))),
+    'on_guild_role_update': (LOG_ROLES, last(attrgetter('guild.id'))),
+    'on_thread_create': (LOG_THREADS, first(attrgetter('guild.id'))),
+    'on_thread_join': (LOG_THREADS, first(attrgetter('guild.id'))),
+    'on_thread_update': (LOG_THREADS, last(attrgetter('guild.id'))),
+    'on_thread_remove': (LOG_THREADS, first(attrgetter('guild.id'))),
+    'on_thread_delete': (LOG_THREADS, first(attrgetter('guild.id'))),
+}
+
+
+class NullLog:
+    """
+    sink of guilds without logs, it is falsy so handlers can return before rendering anything
+    """
+    __slots__ = ()
+    channel_id = None
+    mask = 0
+
+    def __bool__(self) -> bool:
+        return False
+
+    def put(self, content: str) -> None:
+        pass
+
+
+NULL_LOG = NullLog()
+
+
+class GuildLog:
+    """
+    sink of a guild with logs, lines are queued in the outbox
+    """
+    __slots__ = ('guild_id', 'channel_id', 'mask', 'outbox')
+
+    def __init__(self, guild_id: int, channel_id: int, mask: int, outbox: LogOutbox):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.mask = mask
+        self.outbox = outbox
+
+    def put(self, content: str) -> None:
+        self.outbox.put(self.guild_id, content)
+
+
+class LogResolver:
+    """
+    resolves where logs of a guild go and caches it
+
+    logs are delivered through a webhook of the log channel (created once), so they use the webhook's
+    rate limit buckets instead of competing with the bot's own messages, without the permission to manage
+    webhooks the channel itself is used
+    """
+
+    def __init__(self, bot: commands.Bot, log_channels: ConfigTable, log_categories: ConfigTable,
+                 interval: float = 1.0):
+        """
+        :param bot: bot
+        :param log_channels: guild id -> log channel id
+        :param log_categories: guild id -> bitmask of subscribed categories, DEFAULT_CATEGORIES if missing
+        :param interval: seconds between flushes of the outbox
+        """
+        self.bot = bot
+        self.log_channels = log_channels
+        self.log_categories = log_categories
+        self.outbox = LogOutbox(self.resolve, interval, invalidate=self.invalidate)
+        # guilds without logs are cached as NULL_LOG, so every lookup after the first one is a single dict access
+        self.sinks: dict[int, GuildLog | NullLog] = {}
+        self.targets: dict[int, discord.abc.Messageable | discord.Webhook] = {}
+
+    def sink(self, guild_id: int, category: int = LOG_ALL) -> GuildLog | NullLog:
+        """
+        called first by every logging handler, so unsubscribed events cost a dict lookup and an AND
+        :param guild_id: id of the guild
+        :param category: LOG_* category of the event
+        :return: sink for logs of the guild, NULL_LOG if logs or the category are disabled
+        """
+        sink = self.sinks.get(guild_id)
+        if sink is None:
+            sink = self.load(guild_id)
+        return sink if sink.mask & category else NULL_LOG
+
+    def admits(self, event: str, args: tuple) -> bool:
+        """
+        dispatch check: whether the handlers of the event have anything to log
+        :param event: handler name
+        :param args: arguments of the event
+        :return: False if the event only logs a category the guild doesn't log
+        """
+        route = EVENT_CATEGORIES.get(event)
+        if route is None:
+            return True
+        category, guild_id = route
+        guild_id = guild_id(args)
+        return guild_id is not None and self.sink(guild_id, category) is not NULL_LOG
+
+    def load(self, guild_id: int) -> GuildLog | NullLog:
+        channel_id = self.log_channels.get(guild_id, None)
+        if channel_id is None:
+            sink = NULL_LOG
+        elif self.bot.get_channel(channel_id) is None:
+            if self.bot.get_guild(guild_id) is None:
+                # the guild isn't cached yet (or is unavailable), look again later
+                return NULL_LOG
+            # the log channel is gone, nothing would be sent
+            sink = NULL_LOG
+        else:
+            sink = GuildLog(guild_id, channel_id, self.log_categories.get(guild_id, DEFAULT_CATEGORIES), self.outbox)
+        self.sinks[guild_id] = sink
+        return sink
+
+    async def subscribe(self, guild_id: int, category: int, enabled: bool) -> int:
+        """
+        enable or disable category of logs of the guild
+        :param guild_id: id of the guild
+        :param category: LOG_* category
+        :param enabled: whether the category is logged
+        :return: new bitmask of the guild
+        """
+        mask = self.log_categories.get(guild_id, DEFAULT_CATEGORIES)
+        mask = mask | category if enabled else mask & ~category
+        await self.log_categories.set(guild_id, mask)
+        self.sinks.pop(guild_id, None)
+        return mask
+
+    def is_log_channel(self, channel: discord.abc.GuildChannel) -> bool:
+        return self.log_channels.get(channel.guild.id, None) == channel.id
+
+    async def remove(self, guild_id: int) -> None:
+        """
+        stop logs of the guild, once its log channel is deleted
+        :param guild_id: id of the guild
+        :return:
+        """
+        await self.log_channels.delete(guild_id)
+        self.invalidate(guild_id)
+
+    def invalidate(self, guild_id: int) -> None:
+        """
+        forget cached sink and resolved target of the guild, they are resolved again when needed
+        :param guild_id: id of the guild
+        :return:
+        """
+        self.sinks.pop(guild_id, None)
+        self.targets.pop(guild_id, None)
+
+    async def resolve(self, guild_id: int) -> discord.abc.Messageable | discord.Webhook | None:
+        target = self.targets.get(guild_id)
+        if target is not None:
+            return target
+        channel = self.bot.get_channel(self.log_channels.get(guild_id, None))
+        if channel is None:
+            return None
+        target = channel
+        # threads have no webhooks of their own, logs go to them directly
+        if isinstance(channel, WEBHOOK_CHANNELS) and channel.permissions_for(channel.guild.me).manage_webhooks:
+            try:
+                target = await self.webhook(channel)
+            except discord.HTTPException as e:
+                print(f'Failed to get logs webhook of guild {guild_id}: {e}')
+            except discord.RateLimited:
+                # shed by the REST scheduler, send to the channel this time and look for the webhook on the next flush
+                return channel
+        self.targets[guild_id] = target
+        return target
+
+    async def webhook(self, channel: discord.TextChannel) -> discord.Webhook:
+        for webhook in await channel.webhooks():
+            if webhook.user == self.bot.user and webhook.name == WEBHOOK_NAME and webhook.token is not None:
+                return webhook
+        return await channel.create_webhook(name=WEBHOOK_NAME)
@@ -1,23 +1,93 @@
+import asyncio
 import atexit
 import datetime
 import discord
 from discord.ext import commands
-import pickle
+import os
 import re
-
-try:
-    autoroles: dict[int, tuple[int, int]] = pickle.load(open('autoroles.pkl', 'rb'))
-    log_channels: dict[int, int] = pickle.load(open('log_channels.pkl', 'rb'))
-except FileNotFoundError:
-    autoroles = dict()
-    log_channels = dict()
-atexit.register(
-    lambda: [pickle.dump(autoroles, open('autoroles.pkl', 'wb')),
-             pickle.dump(log_channels, open('log_channels.pkl', 'wb'))])
-
-intents = discord.Intents.all()
-intents.message_content = True
-bot = commands.Bot(command_prefix='/', intents=intents)
+import time
+
+from audit_log import AuditLogCache
+from autorole import AutoroleWorker
+from bulk import BulkResult, parse_members, recent_members, run_bulk
+from cluster import cluster_from_env
+from command_sync import sync_tree
+from config_store import ConfigStore
+from diff import DiffSpec, collection, flags, overwrites, permissions, scalar
+from infractions import (ACTION_BAN, ACTION_KICK, ACTION_MUTE, ACTION_PURGE, ACTION_UNBAN, ACTION_UNMUTE, PAGE_SIZE,
+                         InfractionLog, describe)
+from ingest import BLOCK, COALESCE, DROP_OLDEST, Ingest, Lane
+from dm_outbox import DMOutbox
+from features import (cache_joined, chunked_guilds, ensure_chunked, env_features, env_flag, feature_intents,
+                      feature_member_cache_flags, remove_disabled_commands)
+from log_sink import LOG_CATEGORIES, LOG_CHANNELS, LOG_GUILD, LOG_MEMBERS, LOG_VOICE, LogResolver
+from message_store import MessageStore
+from metrics import METRICS_PORT, Metrics
+from purge import PurgeJob, message_filter
+from recorder import GatewayRecorder
+from rest_scheduler import RestScheduler
+from temp_voice import TempVoiceManager
+from timed_actions import MAX_TIMEOUT, MUTE, REARM_MARGIN, REMOVE_ROLE, UNBAN, TimedActions
+
+config = ConfigStore('config.db')
+autoroles = config.table('autoroles', 'role_member', 'role_bot')
+log_channels = config.table('log_channels', 'channel_id')
+command_hashes = config.table('command_hashes', 'hash', key='scope')
+autoroles.import_pickle('autoroles.pkl')
+log_channels.import_pickle('log_channels.pkl')
+atexit.register(config.close)
+
+features = env_features()
+intents = feature_intents(features)
+metrics = Metrics()
+rest_scheduler = RestScheduler()
+http_trace = metrics.trace_config()
+rest_scheduler.trace(http_trace)
+lean_member_cache = env_flag('DLBOT_LEAN_MEMBER_CACHE', False)
+bot_options = dict(
+    command_prefix='/', intents=intents, http_trace=http_trace,
+    member_cache_flags=feature_member_cache_flags(intents, lean_member_cache),
+    # the lean cache would drop the members chunked at startup, guilds are chunked by the commands needing them
+    chunk_guilds_at_startup=env_flag('DLBOT_CHUNK_AT_STARTUP', intents.members and not lean_member_cache),
+    max_messages=100)
+cluster, shard_ids, shard_count = cluster_from_env()
+if cluster is None:
+    bot = commands.Bot(**bot_options)
+else:
+    bot = commands.AutoShardedBot(shard_ids=shard_ids, shard_count=shard_count, **bot_options)
+log_resolver = LogResolver(bot, log_channels, config.table('log_categories', 'mask'))
+log_sink = log_resolver.sink
+# handlers of high-volume events run from bounded lanes, critical events (ingest.CRITICAL_EVENTS) are never queued
+# events which only log a category the guild doesn't log are dropped first (log_sink.EVENT_CATEGORIES)
+# updates of an object are held for DLBOT_UPDATE_WINDOW seconds and logged once with their net change
+update_lane = Lane('updates', dict.fromkeys(('on_guild_update', 'on_member_update', 'on_guild_role_update',
+                                             'on_guild_channel_update', 'on_thread_update'), 10.0),
+                   limit=10_000, policy=COALESCE, workers=8, window=float(os.environ.get('DLBOT_UPDATE_WINDOW', 2.0)))
+ingest = Ingest([
+    Lane('typing', {'on_typing': 5.0}, limit=1_000, policy=DROP_OLDEST, workers=2),
+    update_lane,
+    Lane('messages', {'on_message': 10.0, 'on_raw_message_edit': 10.0, 'on_raw_message_delete': 30.0,
+                      'on_raw_bulk_message_delete': 30.0}, limit=5_000, policy=BLOCK, workers=16),
+], gate=log_resolver.admits)
+ingest.attach(bot)
+audit_log = AuditLogCache(pushed=intents.moderation)
+dm_outbox = DMOutbox()
+timed_actions = TimedActions(config, bot.http, shard_ids=shard_ids, shard_count=shard_count)
+infractions = InfractionLog(config)
+# registered after config.close, so it runs before it
+atexit.register(infractions.close)
+message_store = MessageStore()
+temp_voice = TempVoiceManager(config.table('voice_lobbies', 'channel_id'),
+                              config.table('temp_voice_channels', 'guild_id', 'category_id', 'owner_id',
+                                           key='channel_id'))
+# gateway traffic is recorded for offline replay (python -m benchmarks.replay) when DLBOT_RECORD_DIR is set
+recorder = None
+if os.environ.get('DLBOT_RECORD_DIR'):
+    recorder = GatewayRecorder(os.path.join(os.environ['DLBOT_RECORD_DIR'],
+                                            'cluster0' if cluster is None else f'cluster{cluster.cluster}'))
+    atexit.register(recorder.close)
+# kicked/banned members can't receive DMs anymore, so the action waits for the DM at most that long
+DM_TIMEOUT = 2.0
 
 regex = re.compile(
     r'((?P<days>\d+?)d)?((?P<hours>\d+?)h)?((?P<minutes>\d+?)m)?((?P<seconds>\d+?)s)?')
@@ -26,6 +96,20 @@ regex = re.compile(
 # ----------------------------------------------------------------------------------------------------
 # Autorole
 
+def get_autorole(member: discord.Member) -> discord.Role | None:
+    """
+    :param member: member
+    :return: autorole the member should get, None if autorole isn't configured
+    """
+    roles = autoroles.get(member.guild.id, None)
+    if roles is None:
+        return None
+    return member.guild.get_role(roles[member.bot])
+
+
+autorole_worker = AutoroleWorker(get_autorole)
+
+
 @bot.tree.command(name='autorole', description='Setup autorole')
 async def autorole(interaction: discord.Interaction, role_member: discord.Role, role_bot: discord.Role):
     """
@@ -38,13 +122,75 @@ async def autorole(interaction: discord.Interaction, role_member: discord.Role,
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("You don't have permissions to do this", ephemeral=True)
         return
-    autoroles[interaction.id] = (role_member.id, role_bot.id)
+    await autoroles.set(interaction.guild.id, (role_member.id, role_bot.id))
     await interaction.response.send_message('Autorole is configured', ephemeral=True)
 
 
 # ----------------------------------------------------------------------------------------------------
 # Moderation
 
+def check_moderator(interaction: discord.Interaction, member: discord.Member | None, permission: str) -> str | None:
+    """
+    check whether interaction user is allowed to moderate member
+    :param interaction: interaction
+    :param member: member to moderate (None to check only the permission)
+    :param permission: name of the required guild permission
+    :return: error message, None if user is allowed
+    """
+    if not getattr(interaction.user.guild_permissions, permission):
+        return "You don't have permissions to do this"
+    elif member is not None and interaction.user.top_role <= member.top_role:
+        return f"Your top role is same/lower than **{member}**'s"
+    return None
+
+
+def parse_duration(duration: str) -> datetime.timedelta:
+    """
+    parse duration
+    :param duration: duration (example: 1h30m, 1d)
+    :return: duration
+    """
+    until = regex.match(duration)
+    until = until.groupdict(0)
+    until = {k: int(v) for k, v in until.items()}
+    return datetime.timedelta(**until)
+
+
+def format_reason(reason: str) -> str:
+    return f'. Reason: **{reason}**' if len(reason) > 0 else ''
+
+
+async def kick_member(interaction: discord.Interaction, member: discord.Member, reason: str):
+    await dm_outbox.send(member, f'You were kicked from **{interaction.guild}** by **{interaction.user}**'
+                                 f'{format_reason(reason)}', DM_TIMEOUT)
+    await member.kick(reason=reason or None)
+    infractions.add(interaction.guild.id, member.id, interaction.user.id, ACTION_KICK, reason)
+
+
+async def ban_member(interaction: discord.Interaction, member: discord.Member, reason: str,
+                     until: datetime.timedelta | None = None):
+    length = '' if until is None else f' for **{until}**'
+    await dm_outbox.send(member, f'You were banned from **{interaction.guild}**{length} by **{interaction.user}**'
+                                 f'{format_reason(reason)}', DM_TIMEOUT)
+    await member.ban(reason=reason or None)
+    infractions.add(interaction.guild.id, member.id, interaction.user.id, ACTION_BAN, reason, until)
+
+
+async def mute_member(interaction: discord.Interaction, member: discord.Member, until: datetime.timedelta,
+                      reason: str):
+    # timeouts can't be longer than 28 days, longer mutes are re-armed by timed actions
+    await member.timeout(min(until, MAX_TIMEOUT), reason=reason or None)
+    infractions.add(interaction.guild.id, member.id, interaction.user.id, ACTION_MUTE, reason, until)
+    if until > MAX_TIMEOUT:
+        now = time.time()
+        rearm = now + MAX_TIMEOUT.total_seconds() - REARM_MARGIN
+        await timed_actions.schedule(member.guild.id, member.id, MUTE, rearm, until=now + until.total_seconds())
+    else:
+        await timed_actions.cancel(member.guild.id, member.id, MUTE)
+    dm_outbox.put(member, f'You were muted at **{interaction.guild}** for **{until}** by **{interaction.user}**'
+                          f'{format_reason(reason)}')
+
+
 @bot.tree.command(name='kick', description='Kick member')
 async def kick(interaction: discord.Interaction, member: discord.Member, reason: str = ''):
     """
@@ -54,16 +200,11 @@ async def kick(interaction: discord.Interaction, member: discord.Member, reason:
     :param reason: reason for kick
     :return:
     """
-    if not interaction.user.guild_permissions.kick_members:
-        await interaction.response.send_message("You don't have permissions to do this", ephemeral=True)
-        return
-    elif interaction.user.top_role <= member.top_role:
-        await interaction.response.send_message(f"Your top role is same/lower than **{member}**'s", ephemeral=True)
+    error = check_moderator(interaction, member, 'kick_members')
+    if error is not None:
+        await interaction.response.send_message(error, ephemeral=True)
         return
-    if len(reason) > 0:
-        reason = f'. Reason: **{reason}**'
-    await member.send(f'You were kicked from **{interaction.guild}** by **{interaction.user}**{reason}')
-    await member.kick(reason=reason)
+    await kick_member(interaction, member, reason)
     await interaction.response.send_message(f'**{member}** was kicked', ephemeral=True)
 
 
@@ -76,19 +217,35 @@ async def ban(interaction: discord.Interaction, member: discord.Member, reason:
     :param reason: reason for ban
     :return:
     """
-    if not interaction.user.guild_permissions.ban_members:
-        await interaction.response.send_message("You don't have permissions to do this", ephemeral=True)
-        return
-    elif interaction.user.top_role <= member.top_role:
-        await interaction.response.send_message(f"Your top role is same/lower than **{member}**'s", ephemeral=True)
+    error = check_moderator(interaction, member, 'ban_members')
+    if error is not None:
+        await interaction.response.send_message(error, ephemeral=True)
         return
-    if len(reason) > 0:
-        reason = f'. Reason: **{reason}**'
-    await member.send(f'You were banned from **{interaction.guild}** by **{interaction.user}**{reason}')
-    await member.ban(reason=reason)
+    await ban_member(interaction, member, reason)
+    await timed_actions.cancel(interaction.guild.id, member.id, UNBAN)
     await interaction.response.send_message(f'**{member}** was banned', ephemeral=True)
 
 
+@bot.tree.command(name='tempban', description='Ban member for some time')
+async def tempban(interaction: discord.Interaction, member: discord.Member, duration: str, reason: str = ''):
+    """
+    ban member, they are unbanned once the duration is over
+    :param interaction: interaction
+    :param member: member to ban
+    :param duration: amount of time member should be banned for (example: 1h30m, 1d)
+    :param reason: reason for ban
+    :return:
+    """
+    error = check_moderator(interaction, member, 'ban_members')
+    if error is not None:
+        await interaction.response.send_message(error, ephemeral=True)
+        return
+    until = parse_duration(duration)
+    await ban_member(interaction, member, reason, until)
+    await timed_actions.schedule(interaction.guild.id, member.id, UNBAN, time.time() + until.total_seconds())
+    await interaction.response.send_message(f'**{member}** was banned for **{until}**', ephemeral=True)
+
+
 @bot.tree.command(name='unban', description='Unban user')
 async def unban(interaction: discord.Interaction, user: discord.User, reason: str = ''):
     """
@@ -98,14 +255,16 @@ async def unban(interaction: discord.Interaction, user: discord.User, reason: st
     :param reason: reason for unban
     :return:
     """
-    if not interaction.user.guild_permissions.kick_members:
-        await interaction.response.send_message("You don't have permissions to do this", ephemeral=True)
+    error = check_moderator(interaction, None, 'kick_members')
+    if error is not None:
+        await interaction.response.send_message(error, ephemeral=True)
         return
     try:
-        if len(reason) > 0:
-            reason = f'. Reason: **{reason}**'
-        await interaction.guild.unban(user)
-        await user.send(f'You were unbanned at **{interaction.guild}** by **{interaction.user}**{reason}')
+        await interaction.guild.unban(user, reason=reason or None)
+        await timed_actions.cancel(interaction.guild.id, user.id, UNBAN)
+        infractions.add(interaction.guild.id, user.id, interaction.user.id, ACTION_UNBAN, reason)
+        dm_outbox.put(user, f'You were unbanned at **{interaction.guild}** by **{interaction.user}**'
+                            f'{format_reason(reason)}')
         await interaction.response.send_message(f'**{user}** was unbanned', ephemeral=True)
     except discord.errors.NotFound:
         await interaction.response.send_message(f'**{user}** is not banned', ephemeral=True)
@@ -121,20 +280,11 @@ async def mute(interaction: discord.Interaction, member: discord.Member, duratio
     :param reason: reason for mute (timeout)
     :return:
     """
-    if not interaction.user.guild_permissions.moderate_members:
-        await interaction.response.send_message("You don't have permissions to do this", ephemeral=True)
-        return
-    elif interaction.user.top_role <= member.top_role:
-        await interaction.response.send_message(f"Your top role is same/lower than **{member}**'s", ephemeral=True)
+    error = check_moderator(interaction, member, 'moderate_members')
+    if error is not None:
+        await interaction.response.send_message(error, ephemeral=True)
         return
-    if len(reason) > 0:
-        reason = f'. Reason: **{reason}**'
-    until = regex.match(duration)
-    until = until.groupdict(0)
-    until = {k: int(v) for k, v in until.items()}
-    until = min(datetime.timedelta(**until), datetime.timedelta(days=28))
-    await member.timeout(until, reason=reason)
-    await member.send(f'You were muted at **{interaction.guild}** for **{until}** by **{interaction.user}**{reason}')
+    await mute_member(interaction, member, parse_duration(duration), reason)
     await interaction.response.send_message(f'**{member}** was muted', ephemeral=True)
 
 
@@ -147,35 +297,269 @@ async def unmute(interaction: discord.Interaction, member: discord.Member, reaso
     :param reason: reason for unmute
     :return:
     """
-    if not interaction.user.guild_permissions.kick_members:
-        await interaction.response.send_message("You don't have permissions to do this", ephemeral=True)
+    error = check_moderator(interaction, member, 'kick_members')
+    if error is not None:
+        await interaction.response.send_message(error, ephemeral=True)
         return
-    elif interaction.user.top_role <= member.top_role:
-        await interaction.response.send_message(f"Your top role is same/lower than **{member}**'s", ephemeral=True)
-        return
-    if len(reason) > 0:
-        reason = f'. Reason: **{reason}**'
-    await member.timeout(None)
-    await member.send(f'You were unmuted at **{interaction.guild}** by **{interaction.user}**{reason}')
+    await member.timeout(None, reason=reason or None)
+    await timed_actions.cancel(interaction.guild.id, member.id, MUTE)
+    infractions.add(interaction.guild.id, member.id, interaction.user.id, ACTION_UNMUTE, reason)
+    dm_outbox.put(member, f'You were unmuted at **{interaction.guild}** by **{interaction.user}**'
+                          f'{format_reason(reason)}')
     await interaction.response.send_message(f'**{member}** was unmuted', ephemeral=True)
 
 
+@bot.tree.command(name='temprole', description='Give member a role for some time')
+async def temprole(interaction: discord.Interaction, member: discord.Member, role: discord.Role, duration: str,
+                   reason: str = ''):
+    """
+    give member a role, it is removed once the duration is over
+    :param interaction: interaction
+    :param member: member to give the role to
+    :param role: role
+    :param duration: amount of time member should have the role for (example: 1h30m, 1d)
+    :param reason: reason
+    :return:
+    """
+    error = check_moderator(interaction, member, 'manage_roles')
+    if error is None and (role >= interaction.user.top_role or role >= interaction.guild.me.top_role):
+        error = f'**{role}** is same/higher than your or my top role'
+    if error is not None:
+        await interaction.response.send_message(error, ephemeral=True)
+        return
+    until = parse_duration(duration)
+    await member.add_roles(role, reason=reason or None)
+    await timed_actions.schedule(interaction.guild.id, member.id, REMOVE_ROLE, time.time() + until.total_seconds(),
+                                 role_id=role.id)
+    await interaction.response.send_message(f'**{member}** has **{role}** for **{until}**', ephemeral=True)
+
+
+bulk_group = discord.app_commands.Group(name='bulk', description='Moderate many members at once')
+bot.tree.add_command(bulk_group)
+
+
+async def run_bulk_moderation(interaction: discord.Interaction, permission: str, action: str, members: str,
+                              role: discord.Role | None, joined_within: int | None, function):
+    """
+    shared pipeline of the bulk commands: collect targets, check them, run function for every one of them
+    :param interaction: interaction
+    :param permission: name of the required guild permission
+    :param action: past tense of the action for the summary (example: Kicked)
+    :param members: mentions and/or ids of members
+    :param role: every member with this role is a target
+    :param joined_within: every member who joined in the last joined_within minutes is a target
+    :param function: coroutine function called with every allowed target
+    :return:
+    """
+    error = check_moderator(interaction, None, permission)
+    if error is None and not intents.members:
+        # the command was registered by a process with the moderation feature enabled
+        error = 'Bulk moderation needs the moderation feature, which is disabled'
+    if error is not None:
+        await interaction.response.send_message(error, ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    await ensure_chunked(interaction.guild)
+
+    targets = {member.id: member for member in parse_members(interaction.guild, members)}
+    if role is not None:
+        targets.update((member.id, member) for member in role.members)
+    if joined_within is not None:
+        targets.update((member.id, member) for member in recent_members(interaction.guild, joined_within))
+    targets.pop(interaction.user.id, None)
+    targets.pop(interaction.guild.me.id, None)
+    allowed = [member for member in targets.values() if check_moderator(interaction, member, permission) is None]
+    if len(allowed) == 0:
+        await interaction.followup.send('There is no member you can do this to', ephemeral=True)
+        return
+
+    message = await interaction.followup.send(f'{action} 0/{len(allowed)} member(s)...', ephemeral=True, wait=True)
+
+    async def progress(result: BulkResult):
+        await message.edit(content=f'{action} {result.done}/{result.total} member(s)...')
+
+    result = await run_bulk(allowed, function, progress=progress)
+    skipped = len(targets) - len(allowed)
+    await message.edit(content=result.summary(action) + (f', {skipped} skipped (same/higher top role)'
+                                                         if skipped > 0 else ''))
+
+
+@bulk_group.command(name='kick', description='Kick many members')
+async def bulk_kick(interaction: discord.Interaction, members: str = '', role: discord.Role = None,
+                    joined_within: int = None, reason: str = ''):
+    """
+    kick many members
+    :param interaction: interaction
+    :param members: mentions or ids of members to kick
+    :param role: kick every member with this role
+    :param joined_within: kick every member who joined in the last joined_within minutes
+    :param reason: reason for kick
+    :return:
+    """
+    await run_bulk_moderation(interaction, 'kick_members', 'Kicked', members, role, joined_within,
+                              lambda member: kick_member(interaction, member, reason))
+
+
+@bulk_group.command(name='ban', description='Ban many members')
+async def bulk_ban(interaction: discord.Interaction, members: str = '', role: discord.Role = None,
+                   joined_within: int = None, reason: str = ''):
+    """
+    ban many members
+    :param interaction: interaction
+    :param members: mentions or ids of members to ban
+    :param role: ban every member with this role
+    :param joined_within: ban every member who joined in the last joined_within minutes
+    :param reason: reason for ban
+    :return:
+    """
+    await run_bulk_moderation(interaction, 'ban_members', 'Banned', members, role, joined_within,
+                              lambda member: ban_member(interaction, member, reason))
+
+
+@bulk_group.command(name='mute', description='Mute (timeout) many members')
+async def bulk_mute(interaction: discord.Interaction, duration: str, members: str = '', role: discord.Role = None,
+                    joined_within: int = None, reason: str = ''):
+    """
+    mute (timeout) many members
+    :param interaction: interaction
+    :param duration: amount of time members should be muted (timed out) for (example: 1h30m, 1d)
+    :param members: mentions or ids of members to mute
+    :param role: mute every member with this role
+    :param joined_within: mute every member who joined in the last joined_within minutes
+    :param reason: reason for mute (timeout)
+    :return:
+    """
+    until = parse_duration(duration)
+    await run_bulk_moderation(interaction, 'moderate_members', 'Muted', members, role, joined_within,
+                              lambda member: mute_member(interaction, member, until, reason))
+
+
+purge_jobs: dict[int, asyncio.Task] = {}
+
+
+async def run_purge(job: PurgeJob, message: discord.WebhookMessage, reason: str):
+    """
+    run purge job, reporting its progress by editing message
+    :param job: purge job
+    :param message: follow-up message of the purge command
+    :param reason: formatted reason for purge
+    :return:
+    """
+    async def edit(content: str):
+        # follow-up messages can't be edited after the interaction token expires (15 minutes)
+        try:
+            await message.edit(content=content)
+        except discord.HTTPException:
+            pass
+
+    async def progress(job: PurgeJob):
+        await edit(f'Deleting messages... {job.summary()}')
+
+    try:
+        await job.run(progress)
+        await edit(f'{job.summary()}{reason}')
+    except asyncio.CancelledError:
+        await edit(f'Cancelled. {job.summary()}{reason}')
+        raise
+
+
 @bot.tree.command(name='purge', description='Purge messages')
-async def purge(interaction: discord.Interaction, limit: int, reason: str = ''):
+async def purge(interaction: discord.Interaction, limit: int, member: discord.Member = None, contains: str = '',
+                bots: bool = False, reason: str = ''):
     """
     purge messages
     :param interaction:
-    :param limit: limit of messages to purge
+    :param limit: limit of messages to look through
+    :param member: delete only messages of this member
+    :param contains: delete only messages containing this text
+    :param bots: delete only messages of bots
     :param reason: reason for purge
     :return:
     """
-    if not interaction.user.guild_permissions.manage_messages:
-        await interaction.response.send_message("You don't have permissions to do this", ephemeral=True)
+    error = check_moderator(interaction, None, 'manage_messages')
+    if error is None and contains and not intents.message_content:
+        error = 'Filtering by content needs the moderation feature, which is disabled'
+    if error is not None:
+        await interaction.response.send_message(error, ephemeral=True)
+        return
+    channel = interaction.channel
+    if channel.id in purge_jobs:
+        await interaction.response.send_message('This channel is already being purged, use /purge_cancel to stop it',
+                                                ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    job = PurgeJob(channel, limit, message_filter(member, contains, bots), reason or None)
+    infractions.add(interaction.guild.id, 0 if member is None else member.id, interaction.user.id, ACTION_PURGE,
+                    reason, channel_id=channel.id)
+    reason = format_reason(reason)
+    message = await interaction.followup.send('Deleting messages...', ephemeral=True, wait=True)
+
+    task = purge_jobs[channel.id] = asyncio.create_task(run_purge(job, message, reason))
+    task.add_done_callback(lambda _: purge_jobs.pop(channel.id, None))
+
+
+@bot.tree.command(name='purge_cancel', description='Cancel purge running in this channel')
+async def purge_cancel(interaction: discord.Interaction):
+    """
+    cancel purge running in this channel
+    :param interaction:
+    :return:
+    """
+    error = check_moderator(interaction, None, 'manage_messages')
+    if error is not None:
+        await interaction.response.send_message(error, ephemeral=True)
+        return
+    task = purge_jobs.get(interaction.channel.id)
+    if task is None:
+        await interaction.response.send_message('There is no purge running in this channel', ephemeral=True)
         return
-    if len(reason) > 0:
-        reason = f'. Reason: **{reason}**'
-    deleted = await interaction.channel.purge(limit=limit)
-    await interaction.response.send_message(f'Deleted {len(deleted)} message(s){reason}', ephemeral=True)
+    task.cancel()
+    await interaction.response.send_message('Purge is cancelled', ephemeral=True)
+
+
+class HistoryPages(discord.ui.View):
+    """
+    pages of a member's infractions, the next page starts after the last row shown (keyset pagination)
+    """
+
+    def __init__(self, guild_id: int, member: discord.abc.User, rows: list[tuple]):
+        super().__init__(timeout=300)
+        self.guild_id = guild_id
+        self.member = member
+        self.page = 1
+        self.rows = rows
+        self.older.disabled = len(rows) < PAGE_SIZE
+
+    def content(self) -> str:
+        if not self.rows:
+            return f'**{self.member}** has no infractions'
+        return '\n'.join((f'Infractions of **{self.member}** (page {self.page})', *map(describe, self.rows)))
+
+    @discord.ui.button(label='Older', style=discord.ButtonStyle.secondary)
+    async def older(self, interaction: discord.Interaction, button: discord.ui.Button):
+        last = self.rows[-1]
+        rows = await infractions.page(self.guild_id, self.member.id, (last[1], last[0]))
+        if rows:
+            self.rows = rows
+            self.page += 1
+        button.disabled = len(rows) < PAGE_SIZE
+        await interaction.response.edit_message(content=self.content(), view=self)
+
+
+@bot.tree.command(name='history', description='Show infractions of member')
+async def history(interaction: discord.Interaction, member: discord.User):
+    """
+    show infractions of member, newest first
+    :param interaction: interaction
+    :param member: member (or user who left)
+    :return:
+    """
+    error = check_moderator(interaction, None, 'moderate_members')
+    if error is not None:
+        await interaction.response.send_message(error, ephemeral=True)
+        return
+    view = HistoryPages(interaction.guild.id, member, await infractions.page(interaction.guild.id, member.id))
+    await interaction.response.send_message(view.content(), view=view, ephemeral=True)
 
 
 # ----------------------------------------------------------------------------------------------------
@@ -185,54 +569,35 @@ async def logs(interaction: discord.Interaction):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("You don't have permissions to do this", ephemeral=True)
         return
-    log_channels[interaction.guild.id] = interaction.channel.id
+    await log_channels.set(interaction.guild.id, interaction.channel.id)
+    log_resolver.invalidate(interaction.guild.id)
     await interaction.response.send_message(f'**{interaction.channel.name}** is now channel for logs', ephemeral=True)
 
 
-def check_single(before, after, name: str = None) -> str:
-    if name is None:
-        name = after.__name__
-    log = ''
-    if before != after:
-        log += f'{name}: {getattr(before, "mention", before)} -> {getattr(after, "mention", after)}\n'
-    return log
-
-
-def check_several(before, after, name: str = None) -> str:
-    if name is None:
-        name = f'{after.__name__}s'
-    log = ''
-    if before != after:
-        removed = [getattr(item, "mention", str(item)) for item in before if item not in after]
-        added = [getattr(item, "mention", str(item)) for item in after if item not in before]
-        if len(removed) > 0:
-            log += f'{name} removed: {f", ".join(removed)}\n'
-        if len(added) > 0:
-            log += f'{name} added: {f", ".join(added)}\n'
-    return log
+@bot.tree.command(name='log_category', description='Enable or disable a category of logs')
+@discord.app_commands.choices(category=[discord.app_commands.Choice(name=name, value=name) for name in LOG_CATEGORIES])
+async def log_category(interaction: discord.Interaction, category: str, enabled: bool):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You don't have permissions to do this", ephemeral=True)
+        return
+    mask = await log_resolver.subscribe(interaction.guild.id, LOG_CATEGORIES[category], enabled)
+    logged = ', '.join(name for name, bit in LOG_CATEGORIES.items() if mask & bit) or 'nothing'
+    await interaction.response.send_message(f'Logged categories: {logged}', ephemeral=True)
 
 
 # App Commands
 
 @bot.event
 async def on_raw_app_command_permissions_update(payload: discord.RawAppCommandPermissionsUpdateEvent):
-    log_channel = log_channels.get(payload.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = payload.guild.get_channel(log_channel)
-
-    await log_channel.send('Application command permissions are updated')
+    log = log_sink(payload.guild.id)
+    log.put('Application command permissions are updated')
 
 
 @bot.event
 async def on_app_command_completion(interaction: discord.Interaction,
                                     command: discord.app_commands.Command | discord.app_commands.ContextMenu):
-    log_channel = log_channels.get(interaction.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = interaction.guild.get_channel(log_channel)
-
-    await log_channel.send(f'**{command}** command has successfully completed without error')
+    log = log_sink(interaction.guild.id)
+    log.put(f'**{command}** command has successfully completed without error')
 
 
 # AutoMod
@@ -240,124 +605,142 @@ async def on_app_command_completion(interaction: discord.Interaction,
 
 @bot.event
 async def on_automod_rule_create(rule: discord.AutoModRule):
-    log_channel = log_channels.get(rule.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = rule.guild.get_channel(log_channel)
-
-    await log_channel.send(f'**{rule}** rule is created')
+    log = log_sink(rule.guild.id)
+    log.put(f'**{rule}** rule is created')
 
 
 @bot.event
 async def on_automod_rule_delete(rule: discord.AutoModRule):
-    log_channel = log_channels.get(rule.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = rule.guild.get_channel(log_channel)
-
-    await log_channel.send(f'**{rule}** rule is deleted')
+    log = log_sink(rule.guild.id)
+    log.put(f'**{rule}** rule is deleted')
 
 
 @bot.event
 async def on_automod_rule_update(rule: discord.AutoModRule):
-    log_channel = log_channels.get(rule.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = rule.guild.get_channel(log_channel)
-
-    await log_channel.send(f'**{rule}** rule is updated')
+    log = log_sink(rule.guild.id)
+    log.put(f'**{rule}** rule is updated')
 
 
 @bot.event
 async def on_automod_rule_action(execution: discord.AutoModAction):
-    log_channel = log_channels.get(execution.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = execution.guild.get_channel(log_channel)
-
-    await log_channel.send(f"**{execution.member}**'s message has triggered the rule. Result: {execution.action.type}\n"
-                           f"Message:\n{execution.content}")
+    log = log_sink(execution.guild.id)
+    log.put(f"**{execution.member}**'s message has triggered the rule. Result: {execution.action.type}\n"
+            f"Message:\n{execution.content}")
 
 
 # Channels
 
 @bot.event
 async def on_guild_channel_create(channel: discord.abc.GuildChannel):
-    log_channel = log_channels.get(channel.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = channel.guild.get_channel(log_channel)
+    log = log_sink(channel.guild.id)
+    log.put(f'**{channel}** channel is created')
 
-    await log_channel.send(f'**{channel}** channel is created')
+
+async def notify_logs_removed(channel: discord.abc.GuildChannel) -> None:
+    """
+    tell the guild its logs stopped, in its system channel
+    :param channel: deleted log channel
+    :return:
+    """
+    system_channel = channel.guild.system_channel
+    if system_channel is None or not system_channel.permissions_for(channel.guild.me).send_messages:
+        return
+    try:
+        await system_channel.send(f'Log channel **{channel}** was deleted, logs are disabled until a new one is '
+                                  'set with /logs')
+    except discord.HTTPException as e:
+        print(f'Failed to notify {channel.guild} about its deleted log channel: {e}')
 
 
 @bot.event
 async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
-    log_channel = log_channels.get(channel.guild.id, None)
-    if log_channel is None:
+    if log_resolver.is_log_channel(channel):
+        await log_resolver.remove(channel.guild.id)
+        await notify_logs_removed(channel)
+        return
+    log = log_sink(channel.guild.id, LOG_CHANNELS)
+    if not log:
         return
-    log_channel = channel.guild.get_channel(log_channel)
 
-    await log_channel.send(f'**{channel}** channel is deleted')
+    log.put(f'**{channel}** channel is deleted')
+    audit_log.enrich(log, channel.guild, discord.AuditLogAction.channel_delete, channel.id,
+                     f'**{channel}** channel was deleted')
+
+
+guild_channel_spec = DiffSpec(
+    lambda channel: f'{channel.mention} channel is updated',
+    scalar('name', 'Name'),
+    scalar('guild', 'Guild'),
+    scalar('position', 'Position'),
+    collection('changed_roles', 'Roles'),
+    scalar('mention', 'Mention'),
+    scalar('jump_url', 'URL'),
+    scalar('created_at', 'Creation time'),
+    overwrites('_overwrites', 'Overwrites'),
+    scalar('category', 'Category'),
+    scalar('permissions_synced', 'Permissions synced'),
+)
 
 
 @bot.event
 async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
-    log_channel = log_channels.get(after.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = after.guild.get_channel(log_channel)
+    if log_resolver.is_log_channel(after) and before.overwrites != after.overwrites:
+        # the bot may have lost (or gained) the permission to manage webhooks
+        log_resolver.invalidate(after.guild.id)
+    log = log_sink(after.guild.id)
+    content = guild_channel_spec.render(before, after)
+    if content is not None:
+        log.put(content)
 
-    content = f'{after.mention} channel is updated\n'
-    content += check_single(before.name, after.name, 'Name')
-    content += check_single(before.guild, after.guild, 'Guild')
-    content += check_single(before.position, after.position, 'Position')
-    content += check_several(before.changed_roles, after.changed_roles, 'Roles')
-    content += check_single(before.mention, after.mention, 'Mention')
-    content += check_single(before.jump_url, after.jump_url, 'URL')
-    content += check_single(before.created_at, after.created_at, 'Creation time')
-    # before.overwrites, after.overwrites, 'Overwrites'
-    content += check_single(before.category, after.category, 'Category')
-    content += check_single(before.permissions_synced, after.permissions_synced, 'Permissions synced')
-    await log_channel.send(content)
 
 
 @bot.event
 async def on_guild_channel_pins_update(channel: discord.abc.GuildChannel | discord.Thread,
                                        last_pin: datetime.datetime | None):
-    log_channel = log_channels.get(channel.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = channel.guild.get_channel(log_channel)
-
+    log = log_sink(channel.guild.id)
     ...
 
 
+@bot.event
+async def on_webhooks_update(channel: discord.abc.GuildChannel):
+    """
+    logs webhook may have been deleted, resolve it again on the next flush
+    :param channel: channel whose webhooks changed
+    :return:
+    """
+    if log_resolver.is_log_channel(channel):
+        log_resolver.invalidate(channel.guild.id)
+
+
+private_channel_spec = DiffSpec(
+    lambda channel: f'{channel} group is updated',
+    collection('recipients', 'Recipients'),
+    scalar('me', 'Alt user'),
+    scalar('id', 'ID'),
+    scalar('owner', 'Owner'),
+    scalar('name', 'Name'),
+    scalar('type', 'Type'),
+    scalar('icon', 'Icon'),
+    scalar('created_at', 'Creation time'),
+    scalar('jump_url', 'URL'),
+)
+
+
 @bot.event
 async def on_private_channel_update(before: discord.GroupChannel, after: discord.GroupChannel):
-    log_channel = log_channels.get(after.guild.id, None)
-    if log_channel is None:
+    log = log_sink(after.guild.id, LOG_CHANNELS)
+    if not log:
         return
-    log_channel = after.guild.get_channel(log_channel)
 
-    content = f'{after} group is updated\n'
-    content += check_several(before.recipients, after.recipients, 'Recipients')
-    content += check_single(before.me, after.me, 'Alt user')
-    content += check_single(before.id, after.id, 'ID')
-    content += check_single(before.owner, after.owner, 'Owner')
-    content += check_single(before.name, after.name, 'Name')
-    content += check_single(before.type, after.type, 'Type')
-    content += check_single(before.guild, after.guild, 'Guild')
-    content += check_single(before.icon, after.icon, 'Icon')
-    content += check_single(before.created_at, after.created_at, 'Creation time')
-    content += check_single(before.jump_url, after.jump_url, 'URL')
-    await log_channel.send(content)
+    content = private_channel_spec.render(before, after)
+    if content is not None:
+        log.put(content)
 
 
 @bot.event
 async def on_private_channel_pins_update(channel: discord.abc.PrivateChannel, last_pin: datetime.datetime | None):
-    log_channel = log_channels.get(channel.id, None)
-    if log_channel is None:
+    log = log_sink(channel.id, LOG_CHANNELS)
+    if not log:
         return
 
     ...
@@ -365,20 +748,9 @@ async def on_private_channel_pins_update(channel: discord.abc.PrivateChannel, la
 
 @bot.event
 async def on_typing(channel: discord.abc.Messageable, user: discord.User | discord.Member, when: datetime.datetime):
-    if type(channel) == discord.TextChannel:
-        channel: discord.TextChannel
-        log_channel = log_channels.get(channel.guild.id, None)
-        if log_channel is None:
-            return
-        log_channel = channel.guild.get_channel(log_channel)
-        # await log_channel.send(f'{user.mention} started tying in {channel.mention} at {when}')
-    else:
-        channel: discord.GroupChannel | discord.DMChannel
-        log_channel = log_channels.get(channel.id, None)
-        if log_channel is None:
-            return
-        log_channel = channel
-        # await log_channel.send(f'{user.mention} started typing in {channel} at {when}')
+    # typing in private channels isn't dispatched here, they don't belong to a guild with logs
+    log = log_sink(channel.guild.id)
+    # log.put(f'{user.mention} started typing in {channel.mention} at {when}')
 
 
 # @bot.event
@@ -388,6 +760,34 @@ async def on_typing(channel: discord.abc.Messageable, user: discord.User | disco
 
 # Connection
 
+@bot.event
+async def setup_hook():
+    """
+    start background tasks
+    :return:
+    """
+    rest_scheduler.attach(bot.http)
+    rest_scheduler.start()
+    ingest.start()
+    timed_actions.start()
+    infractions.start()
+    log_resolver.outbox.start()
+    dm_outbox.start()
+    temp_voice.start()
+    metrics.count_events(bot._connection)
+    if recorder is not None:
+        recorder.attach(bot._connection)
+        recorder.start()
+    port = int(os.environ.get('DLBOT_METRICS_PORT', METRICS_PORT + (0 if cluster is None else cluster.cluster)))
+    try:
+        await metrics.serve(port=port)
+    except OSError as e:
+        print(f'Failed to serve metrics on port {port}: {e}')
+    if cluster is not None:
+        cluster.handlers.update(stats=cluster_stats, shutdown=cluster_shutdown)
+        await cluster.connect()
+
+
 @bot.event
 async def on_connect():
     print('Client has successfully connected to Discord')
@@ -412,6 +812,7 @@ async def on_shard_disconnect(shard_id: int):
 
 @bot.event
 async def on_error(event: str, *args, **kwargs):
+    metrics.error(event)
     print(f'{event} raised an exception\nPositional arguments: {args}\nKeyword arguments: {kwargs}')
 
 
@@ -437,15 +838,34 @@ async def on_socket_event_type(event_type: str):
 @bot.event
 async def on_ready():
     """
-    sync the commands tree
+    sync the commands tree if it changed, reconcile temporary voice channels
     :return:
     """
     # bot.tree.copy_global_to(guild=discord.Object(id=964109254833356860))
-    await bot.tree.sync()
-    # await bot.tree.sync(guild=discord.Object(id=964109254833356860))
+    await sync_tree(bot.tree, command_hashes)
+    # await sync_tree(bot.tree, command_hashes, guild=discord.Object(id=964109254833356860))
+    await temp_voice.reconcile(bot.guilds)
     print('Client is done preparing the data received from Discord')
 
 
+@bot.tree.command(name='sync', description='Sync application commands')
+async def sync(interaction: discord.Interaction, force: bool = False):
+    """
+    sync application commands, normally they are synced on startup only when they change
+    :param interaction: interaction
+    :param force: sync even if commands didn't change
+    :return:
+    """
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You don't have permissions to do this", ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    if await sync_tree(bot.tree, command_hashes, force=force):
+        await interaction.followup.send('Commands are synced', ephemeral=True)
+    else:
+        await interaction.followup.send('Commands are already up to date', ephemeral=True)
+
+
 @bot.event
 async def on_resumed():
     print('Client has resumed a session')
@@ -465,22 +885,14 @@ async def on_shard_resumed(shard_id: int):
 
 @bot.event
 async def on_guild_available(guild: discord.Guild):
-    log_channel = log_channels.get(guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = guild.get_channel(log_channel)
-
-    await log_channel.send(f'{guild} server has become available')
+    log = log_sink(guild.id)
+    log.put(f'{guild} server has become available')
 
 
 @bot.event
 async def on_guild_unavailable(guild: discord.Guild):
-    log_channel = log_channels.get(guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = guild.get_channel(log_channel)
-
-    await log_channel.send(f'{guild} server has become unavailable')
+    log = log_sink(guild.id)
+    log.put(f'{guild} server has become unavailable')
 
 
 @bot.event
@@ -490,105 +902,102 @@ async def on_guild_join(guild: discord.Guild):
     :param guild: guild which bot joined
     :return:
     """
-    await guild.create_voice_channel('Create channel')
+    await temp_voice.create_lobby(guild)
 
-    log_channel = log_channels.get(guild.id, None)
-    if log_channel is None:
+    log = log_sink(guild.id, LOG_GUILD)
+    if not log:
         return
-    log_channel = guild.get_channel(log_channel)
 
-    await log_channel.send(f'{guild} server was joined')
+    log.put(f'{guild} server was joined')
 
 
 @bot.event
 async def on_guild_remove(guild: discord.Guild):
-    log_channel = log_channels.get(guild.id, None)
-    if log_channel is None:
+    chunked_guilds.pop(guild.id, None)
+    log = log_sink(guild.id, LOG_GUILD)
+    if not log:
         return
-    log_channel = guild.get_channel(log_channel)
 
-    await log_channel.send(f'{guild} server was removed')
+    log.put(f'{guild} server was removed')
+
+
+guild_spec = DiffSpec(
+    lambda guild: f'{guild} server is updated',
+    scalar('name', 'Name'),
+    collection('emojis', 'Emojis'),
+    collection('stickers', 'Stickers'),
+    scalar('afk_timeout', 'AFK timeout (seconds)'),
+    scalar('id', 'ID'),
+    scalar('owner', 'Owner'),
+    scalar('unavailable', 'Unavailability'),
+    scalar('max_presences', 'Maximum presences'),
+    scalar('max_members', 'Maximum members'),
+    scalar('max_video_channel_users', 'Maximum users in a video channel'),
+    scalar('description', 'Description'),
+    scalar('verification_level', 'Verification level'),
+    scalar('vanity_url_code', 'URL code'),
+    scalar('explicit_content_filter', 'Explicit content filter'),
+    scalar('default_notifications', 'Notifications'),
+    collection('features', 'Features'),
+    scalar('premium_tier', 'Server Nitro level'),
+    scalar('premium_subscription_count', 'Boosts'),
+    scalar('preferred_locale', 'Locale'),
+    scalar('nsfw_level', 'NSFW level'),
+    scalar('mfa_level', 'MFA level'),
+    scalar('approximate_member_count', 'Approximate number of members'),
+    scalar('approximate_presence_count', 'Approximate number of presences'),
+    scalar('premium_progress_bar_enabled', 'Server Boost level progress bar'),
+    scalar('widget_enabled', 'Widget enabled'),
+    scalar('max_stage_video_users', 'Maximum users in a stage video channel'),
+    collection('channels', 'Channels'),
+    collection('threads', 'Threads'),
+    scalar('large', 'Is large'),
+    collection('voice_channels', 'Voice channels'),
+    collection('stage_channels', 'Stage channels'),
+    scalar('me', 'Alt member'),
+    scalar('voice_client', 'Voice client'),
+    collection('text_channels', 'Text channels'),
+    collection('categories', 'Categories'),
+    collection('forums', 'Forums'),
+    scalar('afk_channel', 'Inactive (AFK) channel'),
+    scalar('system_channel', 'System channel'),
+    flags('system_channel_flags', 'System channel', discord.SystemChannelFlags),
+    scalar('rules_channel', 'Rules channel'),
+    scalar('public_updates_channel', 'Community updates channel'),
+    scalar('safety_alerts_channel', 'Safety alerts channel'),
+    scalar('widget_channel', 'Widget channel'),
+    scalar('emoji_limit', 'Emoji limit'),
+    scalar('sticker_limit', 'Sticker limit'),
+    scalar('bitrate_limit', 'Bitrate limit'),
+    scalar('filesize_limit', 'File size limit (bytes)'),
+    collection('members', 'Members'),
+    collection('premium_subscribers', 'Boosters'),
+    collection('roles', 'Roles'),
+    scalar('default_role', 'Default role'),
+    scalar('premium_subscriber_role', 'Booster role'),
+    scalar('self_role', 'Alt role'),
+    collection('stage_instances', 'Stage instances'),
+    collection('scheduled_events', 'Scheduled events'),
+    scalar('icon', 'Icon'),
+    scalar('banner', 'Banner'),
+    scalar('splash', 'Invite splash'),
+    scalar('discovery_splash', 'Discovery splash'),
+    scalar('member_count', 'Number of members'),
+    # scalar('chunked', 'Chunked'),
+    scalar('shard_id', 'Shard ID'),
+    scalar('created_at', 'Creation time'),
+)
 
 
 @bot.event
 async def on_guild_update(before: discord.Guild, after: discord.Guild):
-    log_channel = log_channels.get(after.id, None)
-    if log_channel is None:
-        return
-    log_channel = after.get_channel(log_channel)
-
-    content = f'{after} server is updated\n'
-    content += check_single(before.name, after.name, 'ID')
-    content += check_several(before.emojis, after.emojis, 'Emojis')
-    content += check_several(before.stickers, after.stickers, 'Stickers')
-    content += check_single(before.afk_timeout, after.afk_timeout, 'AFK timeout (seconds)')
-    content += check_single(before.id, after.id, 'ID')
-    content += check_single(before.owner, after.owner, 'Owner')
-    content += check_single(before.unavailable, after.unavailable, 'Unavailability')
-    content += check_single(before.max_presences, after.max_presences, 'Maximum presences')
-    content += check_single(before.max_members, after.max_members, 'Maximum members')
-    content += check_single(before.max_video_channel_users, after.max_video_channel_users,
-                            'Maximum users in a video channel')
-    content += check_single(before.description, after.description, 'Description')
-    content += check_single(before.verification_level, after.verification_level, 'Verification level')
-    content += check_single(before.vanity_url_code, after.vanity_url_code, 'URL code')
-    content += check_single(before.explicit_content_filter, after.explicit_content_filter, 'Explicit content filter')
-    content += check_single(before.default_notifications, after.default_notifications, 'Notifications')
-    content += check_several(before.features, after.features, 'Features')
-    content += check_single(before.premium_tier, after.premium_tier, 'Server Nitro level')
-    content += check_single(before.premium_subscription_count, after.premium_subscription_count, 'Boosts')
-    content += check_single(before.preferred_locale, after.preferred_locale, 'Locale')
-    content += check_single(before.nsfw_level, after.nsfw_level, 'NSFW level')
-    content += check_single(before.mfa_level, after.mfa_level, 'MFA level')
-    content += check_single(before.approximate_member_count, after.approximate_member_count,
-                            'Approximate number of members')
-    content += check_single(before.approximate_presence_count, after.approximate_presence_count,
-                            'Approximate number of presences')
-    content += check_single(before.premium_progress_bar_enabled, after.premium_progress_bar_enabled,
-                            'Server Boost level progress bar')
-    content += check_single(before.widget_enabled, after.widget_enabled, 'Widget enabled')
-    content += check_single(before.max_stage_video_users, after.max_stage_video_users,
-                            'Maximum users in a stage video channel')
-    content += check_several(before.channels, after.channels, 'Channels')
-    content += check_several(before.threads, after.threads, 'Threads')
-    content += check_single(before.large, after.large, 'Is large')
-    content += check_several(before.voice_channels, after.voice_channels, 'Voice channels')
-    content += check_several(before.stage_channels, after.stage_channels, 'Stage channels')
-    content += check_single(before.me, after.me, 'Alt member')
-    content += check_single(before.voice_client, after.voice_client, 'Voice client')
-    content += check_several(before.text_channels, after.text_channels, 'Text channels')
-    content += check_several(before.categories, after.categories, 'Categories')
-    content += check_several(before.forums, before.forums, 'Forums')
-    content += check_single(before.afk_channel, after.afk_channel, 'Inactive (AFK) channel')
-    content += check_single(before.system_channel, after.system_channel, 'System channel')
-    # before.system_channel_flags, after.system_channel_flags
-    content += check_single(before.rules_channel, after.rules_channel, 'Rules channel')
-    content += check_single(before.public_updates_channel, after.public_updates_channel, 'Community updates channel')
-    content += check_single(before.safety_alerts_channel, after.safety_alerts_channel, 'Safety alerts channel')
-    content += check_single(before.widget_channel, after.widget_channel, 'Widget channel')
-    content += check_single(before.emoji_limit, after.emoji_limit, 'Emoji limit')
-    content += check_single(before.sticker_limit, after.sticker_limit, 'Sticker limit')
-    content += check_single(before.bitrate_limit, after.bitrate_limit, 'Bitrate limit')
-    content += check_single(before.filesize_limit, after.filesize_limit, 'File size limit (bytes)')
-    content += check_several(before.members, after.members, 'Members')
-    content += check_several(before.premium_subscribers, after.premium_subscribers, 'Boosters')
-    content += check_several(before.roles, after.roles, 'Roles')
-    content += check_single(before.default_role, after.default_role, 'Default role')
-    content += check_single(before.premium_subscriber_role, after.premium_subscriber_role, 'Booster role')
-    content += check_single(before.self_role, after.self_role, 'Alt role')
-    content += check_several(before.stage_instances, after.stage_instances, 'Stage instances')
-    content += check_several(before.scheduled_events, after.scheduled_events, 'Scheduled events')
-    content += check_single(before.owner, after.owner, 'Owner')
-    content += check_single(before.icon, after.icon, 'Icon')
-    content += check_single(before.banner, after.banner, 'Banner')
-    content += check_single(before.splash, after.splash, 'Invite splash')
-    content += check_single(before.discovery_splash, after.discovery_splash, 'Discovery splash')
-    content += check_single(before.member_count, after.member_count, 'Number of members')
-    # content += check_single(before.chunked, after.chunked, 'Chunked')
-    content += check_single(before.shard_id, after.shard_id, 'Shard ID')
-    content += check_single(before.created_at, after.created_at, 'Creation time')
-
-    await log_channel.send(content)
+    log = log_sink(after.id)
+    content = guild_spec.render(before, after)
+    if content is not None:
+        log.put(content)
+
+
+update_lane.filters['on_guild_update'] = guild_spec.changed
 
 
 #
@@ -600,185 +1009,218 @@ async def on_member_join(member: discord.Member):
     :param member: recently joined member
     :return:
     """
-    role = autoroles.get(member.guild.id, None)
-    if role is not None:
-        role = role[member.bot]
-        role = member.guild.get_role(role)
-        await member.add_roles(role)
+    autorole_worker.put(member)
+    if lean_member_cache:
+        cache_joined(member)
 
-    log_channel = log_channels.get(member.guild.id, None)
-    if log_channel is None:
+    log = log_sink(member.guild.id, LOG_MEMBERS)
+    if not log:
         return
-    log_channel = member.guild.get_channel(log_channel)
 
-    await log_channel.send(f'{member.mention} has joined the server')
+    log.put(f'{member.mention} has joined the server')
+
+
+@bot.event
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
+    autorole_worker.discard(payload.guild_id, payload.user.id)
 
 
 @bot.event
 async def on_member_remove(member: discord.Member):
-    log_channel = log_channels.get(member.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = member.guild.get_channel(log_channel)
+    log = log_sink(member.guild.id)
+    log.put(f'{member.mention} has left the server')
 
-    await log_channel.send(f'{member.mention} has left the server')
+
+member_spec = DiffSpec(
+    lambda member: f'{member.mention} has updated their profile',
+    scalar('name', 'Name'),
+    scalar('global_name', 'Global name'),
+    scalar('display_name', 'Display name'),
+    collection('roles', 'Roles'),
+)
 
 
 @bot.event
 async def on_member_update(before: discord.Member, after: discord.Member):
-    log_channel = log_channels.get(after.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = after.guild.get_channel(log_channel)
+    log = log_sink(after.guild.id)
+    content = member_spec.render(before, after)
+    if content is not None:
+        log.put(content)
 
-    content = f'{after.mention} has updated their profile\n'
-    content += check_single(before.name, after.name, 'Name')
-    content += check_single(before.global_name, after.global_name, 'Global name')
-    content += check_single(before.display_name, after.display_name, 'Display name')
-    content += check_several(before.roles, after.roles, 'Roles')
-    await log_channel.send(content)
+
+update_lane.filters['on_member_update'] = member_spec.changed
 
 
 @bot.event
 async def on_member_ban(guild: discord.Guild, user: discord.User | discord.Member):
-    log_channel = log_channels.get(guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = guild.get_channel(log_channel)
+    log = log_sink(guild.id)
+    log.put(f'{user.mention} was banned')
+    audit_log.enrich(log, guild, discord.AuditLogAction.ban, user.id, f'{user.mention} was banned')
 
-    await log_channel.send(f'{user.mention} was banned')
+
+@bot.event
+async def on_audit_log_entry_create(entry: discord.AuditLogEntry):
+    """
+    cache entries pushed by the gateway, so attributing events doesn't need to fetch the audit log
+    :param entry: new audit log entry
+    :return:
+    """
+    audit_log.add(entry)
 
 
 @bot.event
 async def on_member_unban(guild: discord.Guild, user: discord.User):
-    log_channel = log_channels.get(guild.id, None)
-    if log_channel is None:
+    log = log_sink(guild.id)
+    log.put(f'{user.mention} was unbanned')
+
+
+@bot.event
+async def on_message(message: discord.Message):
+    """
+    remember messages of guilds with logs for edit/delete logging
+    :param message: new message
+    :return:
+    """
+    log = log_sink(message.guild.id)
+    if log.channel_id == message.channel.id:
         return
-    log_channel = guild.get_channel(log_channel)
 
-    await log_channel.send(f'{user.mention} was unbanned')
+    message_store.put_message(message)
 
 
 @bot.event
-async def on_message_edit(before: discord.Message, after: discord.Message):
-    log_channel = log_channels.get(after.guild.id, None)
-    if log_channel is None:
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    log = log_sink(payload.guild_id)
+    if 'content' not in payload.data or log.channel_id == payload.channel_id:
         return
-    log_channel = after.guild.get_channel(log_channel)
 
-    await log_channel.send(
-        f'{after.author.mention} has changed their message in {after.channel.mention}\n'
-        f'Before:\n{before.content}\nAfter:\n{after.content}')
+    stored = message_store.get(payload.guild_id, payload.message_id)
+    content = payload.data['content']
+    if stored is not None and stored.content == content:
+        return
+    if 'author' in payload.data:
+        author_id = int(payload.data['author']['id'])
+    elif stored is not None:
+        author_id = stored.author_id
+    else:
+        return
+    attachments = tuple(attachment['url'] for attachment in payload.data.get('attachments', []))
+    message_store.put(payload.guild_id, payload.message_id, payload.channel_id, author_id, content, attachments)
+    before = '*unknown (message is older than the logs)*' if stored is None else stored.content
+    log.put(
+        f'<@{author_id}> has changed their message in <#{payload.channel_id}>\n'
+        f'Before:\n{before}\nAfter:\n{content}')
 
 
 @bot.event
-async def on_message_delete(message: discord.Message):
-    log_channel = log_channels.get(message.guild.id, None)
-    if log_channel is None:
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    log = log_sink(payload.guild_id)
+    if log.channel_id == payload.channel_id:
         return
-    log_channel = message.guild.get_channel(log_channel)
 
-    await log_channel.send(
-        f'{message.author.mention} has deleted their message in {message.channel.mention}\n'
-        f'Message:\n{message.content}')
+    stored = message_store.pop(payload.guild_id, payload.message_id)
+    if stored is None:
+        log.put(f'A message was deleted in <#{payload.channel_id}>, its content is unknown')
+        return
+    log.put(
+        f'<@{stored.author_id}> has deleted their message in <#{payload.channel_id}>\n'
+        f'Message:\n{stored.describe()}')
+    # deleting own messages leaves no audit log entry, only deletions by someone else are attributed, and the
+    # audit log isn't fetched for the (many) deletions without one
+    audit_log.enrich(log, bot.get_guild(payload.guild_id), discord.AuditLogAction.message_delete, stored.author_id,
+                     f'Message of <@{stored.author_id}> in <#{payload.channel_id}> was deleted',
+                     lambda entry: entry.extra.channel.id == payload.channel_id, fetch=False)
 
 
 @bot.event
-async def on_guild_role_create(role: discord.Role):
-    log_channel = log_channels.get(role.guild.id, None)
-    if log_channel is None:
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    log = log_sink(payload.guild_id)
+    if log.channel_id == payload.channel_id:
         return
-    log_channel = role.guild.get_channel(log_channel)
 
-    await log_channel.send(f'{role.mention} role was created')
+    content = [f'{len(payload.message_ids)} messages were deleted in <#{payload.channel_id}>']
+    for message_id in sorted(payload.message_ids):
+        stored = message_store.pop(payload.guild_id, message_id)
+        if stored is not None:
+            content.append(f'<@{stored.author_id}>: {stored.describe()}')
+    log.put('\n'.join(content))
+
+
+@bot.event
+async def on_guild_role_create(role: discord.Role):
+    log = log_sink(role.guild.id)
+    log.put(f'{role.mention} role was created')
 
 
 @bot.event
 async def on_guild_role_delete(role: discord.Role):
-    log_channel = log_channels.get(role.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = role.guild.get_channel(log_channel)
+    log = log_sink(role.guild.id)
+    log.put(f'{role.mention} role was deleted')
+    audit_log.enrich(log, role.guild, discord.AuditLogAction.role_delete, role.id, f'**{role}** role was deleted')
+
 
-    await log_channel.send(f'{role.mention} role was deleted')
+role_spec = DiffSpec(
+    lambda role: f'{role.mention} role was updated',
+    scalar('name', 'Name'),
+    scalar('color', 'Color'),
+    permissions('permissions', 'Permissions'),
+)
 
 
 @bot.event
 async def on_guild_role_update(before: discord.Role, after: discord.Role):
-    log_channel = log_channels.get(after.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = after.guild.get_channel(log_channel)
-
-    content = f'{after.mention} role was updated\n'
-    if before.name != after.name:
-        content += f'Name: **{before.name}** -> **{after.name}**\n'
-    if before.color != after.color:
-        content += f'Color: **{before.color}** -> **{after.color}**\n'
-    before_permissions = [permission for permission in before.permissions]
-    after_permissions = [permission for permission in after.permissions]
-    removed_permissions = []
-    added_permissions = []
-    for before_permission, after_permission in zip(before_permissions, after_permissions):
-        if before_permission[1] and not after_permission[1]:
-            removed_permissions.append(before_permission[0])
-        if not before_permission[1] and after_permission[1]:
-            added_permissions.append(after_permission[0])
-    if len(removed_permissions) > 0:
-        content += f'Removed permissions: **{"**, **".join(removed_permissions)}**\n'
-    if len(added_permissions) > 0:
-        content += f'Added permissions: **{"**, **".join(added_permissions)}**\n'
-    await log_channel.send(content)
+    log = log_sink(after.guild.id)
+    content = role_spec.render(before, after)
+    if content is not None:
+        log.put(content)
+
 
 
 @bot.event
 async def on_thread_create(thread: discord.Thread):
-    log_channel = log_channels.get(thread.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = thread.guild.get_channel(log_channel)
-
-    await log_channel.send(f'{thread.mention} was created in {thread.parent.mention}')
+    log = log_sink(thread.guild.id)
+    log.put(f'{thread.mention} was created in {thread.parent.mention}')
 
 
 @bot.event
 async def on_thread_join(thread: discord.Thread):
-    log_channel = log_channels.get(thread.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = thread.guild.get_channel(log_channel)
+    log = log_sink(thread.guild.id)
+    log.put(f'{thread.mention} was joined in {thread.parent.mention}')
 
-    await log_channel.send(f'{thread.mention} was joined in {thread.parent.mention}')
+
+thread_spec = DiffSpec(
+    lambda thread: f'{thread.mention} thread was updated',
+    scalar('name', 'Name'),
+    scalar('parent', 'Parent'),
+    scalar('owner', 'Owner'),
+    scalar('archived', 'Archived'),
+    scalar('locked', 'Locked'),
+    scalar('invitable', 'Invitable'),
+    scalar('slowmode_delay', 'Slowmode delay (seconds)'),
+    scalar('auto_archive_duration', 'Auto archive duration (minutes)'),
+    collection('applied_tags', 'Tags'),
+)
 
 
 @bot.event
 async def on_thread_update(before: discord.Thread, after: discord.Thread):
-    log_channel = log_channels.get(after.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = after.guild.get_channel(log_channel)
+    log = log_sink(after.guild.id)
+    content = thread_spec.render(before, after)
+    if content is not None:
+        log.put(content)
 
-    ...
 
 
 @bot.event
 async def on_thread_remove(thread: discord.Thread):
-    log_channel = log_channels.get(thread.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = thread.guild.get_channel(log_channel)
-
-    await log_channel.send(f'{thread.mention} was removed from {thread.parent.mention}')
+    log = log_sink(thread.guild.id)
+    log.put(f'{thread.mention} was removed from {thread.parent.mention}')
 
 
 @bot.event
 async def on_thread_delete(thread: discord.Thread):
-    log_channel = log_channels.get(thread.guild.id, None)
-    if log_channel is None:
-        return
-    log_channel = thread.guild.get_channel(log_channel)
-
-    await log_channel.send(f'{thread.mention} was deleted from {thread.parent.mention}')
+    log = log_sink(thread.guild.id)
+    log.put(f'{thread.mention} was deleted from {thread.parent.mention}')
 
 
 @bot.event
@@ -790,24 +1232,141 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
     :param after: voice state after update
     :return:
     """
-    if after.channel is not None and after.channel.name == 'Create channel':
-        channel = await member.guild.create_voice_channel(f'Created by {member.name}', category=after.channel.category)
-        await member.move_to(channel)
-    if before.channel is not None and before.channel.name == f'Created by {member.name}':
-        await before.channel.delete()
-
-    log_channel = log_channels.get(member.guild.id, None)
-    if log_channel is None:
+    if after.channel is not None and temp_voice.is_lobby(after.channel):
+        await temp_voice.claim(member, after.channel)
+    if (before.channel is not None and before.channel != after.channel and len(before.channel.members) == 0
+            and temp_voice.owner(before.channel) is not None):
+        temp_voice.release(before.channel)
+
+    log = log_sink(member.guild.id, LOG_VOICE)
+    if not log:
         return
-    log_channel = member.guild.get_channel(log_channel)
 
     if before.channel is None and after.channel is not None:
-        await log_channel.send(f'{member.mention} has joined {after.channel.mention} channel')
+        log.put(f'{member.mention} has joined {after.channel.mention} channel')
     elif before.channel is not None and after.channel is None:
-        await log_channel.send(f'{member.mention} has left {before.channel.mention} channel')
+        log.put(f'{member.mention} has left {before.channel.mention} channel')
+
+
+# ----------------------------------------------------------------------------------------------------
+# Cluster
+
+async def cluster_stats(data=None) -> dict:
+    """
+    stats of this process, answered to the other clusters as well
+    :param data: unused
+    :return: stats
+    """
+    return {
+        'shards': shard_ids or [bot.shard_id or 0],
+        'guilds': len(bot.guilds),
+        'members': sum(guild.member_count or 0 for guild in bot.guilds),
+        'latency': round(bot.latency * 1000) if bot.latency == bot.latency else None,
+        'log_queue': sum(map(len, log_resolver.outbox.queues.values())),
+        'dm_queue': dm_outbox.depth,
+    }
+
+
+async def cluster_shutdown(data=None):
+    asyncio.create_task(bot.close())
+
+
+@bot.tree.command(name='cluster', description='Show stats of every bot process')
+async def cluster_command(interaction: discord.Interaction):
+    """
+    show stats of every cluster
+    :param interaction: interaction
+    :return:
+    """
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You don't have permissions to do this", ephemeral=True)
+        return
+    if cluster is None:
+        stats = {0: await cluster_stats()}
+    else:
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        stats = await cluster.broadcast('stats')
+    content = '\n'.join(
+        f'Cluster {cluster_id}: shards {value["shards"]}, {value["guilds"]} server(s), {value["members"]} member(s), '
+        f'latency {value["latency"]} ms, {value["log_queue"]} queued log(s), {value["dm_queue"]} queued DM(s)'
+        for cluster_id, value in sorted(stats.items()))
+    if interaction.response.is_done():
+        await interaction.followup.send(content, ephemeral=True)
+    else:
+        await interaction.response.send_message(content, ephemeral=True)
 
 
 # ----------------------------------------------------------------------------------------------------
+# Metrics
+
+metrics.collect('dlbot_guilds', 'gauge', 'Servers', lambda: len(bot.guilds))
+metrics.collect('dlbot_gateway_latency_seconds', 'gauge', 'Gateway latency (s)',
+                lambda: dict(getattr(bot, 'latencies', [(bot.shard_id or 0, bot.latency)])))
+metrics.collect('dlbot_queue_depth', 'gauge', 'Queued items', lambda: {
+    'logs': sum(map(len, log_resolver.outbox.queues.values())),
+    'dms': dm_outbox.depth,
+    'autorole': autorole_worker.depth,
+})
+metrics.collect('dlbot_rest_waiting', 'gauge', 'REST calls waiting for their turn', lambda: rest_scheduler.depth)
+metrics.collect('dlbot_rest_delayed_total', 'counter', 'REST calls delayed by priority', lambda: {
+    name: value['delayed'] for name, value in rest_scheduler.stats().items()})
+metrics.collect('dlbot_rest_shed_total', 'counter', 'Shed REST calls', lambda: {
+    'log': rest_scheduler.shed[-1], 'log_messages': log_resolver.outbox.shed})
+metrics.collect('dlbot_ingest_depth', 'gauge', 'Queued event handlers by lane', lambda: {
+    name: lane.depth for name, lane in ingest.lanes.items()})
+metrics.collect('dlbot_ingest_shed_total', 'counter', 'Shed event handlers by lane', lambda: {
+    name: lane.shed for name, lane in ingest.lanes.items()})
+metrics.collect('dlbot_ingest_coalesced_total', 'counter', 'Coalesced event handlers by lane', lambda: {
+    name: lane.coalesced for name, lane in ingest.lanes.items()})
+metrics.collect('dlbot_ingest_unchanged_total', 'counter', 'Coalesced updates dropped as they changed nothing',
+                lambda: {name: lane.unchanged for name, lane in ingest.lanes.items()})
+metrics.collect('dlbot_ingest_gated_total', 'counter', "Events dropped as their guild doesn't log their category",
+                lambda: ingest.gated)
+metrics.collect('dlbot_ingest_timeouts_total', 'counter', 'Event handlers cancelled after their timeout', lambda: {
+    name: lane.timed_out for name, lane in ingest.lanes.items()})
+metrics.collect('dlbot_ingest_blocked_seconds_total', 'counter', 'Gateway paused by full lanes (s)',
+                lambda: round(ingest.blocked, 3))
+metrics.collect('dlbot_timed_actions', 'gauge', 'Pending timed actions', lambda: timed_actions.depth)
+metrics.collect('dlbot_timed_actions_total', 'counter', 'Timed actions run', lambda: {
+    'done': timed_actions.done, 'retried': timed_actions.retried})
+metrics.collect('dlbot_infractions_written_total', 'counter', 'Recorded infractions', lambda: infractions.written)
+metrics.collect('dlbot_stored_messages', 'gauge', 'Stored messages', lambda: len(message_store))
+metrics.collect('dlbot_bucket_wait_seconds_total', 'counter', 'Waited for local rate limits (s)', lambda: {
+    'autorole': round(sum(bucket.waited for bucket in autorole_worker.buckets.values()), 3),
+})
+
+
+@bot.tree.command(name='stats', description='Show event, handler and rate limit metrics')
+async def stats(interaction: discord.Interaction):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("You don't have permissions to do this", ephemeral=True)
+        return
+    content = metrics.summary()
+    if len(content) > 2000:
+        content = content[:1997] + '...'
+    await interaction.response.send_message(content, ephemeral=True)
+
+
+async def run_fake_gateway():
+    """
+    run without connecting to Discord, used to test clusters locally (python cluster.py --fake)
+    :return:
+    """
+    async with bot:
+        await bot.setup_hook()
+        while not bot.is_closed():
+            await asyncio.sleep(0.5)
+
+
+# every handler and command is defined by now
+removed_commands = remove_disabled_commands(bot.tree, features)
+if removed_commands:
+    print(f'Commands of disabled features are not registered: {", ".join(removed_commands)}')
+metrics.instrument_bot(bot)
+metrics.instrument_tree(bot.tree)
 
 if __name__ == '__main__':
-    bot.run('TOKEN')
+    if env_flag('DLBOT_FAKE_GATEWAY', False):
+        asyncio.run(run_fake_gateway())
+    else:
+        bot.run('TOKEN')
@@ -0,0 +1,116 @@
+import sys
+import zlib
+from collections import OrderedDict, deque
+
+import discord
+
+COMPRESS_MIN_SIZE = 128
+
+
+class StoredMessage:
+    """
+    what logging needs to know about a message, content is kept as (possibly compressed) UTF-8 bytes
+    """
+    __slots__ = ('id', 'channel_id', 'author_id', 'data', 'compressed', 'attachments')
+
+    def __init__(self, id: int, channel_id: int, author_id: int, content: str, attachments: tuple[str, ...],
+                 compress: bool):
+        self.id = id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.attachments = attachments
+        data = content.encode()
+        self.compressed = False
+        if compress and len(data) >= COMPRESS_MIN_SIZE:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                self.compressed = True
+        self.data = data
+
+    @property
+    def content(self) -> str:
+        return (zlib.decompress(self.data) if self.compressed else self.data).decode()
+
+    @property
+    def size(self) -> int:
+        return sys.getsizeof(self) + len(self.data) + sum(len(url) for url in self.attachments)
+
+    def describe(self) -> str:
+        content = self.content
+        if self.attachments:
+            content += '\n' + '\n'.join(self.attachments)
+        return content
+
+
+class MessageStore:
+    """
+    bounded store of recent messages for edit/delete logging
+
+    every guild keeps its messages in a ring buffer of at most per_guild entries, on top of that all guilds
+    share a byte budget, when it is exceeded the oldest messages (across all guilds) are evicted first
+    """
+
+    def __init__(self, budget: int = 64 * 2 ** 20, per_guild: int = 10_000, compress: bool = True):
+        """
+        :param budget: maximum total size of stored messages in bytes
+        :param per_guild: maximum number of stored messages per guild
+        :param compress: compress long contents with zlib
+        """
+        self.budget = budget
+        self.per_guild = per_guild
+        self.compress = compress
+        self.guilds: dict[int, OrderedDict[int, StoredMessage]] = {}
+        # global insertion order, entries of messages which are already gone are skipped on eviction
+        self.order: deque[tuple[int, int]] = deque()
+        self.size = 0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def put(self, guild_id: int, message_id: int, channel_id: int, author_id: int, content: str,
+            attachments: tuple[str, ...] = ()) -> None:
+        messages = self.guilds.get(guild_id)
+        if messages is None:
+            messages = self.guilds[guild_id] = OrderedDict()
+        stored = StoredMessage(message_id, channel_id, author_id, content, attachments, self.compress)
+        old = messages.get(message_id)
+        if old is None:
+            self.order.append((guild_id, message_id))
+            self.count += 1
+        else:
+            # edited messages keep their place in the eviction order
+            self.size -= old.size
+        messages[message_id] = stored
+        self.size += stored.size
+        if len(messages) > self.per_guild:
+            _, evicted = messages.popitem(last=False)
+            self.size -= evicted.size
+            self.count -= 1
+        while self.size > self.budget and self.order:
+            self.pop(*self.order.popleft())
+        if len(self.order) > 2 * self.count + 1024:
+            self.order = deque(key for key in self.order if key[1] in self.guilds.get(key[0], ()))
+
+    def put_message(self, message: discord.Message) -> None:
+        self.put(message.guild.id, message.id, message.channel.id, message.author.id, message.content,
+                 tuple(attachment.url for attachment in message.attachments))
+
+    def get(self, guild_id: int, message_id: int) -> StoredMessage | None:
+        messages = self.guilds.get(guild_id)
+        if messages is None:
+            return None
+        return messages.get(message_id)
+
+    def pop(self, guild_id: int, message_id: int) -> StoredMessage | None:
+        messages = self.guilds.get(guild_id)
+        if messages is None:
+            return None
+        stored = messages.pop(message_id, None)
+        if stored is not None:
+            self.size -= stored.size
+            self.count -= 1
+            if not messages:
+                del self.guilds[guild_id]
+        return stored
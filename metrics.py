@@ -0,0 +1,273 @@
+import asyncio
+import functools
+import time
+from bisect import bisect_left
+from collections.abc import Callable
+
+import aiohttp
+import discord
+
+# upper bounds of latency buckets in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+
+
+class Histogram:
+    """
+    latency histogram with fixed buckets, observing is a bisect and two additions
+    """
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def quantile(self, q: float) -> float:
+        """
+        :param q: quantile between 0 and 1
+        :return: upper bound of the bucket containing the quantile (inf if it is beyond the last bucket)
+        """
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """
+    in-process counters and latency histograms, rendered in the Prometheus text format
+
+    recording only touches dicts and lists of the instance, everything else (quantiles, gauges, formatting)
+    happens when metrics are read
+    """
+
+    def __init__(self):
+        self.events: dict[str, int] = {}
+        self.handlers: dict[str, Histogram] = {}
+        self.errors: dict[str, int] = {}
+        self.http: dict[int, int] = {}
+        self.http_latency = Histogram()
+        self.rate_limited = 0
+        self.rate_limit_wait = 0.0
+        # name -> (type, help, function returning a value or {label value: value})
+        self.collectors: dict[str, tuple[str, str, Callable[[], float | dict[str, float]]]] = {}
+        self.server: asyncio.Server | None = None
+
+    def histogram(self, name: str) -> Histogram:
+        histogram = self.handlers.get(name)
+        if histogram is None:
+            histogram = self.handlers[name] = Histogram()
+        return histogram
+
+    def instrument(self, name: str, function):
+        """
+        wrap coroutine function to record its latency
+        :param name: name the latency is recorded under
+        :param function: coroutine function
+        :return: wrapped coroutine function
+        """
+        histogram = self.histogram(name)
+        perf_counter = time.perf_counter
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                histogram.observe(perf_counter() - start)
+        return wrapper
+
+    def instrument_bot(self, bot: discord.Client, skip: frozenset[str] = frozenset({'on_error', 'setup_hook'})) -> None:
+        """
+        wrap every event handler registered with bot.event
+        :param bot: bot
+        :param skip: handlers which aren't wrapped
+        :return:
+        """
+        for name, handler in list(vars(bot).items()):
+            if name.startswith('on_') and name not in skip and asyncio.iscoroutinefunction(handler):
+                setattr(bot, name, self.instrument(name, handler))
+
+    def instrument_tree(self, tree: discord.app_commands.CommandTree) -> None:
+        """
+        wrap callbacks of every application command of the tree (callbacks are already parsed, so only the
+        call itself changes)
+        :param tree: command tree
+        :return:
+        """
+        for command in tree.walk_commands():
+            if isinstance(command, discord.app_commands.Command):
+                command._callback = self.instrument(f'/{command.qualified_name}', command._callback)
+
+    def count_events(self, state) -> None:
+        """
+        count gateway dispatches by type, by wrapping the parsers of the connection state
+        :param state: connection state of the bot
+        :return:
+        """
+        events = self.events
+
+        def counted(event_type: str, parser):
+            def parse(data):
+                events[event_type] = events.get(event_type, 0) + 1
+                return parser(data)
+            return parse
+
+        for event_type, parser in list(state.parsers.items()):
+            state.parsers[event_type] = counted(event_type, parser)
+
+    def error(self, event: str) -> None:
+        self.errors[event] = self.errors.get(event, 0) + 1
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """
+        :return: aiohttp trace config recording REST responses, 429s and the time they ask to wait
+        """
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            context.start = time.perf_counter()
+
+        async def on_request_end(session, context, params):
+            self.http_latency.observe(time.perf_counter() - context.start)
+            status = params.response.status
+            self.http[status] = self.http.get(status, 0) + 1
+            if status == 429:
+                self.rate_limited += 1
+                try:
+                    self.rate_limit_wait += float(params.response.headers.get('Retry-After', 0))
+                except ValueError:
+                    pass
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        return trace
+
+    def collect(self, name: str, kind: str, help: str, function: Callable[[], float | dict[str, float]]) -> None:
+        """
+        register value read when metrics are rendered (queue depths, cache sizes...)
+        :param name: metric name
+        :param kind: 'gauge' or 'counter'
+        :param help: description
+        :param function: function returning the value, or values by label
+        :return:
+        """
+        self.collectors[name] = (kind, help, function)
+
+    def render(self) -> str:
+        """
+        :return: metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        def family(name: str, kind: str, help: str, samples: dict[str, float] | float, label: str = '') -> None:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            if isinstance(samples, dict):
+                for key, value in samples.items():
+                    lines.append(f'{name}{{{label}="{escape(str(key))}"}} {value}')
+            else:
+                lines.append(f'{name} {samples}')
+
+        def histograms(name: str, help: str, values: dict[str, Histogram], label: str) -> None:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} histogram')
+            for key, histogram in values.items():
+                if not histogram.count:
+                    continue
+                labels = f'{label}="{escape(key)}",' if label else ''
+                total = 0
+                for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                    total += count
+                    lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {total}')
+                total += histogram.counts[-1]
+                lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {total}')
+                suffix = f'{{{labels[:-1]}}}' if labels else ''
+                lines.append(f'{name}_sum{suffix} {histogram.sum}')
+                lines.append(f'{name}_count{suffix} {total}')
+
+        family('dlbot_gateway_events_total', 'counter', 'Gateway dispatches by event type', dict(self.events), 'type')
+        histograms('dlbot_handler_seconds', 'Latency of event handlers and commands', dict(self.handlers), 'handler')
+        family('dlbot_handler_errors_total', 'counter', 'Exceptions raised by event handlers', dict(self.errors),
+               'event')
+        family('dlbot_http_responses_total', 'counter', 'REST responses by status', dict(self.http), 'status')
+        histograms('dlbot_http_seconds', 'Latency of REST requests', {'': self.http_latency}, '')
+        family('dlbot_http_rate_limited_total', 'counter', 'REST responses with status 429', self.rate_limited)
+        family('dlbot_http_rate_limit_wait_seconds_total', 'counter', 'Retry-After of 429 responses',
+               self.rate_limit_wait)
+        for name, (kind, help, function) in self.collectors.items():
+            try:
+                family(name, kind, help, function(), 'key')
+            except Exception as e:
+                print(f'Failed to collect {name}: {e}')
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host: str = METRICS_HOST, port: int = METRICS_PORT) -> None:
+        """
+        serve metrics over HTTP, every request gets the metrics no matter the path
+        :param host: host to listen on
+        :param port: port to listen on
+        :return:
+        """
+        self.server = await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while (await reader.readline()).strip():
+                pass
+            body = self.render().encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def summary(self, top: int = 10) -> str:
+        """
+        :param top: number of entries of every list
+        :return: human-readable summary for the stats command
+        """
+        lines = ['**Gateway events**']
+        for event_type, count in sorted(self.events.items(), key=lambda item: -item[1])[:top]:
+            lines.append(f'{event_type}: {count}')
+        lines.append('**Slowest handlers** (mean / p99)')
+        handlers = [(name, histogram) for name, histogram in self.handlers.items() if histogram.count]
+        handlers.sort(key=lambda item: -item[1].sum / item[1].count)
+        for name, histogram in handlers[:top]:
+            lines.append(f'{name}: {histogram.sum / histogram.count * 1000:.2f} ms / '
+                         f'{histogram.quantile(0.99) * 1000:g} ms ({histogram.count} calls)')
+        lines.append('**REST**')
+        lines.append(f'Responses: {", ".join(f"{status}: {count}" for status, count in sorted(self.http.items()))}')
+        lines.append(f'Rate limited: {self.rate_limited} ({self.rate_limit_wait:.1f} s to wait)')
+        if self.errors:
+            lines.append(f'Errors: {", ".join(f"{event}: {count}" for event, count in self.errors.items())}')
+        for name, (kind, help, function) in self.collectors.items():
+            try:
+                value = function()
+            except Exception as e:
+                value = f'unavailable ({e})'
+            if isinstance(value, dict):
+                value = ', '.join(f'{key}: {item}' for key, item in value.items())
+            lines.append(f'{help}: {value}')
+        return '\n'.join(lines)
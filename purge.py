@@ -0,0 +1,100 @@
+import asyncio
+import datetime
+from collections.abc import Awaitable, Callable
+
+import discord
+
+from bulk import run_bulk
+
+BATCH_SIZE = 100
+# messages older than that can't be bulk deleted, a small margin covers clock skew and slow paging
+BULK_DELETE_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=5)
+
+
+def message_filter(member: discord.Member | None = None, contains: str = '',
+                   bots: bool = False) -> Callable[[discord.Message], bool]:
+    """
+    :param member: only messages of this member
+    :param contains: only messages containing this text (case insensitive)
+    :param bots: only messages of bots
+    :return: check for messages to delete
+    """
+    contains = contains.lower()
+
+    def check(message: discord.Message) -> bool:
+        if member is not None and message.author.id != member.id:
+            return False
+        if bots and not message.author.bot:
+            return False
+        if contains and contains not in message.content.lower():
+            return False
+        return True
+
+    return check
+
+
+class PurgeJob:
+    """
+    deletion of messages matching a check while paging channel history
+
+    recent messages are bulk deleted in batches of 100, older ones are deleted one by one concurrently
+    """
+
+    def __init__(self, channel: discord.abc.Messageable, limit: int, check: Callable[[discord.Message], bool],
+                 reason: str | None = None):
+        """
+        :param channel: channel to purge
+        :param limit: number of messages to look through
+        :param check: messages to delete
+        :param reason: reason shown in the audit log
+        """
+        self.channel = channel
+        self.limit = limit
+        self.check = check
+        self.reason = reason
+        self.scanned = 0
+        self.deleted = 0
+        self.failed = 0
+
+    async def run(self, progress: Callable[['PurgeJob'], Awaitable] | None = None) -> None:
+        """
+        :param progress: coroutine function called after every deleted batch
+        :return:
+        """
+        batch = []
+        async for message in self.channel.history(limit=self.limit):
+            self.scanned += 1
+            if not self.check(message):
+                continue
+            batch.append(message)
+            if len(batch) == BATCH_SIZE:
+                await self.delete(batch)
+                batch = []
+                if progress is not None:
+                    await progress(self)
+        if batch:
+            await self.delete(batch)
+
+    async def delete(self, messages: list[discord.Message]) -> None:
+        # a long job runs for minutes, messages recent at its start may be too old by the time of their batch
+        cutoff = discord.utils.utcnow() - BULK_DELETE_AGE
+        recent = [message for message in messages if message.created_at >= cutoff]
+        old = [message for message in messages if message.created_at < cutoff]
+        if recent:
+            try:
+                await self.channel.delete_messages(recent, reason=self.reason)
+                self.deleted += len(recent)
+            except discord.HTTPException as e:
+                # the whole batch is rejected when one message can't be bulk deleted, delete them one by one
+                print(f'Failed to bulk delete {len(recent)} message(s) in {self.channel}: {e}')
+                old.extend(recent)
+        if old:
+            result = await run_bulk(old, lambda message: message.delete())
+            self.deleted += result.succeeded
+            self.failed += len(result.failed)
+
+    def summary(self) -> str:
+        content = f'Deleted {self.deleted} message(s) out of {self.scanned} checked'
+        if self.failed > 0:
+            content += f', {self.failed} failed'
+        return content
@@ -0,0 +1,127 @@
+"""
+record gateway dispatches to compressed, segmented files, replayed offline by benchmarks.replay
+
+every line of a segment is a JSON array [unix time, event type, payload]
+"""
+import asyncio
+import glob
+import gzip
+import json
+import os
+import time
+from collections.abc import Iterator
+
+SEGMENT_SIZE = 64 * 2 ** 20
+
+
+class GatewayRecorder:
+    """
+    records payloads of gateway dispatches by wrapping the parsers of the connection state
+
+    payloads are serialized before discord.py parses them (parsers may modify them), written to disk
+    by a background task in a thread, a new segment is started every segment_size bytes of JSON
+    """
+
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE, interval: float = 1.0):
+        """
+        :param directory: directory segments are written to
+        :param segment_size: uncompressed size of a segment in bytes
+        :param interval: seconds between writes
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.interval = interval
+        self.prefix = os.path.join(directory, time.strftime('gateway-%Y%m%d-%H%M%S'))
+        self.segment = 0
+        self.written = 0
+        self.file: gzip.GzipFile | None = None
+        self.buffer: list[str] = []
+        self.recorded = 0
+        self.task: asyncio.Task | None = None
+
+    def attach(self, state) -> None:
+        """
+        record every dispatch parsed by the connection state
+        :param state: connection state of the bot
+        :return:
+        """
+        buffer = self.buffer
+        dumps = json.dumps
+
+        def recorded(event_type: str, parser):
+            def parse(data):
+                buffer.append(dumps([time.time(), event_type, data], separators=(',', ':')))
+                return parser(data)
+            return parse
+
+        for event_type, parser in list(state.parsers.items()):
+            state.parsers[event_type] = recorded(event_type, parser)
+
+    def start(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.buffer:
+                lines = self.buffer[:]
+                del self.buffer[:]
+                await asyncio.to_thread(self.write, lines)
+
+    def write(self, lines: list[str]) -> None:
+        for line in lines:
+            if self.file is None or self.written >= self.segment_size:
+                self.rotate()
+            data = line.encode() + b'\n'
+            self.file.write(data)
+            self.written += len(data)
+        self.file.flush()
+        self.recorded += len(lines)
+
+    def rotate(self) -> None:
+        if self.file is not None:
+            self.file.close()
+        self.file = gzip.open(f'{self.prefix}-{self.segment:04}.jsonl.gz', 'wb', compresslevel=6)
+        self.segment += 1
+        self.written = 0
+
+    def close(self) -> None:
+        """
+        write what is left and close the current segment
+        :return:
+        """
+        if self.buffer:
+            lines = self.buffer[:]
+            del self.buffer[:]
+            self.write(lines)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def segments(paths: list[str]) -> list[str]:
+    """
+    :param paths: segment files or directories containing them
+    :return: segment files in recording order
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, 'gateway-*.jsonl.gz'))))
+        else:
+            files.append(path)
+    return files
+
+
+def read(paths: list[str]) -> Iterator[tuple[float, str, dict]]:
+    """
+    :param paths: segment files or directories containing them
+    :return: recorded (unix time, event type, payload) in recording order
+    """
+    for path in segments(paths):
+        with gzip.open(path, 'rt') as file:
+            for line in file:
+                timestamp, event_type, data = json.loads(line)
+                yield timestamp, event_type, data
@@ -0,0 +1,212 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import time
+
+import aiohttp
+import discord
+
+from ratelimit import TokenBucket
+
+# priority classes of REST calls, lower goes first
+INTERACTION = 0
+MODERATION = 1
+AUTOROLE = 2
+DM = 3
+LOG = 4
+PRIORITY_NAMES = ('interaction', 'moderation', 'autorole', 'dm', 'log')
+
+# priority of calls made by the current task, background workers lower it for everything they do
+rest_priority: contextvars.ContextVar[int] = contextvars.ContextVar('rest_priority', default=MODERATION)
+# route of the request the current task is making, read when its response headers come in
+rest_route: contextvars.ContextVar[discord.http.Route | None] = contextvars.ContextVar('rest_route', default=None)
+
+GLOBAL_RATE = 50.0
+
+
+class RestScheduler:
+    """
+    orders outgoing REST calls by priority under the global rate limit
+
+    every request takes a token of a global bucket, when they run out requests wait in a heap and the most
+    important one goes first, the last reserve tokens are kept for everything but logs, so logs are delayed
+    (and shed after max_delay) before they can slow down a ban
+
+    rate limit headers are watched as well: requests to a route whose bucket is exhausted wait for its reset
+    before taking a global token, a global 429 pauses everything, buckets are identified like discord.py does,
+    by the X-RateLimit-Bucket hash of the route template and the major parameters (guild, channel, webhook)
+    """
+
+    def __init__(self, rate: float = GLOBAL_RATE, reserve: float = 0.2, max_delay: float = 30.0):
+        """
+        :param rate: requests per second allowed to all routes together
+        :param reserve: share of the global bucket logs can't use
+        :param max_delay: seconds a log request waits at most before it is shed
+        """
+        self.bucket = TokenBucket(rate, rate)
+        self.reserve = reserve * rate
+        self.max_delay = max_delay
+        self.waiting: list[tuple[int, int, float, asyncio.Future]] = []
+        self.ids = itertools.count()
+        self.wakeup = asyncio.Event()
+        # route key ('METHOD path template') -> bucket hash of its responses
+        self.hashes: dict[str, str] = {}
+        # 'bucket hash:major parameters' -> monotonic time the bucket resets
+        self.blocked: dict[str, float] = {}
+        self.paused_until = 0.0
+        self.granted = [0] * len(PRIORITY_NAMES)
+        self.delayed = [0] * len(PRIORITY_NAMES)
+        self.shed = [0] * len(PRIORITY_NAMES)
+        self.task: asyncio.Task | None = None
+
+    @property
+    def depth(self) -> int:
+        return len(self.waiting)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {name: {'granted': self.granted[i], 'delayed': self.delayed[i], 'shed': self.shed[i]}
+                for i, name in enumerate(PRIORITY_NAMES)}
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def attach(self, http: discord.http.HTTPClient) -> None:
+        """
+        put the scheduler in front of every request of the HTTP client
+        :param http: HTTP client of the bot
+        :return:
+        """
+        request = http.request
+
+        async def scheduled(route: discord.http.Route, **kwargs):
+            if route.path.startswith('/interactions/'):
+                # interaction endpoints aren't bound to the global rate limit
+                return await request(route, **kwargs)
+            await self.acquire(rest_priority.get(), self.bucket_key(route))
+            # reset afterwards, other requests of the task (webhooks, CDN) share the session but not the route
+            token = rest_route.set(route)
+            try:
+                return await request(route, **kwargs)
+            finally:
+                rest_route.reset(token)
+
+        http.request = scheduled
+
+    def bucket_key(self, route: discord.http.Route) -> str | None:
+        """
+        :return: key of the rate limit bucket of the route, None until a response told which bucket it is
+        """
+        bucket = self.hashes.get(route.key)
+        if bucket is None:
+            return None
+        return f'{bucket}:{route.major_parameters}'
+
+    def available(self, priority: int) -> bool:
+        self.bucket.refill()
+        return self.bucket.tokens >= (self.reserve + 1 if priority >= LOG else 1)
+
+    async def acquire(self, priority: int, key: str | None = None) -> None:
+        """
+        wait for the turn of a request
+        :param priority: priority class of the request
+        :param key: bucket key of the request (see bucket_key)
+        :return:
+        :raise discord.RateLimited: log request was shed
+        """
+        reset = self.blocked.get(key)
+        if reset is not None:
+            delay = reset - time.monotonic()
+            if delay > 0:
+                # its own bucket is empty anyway, wait without holding a global token
+                await asyncio.sleep(delay)
+            self.blocked.pop(key, None)
+        if (not self.waiting and time.monotonic() >= self.paused_until and self.available(priority)
+                and self.bucket.try_acquire()):
+            self.granted[priority] += 1
+            return
+        self.delayed[priority] += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.ids), time.monotonic() + self.max_delay, future))
+        self.wakeup.set()
+        await future
+
+    async def run(self) -> None:
+        while True:
+            if not self.waiting:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            priority, _, deadline, future = self.waiting[0]
+            if future.done():
+                heapq.heappop(self.waiting)
+            elif self.available(priority) and self.bucket.try_acquire():
+                heapq.heappop(self.waiting)
+                self.granted[priority] += 1
+                future.set_result(None)
+            elif priority >= LOG and self.shed_expired():
+                continue
+            else:
+                # until there are enough tokens, or a more important request comes
+                needed = self.reserve + 1 if priority >= LOG else 1
+                timeout = max(needed - self.bucket.tokens, 0.1) / self.bucket.rate
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    def shed_expired(self) -> bool:
+        """
+        drop log requests which waited longer than max_delay
+        :return: whether anything was shed
+        """
+        now = time.monotonic()
+        kept = []
+        shed = False
+        for item in self.waiting:
+            priority, _, deadline, future = item
+            if priority >= LOG and deadline <= now:
+                if not future.done():
+                    future.set_exception(discord.RateLimited(self.max_delay))
+                    self.shed[priority] += 1
+                shed = True
+            else:
+                kept.append(item)
+        if shed:
+            heapq.heapify(kept)
+            self.waiting = kept
+        return shed
+
+    def trace(self, trace: aiohttp.TraceConfig) -> None:
+        """
+        read rate limit headers of responses
+        :param trace: trace config of the bot's HTTP session
+        :return:
+        """
+        async def on_request_end(session, context, params):
+            headers = params.response.headers
+            now = time.monotonic()
+            if params.response.status == 429 and (headers.get('X-RateLimit-Global') or
+                                                  headers.get('X-RateLimit-Scope') == 'global'):
+                self.paused_until = max(self.paused_until, now + float(headers.get('Retry-After', 1)))
+                return
+            bucket = headers.get('X-RateLimit-Bucket')
+            # requests which didn't go through the scheduled HTTP client (webhooks, interactions, CDN downloads)
+            # have no route
+            route = rest_route.get()
+            if bucket is None or route is None:
+                return
+            self.hashes[route.key] = bucket
+            if headers.get('X-RateLimit-Remaining') == '0':
+                if len(self.blocked) > 1000:
+                    self.blocked = {key: reset for key, reset in self.blocked.items() if reset > now}
+                reset_after = float(headers.get('X-RateLimit-Reset-After', 0))
+                self.blocked[f'{bucket}:{route.major_parameters}'] = now + reset_after
+
+        trace.on_request_end.append(on_request_end)
@@ -0,0 +1,178 @@
+import asyncio
+
+import discord
+
+from bulk import run_bulk
+from config_store import ConfigTable
+
+LOBBY_NAME = 'Create channel'
+POOL_NAME = 'Voice channel'
+# owner id of channels waiting in the pool
+POOLED = 0
+
+
+class TempVoiceManager:
+    """
+    temporary voice channels: joining a lobby gives the member their own channel, which is removed once empty
+
+    lobbies and temporary channels are indexed by id (and persisted, so nothing leaks across restarts),
+    a few hidden channels are kept ready per category, so a member is moved without waiting for a channel
+    to be created, empty channels are returned to the pool or deleted in periodic sweeps
+    """
+
+    def __init__(self, lobbies: ConfigTable, channels: ConfigTable, pool_size: int = 2, sweep_interval: float = 10.0):
+        """
+        :param lobbies: guild id -> lobby channel id
+        :param channels: temporary channel id -> (guild id, category id, owner id or POOLED)
+        :param pool_size: number of hidden channels kept ready per lobby category
+        :param sweep_interval: seconds between sweeps of empty channels
+        """
+        self.lobbies = lobbies
+        self.channels = channels
+        self.pool_size = pool_size
+        self.sweep_interval = sweep_interval
+        # (guild id, category id) -> ids of free channels
+        self.pool: dict[tuple[int, int], list[int]] = {}
+        self.refilling: set[tuple[int, int]] = set()
+        self.empty: dict[int, discord.VoiceChannel] = {}
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def is_lobby(self, channel: discord.abc.GuildChannel) -> bool:
+        return self.lobbies.get(channel.guild.id) == channel.id
+
+    def owner(self, channel: discord.abc.GuildChannel) -> int | None:
+        """
+        :return: id of the member the channel was created for, None if it isn't a claimed temporary channel
+        """
+        row = self.channels.get(channel.id)
+        if row is None or row[2] == POOLED:
+            return None
+        return row[2]
+
+    @staticmethod
+    def pool_key(guild: discord.Guild, category: discord.CategoryChannel | None) -> tuple[int, int]:
+        return guild.id, 0 if category is None else category.id
+
+    async def register_lobby(self, channel: discord.VoiceChannel) -> None:
+        await self.lobbies.set(channel.guild.id, channel.id)
+        await self.refill(channel.guild, channel.category)
+
+    async def create_lobby(self, guild: discord.Guild) -> discord.VoiceChannel:
+        channel = await guild.create_voice_channel(LOBBY_NAME)
+        await self.register_lobby(channel)
+        return channel
+
+    async def claim(self, member: discord.Member, lobby: discord.VoiceChannel) -> None:
+        """
+        give member their own channel next to the lobby and move them there
+        :param member: member who joined the lobby
+        :param lobby: lobby channel
+        :return:
+        """
+        guild = member.guild
+        name = f'Created by {member.name}'
+        key = self.pool_key(guild, lobby.category)
+        channel = None
+        free = self.pool.get(key, [])
+        while free and channel is None:
+            channel = guild.get_channel(free.pop())
+        try:
+            if channel is None:
+                channel = await guild.create_voice_channel(name, category=lobby.category,
+                                                           overwrites=lobby.overwrites)
+                await self.channels.set(channel.id, (guild.id, key[1], member.id))
+                await member.move_to(channel)
+            else:
+                await self.channels.set(channel.id, (guild.id, key[1], member.id))
+                await asyncio.gather(channel.edit(name=name, overwrites=lobby.overwrites), member.move_to(channel))
+        except discord.HTTPException as e:
+            # the member may have left the lobby already, the channel is recycled by the next sweep
+            print(f'Failed to move {member} to their voice channel in {guild}: {e}')
+            if channel is not None:
+                self.release(channel)
+        asyncio.create_task(self.refill(guild, lobby.category))
+
+    def release(self, channel: discord.VoiceChannel) -> None:
+        """
+        mark temporary channel as possibly empty, it is checked on the next sweep
+        """
+        self.empty[channel.id] = channel
+
+    async def refill(self, guild: discord.Guild, category: discord.CategoryChannel | None) -> None:
+        key = self.pool_key(guild, category)
+        if key in self.refilling:
+            return
+        self.refilling.add(key)
+        free = self.pool.setdefault(key, [])
+        try:
+            while len(free) < self.pool_size:
+                channel = await guild.create_voice_channel(POOL_NAME, category=category,
+                                                           overwrites=self.hidden_overwrites(guild))
+                await self.channels.set(channel.id, (guild.id, key[1], POOLED))
+                free.append(channel.id)
+        except discord.HTTPException as e:
+            print(f'Failed to refill voice channel pool of {guild}: {e}')
+        finally:
+            self.refilling.discard(key)
+
+    @staticmethod
+    def hidden_overwrites(guild: discord.Guild) -> dict:
+        return {guild.default_role: discord.PermissionOverwrite(view_channel=False),
+                guild.me: discord.PermissionOverwrite(view_channel=True, connect=True, move_members=True)}
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            await self.sweep()
+
+    async def sweep(self) -> None:
+        """
+        recycle or delete temporary channels which are still empty
+        :return:
+        """
+        candidates, self.empty = self.empty, {}
+        empty = [channel for channel in candidates.values() if len(channel.members) == 0]
+        await run_bulk(empty, self.recycle)
+
+    async def recycle(self, channel: discord.VoiceChannel) -> None:
+        key = self.pool_key(channel.guild, channel.category)
+        free = self.pool.setdefault(key, [])
+        if self.lobbies.get(channel.guild.id) is not None and len(free) < self.pool_size:
+            await channel.edit(name=POOL_NAME, overwrites=self.hidden_overwrites(channel.guild))
+            await self.channels.set(channel.id, (channel.guild.id, key[1], POOLED))
+            free.append(channel.id)
+        else:
+            await self.channels.delete(channel.id)
+            await channel.delete()
+
+    async def reconcile(self, guilds: list[discord.Guild]) -> None:
+        """
+        rebuild the in-memory index after a restart: forget deleted channels, schedule empty ones
+        for the sweep, put pooled ones back into the pool and adopt lobbies created by name
+        :param guilds: guilds of the bot
+        :return:
+        """
+        rows: dict[int, list[tuple[int, int, int]]] = {}
+        for channel_id, (guild_id, category_id, owner_id) in self.channels.items():
+            rows.setdefault(guild_id, []).append((channel_id, category_id, owner_id))
+        self.pool.clear()
+        for guild in guilds:
+            lobby = guild.get_channel(self.lobbies.get(guild.id, 0))
+            if lobby is None:
+                lobby = discord.utils.get(guild.voice_channels, name=LOBBY_NAME)
+                if lobby is not None:
+                    await self.lobbies.set(guild.id, lobby.id)
+            for channel_id, category_id, owner_id in rows.pop(guild.id, []):
+                channel = guild.get_channel(channel_id)
+                if channel is None:
+                    await self.channels.delete(channel_id)
+                elif owner_id == POOLED:
+                    self.pool.setdefault((guild.id, category_id), []).append(channel_id)
+                elif len(channel.members) == 0:
+                    self.release(channel)
+            if lobby is not None:
+                await self.refill(guild, lobby.category)
@@ -0,0 +1,212 @@
+import asyncio
+import datetime
+import heapq
+import math
+import time
+
+import discord
+
+from bulk import run_bulk
+from config_store import ConfigStore
+
+# kinds of timed actions
+UNBAN = 1
+MUTE = 2
+REMOVE_ROLE = 3
+
+# longest timeout Discord accepts, longer mutes are re-armed before their timeout ends
+MAX_TIMEOUT = datetime.timedelta(days=28)
+REARM_MARGIN = 3600.0
+# seconds before an action which failed for another reason than a missing member/ban/permission is retried
+RETRY_DELAY = 60.0
+# the timer wakes up at least that often (seconds), so wall clock adjustments are noticed
+MAX_SLEEP = 3600.0
+END = (math.inf, 0)
+
+
+class TimedActions:
+    """
+    moderation actions which run at a given time (end of a temporary ban, of a long mute, of a temporary role)
+
+    actions are rows of an on-disk table indexed by due time, only the next due ones are kept in memory:
+    a min-heap of (due time, row id) holds every row up to a cursor, rows after it are loaded batch by batch
+    when the heap runs empty, so 100k pending actions cost a batch of tuples in memory
+
+    a single timer task sleeps until the first due action, due actions (all the missed ones after a restart)
+    run in batches with bounded concurrency
+    """
+
+    def __init__(self, store: ConfigStore, http: discord.http.HTTPClient, batch: int = 500, concurrency: int = 4,
+                 shard_ids: list[int] | None = None, shard_count: int | None = None):
+        """
+        :param store: config store the table lives in
+        :param http: HTTP client of the bot
+        :param batch: number of actions loaded or run at once
+        :param concurrency: number of actions running at the same time
+        :param shard_ids: shards of this process, when the table is shared by several processes
+        :param shard_count: total number of shards
+        """
+        self.store = store
+        self.http = http
+        self.batch = batch
+        self.concurrency = concurrency
+        store.reader.execute('CREATE TABLE IF NOT EXISTS timed_actions (id INTEGER PRIMARY KEY, due REAL NOT NULL, '
+                             'guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, action INTEGER NOT NULL, '
+                             'role_id INTEGER NOT NULL DEFAULT 0, until REAL NOT NULL DEFAULT 0)')
+        store.reader.execute('CREATE INDEX IF NOT EXISTS timed_actions_due ON timed_actions (due)')
+        store.reader.execute('CREATE INDEX IF NOT EXISTS timed_actions_target ON timed_actions (guild_id, user_id, '
+                             'action)')
+        # other processes run the actions of guilds of their shards
+        shards = ''
+        if shard_ids is not None:
+            shards = f' AND (guild_id >> 22) % {int(shard_count)} IN ({", ".join(str(int(i)) for i in shard_ids)})'
+        # the first condition alone lets SQLite seek the due index
+        self.select_next = ('SELECT due, id FROM timed_actions WHERE due >= ? AND (due > ? OR id > ?)'
+                            f'{shards} ORDER BY due, id LIMIT ?')
+        self.heap: list[tuple[float, int]] = []
+        # every row up to (due, id) of the cursor is in the heap, END once the whole table is
+        self.cursor: tuple[float, int] = (-math.inf, 0)
+        self.wakeup = asyncio.Event()
+        self.done = 0
+        self.retried = 0
+        self.task: asyncio.Task | None = None
+
+    @property
+    def depth(self) -> int:
+        return self.store.reader.execute('SELECT COUNT(*) FROM timed_actions').fetchone()[0]
+
+    def start(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def schedule(self, guild_id: int, user_id: int, action: int, due: float, role_id: int = 0,
+                       until: float = 0.0) -> None:
+        """
+        schedule action, replacing the pending one of the same kind for the member
+        :param guild_id: id of the guild
+        :param user_id: id of the member
+        :param action: UNBAN, MUTE or REMOVE_ROLE
+        :param due: unix time the action runs at
+        :param role_id: role to remove
+        :param until: unix time the mute ends at
+        :return:
+        """
+        await self.cancel(guild_id, user_id, action, role_id)
+        row_id = await self.store.write('INSERT INTO timed_actions (due, guild_id, user_id, action, role_id, until) '
+                                        'VALUES (?, ?, ?, ?, ?, ?)', (due, guild_id, user_id, action, role_id, until))
+        self.push(due, row_id)
+
+    async def cancel(self, guild_id: int, user_id: int, action: int, role_id: int = 0) -> None:
+        """
+        cancel pending action of the member (its heap entry is skipped when it comes up)
+        """
+        await self.store.write('DELETE FROM timed_actions WHERE guild_id = ? AND user_id = ? AND action = ? '
+                               'AND role_id = ?', (guild_id, user_id, action, role_id))
+
+    def push(self, due: float, row_id: int) -> None:
+        if (due, row_id) > self.cursor:
+            # loaded with its batch later
+            return
+        heapq.heappush(self.heap, (due, row_id))
+        if self.heap[0][1] == row_id:
+            self.wakeup.set()
+        if len(self.heap) > 2 * self.batch:
+            # keep the earliest batch, the rest is loaded again when its turn comes
+            self.heap.sort()
+            del self.heap[self.batch:]
+            self.cursor = self.heap[-1]
+
+    def load(self) -> None:
+        due, row_id = self.cursor
+        rows = self.store.reader.execute(self.select_next, (due, due, row_id, self.batch)).fetchall()
+        self.heap.extend(rows)
+        heapq.heapify(self.heap)
+        self.cursor = rows[-1] if len(rows) == self.batch else END
+
+    async def run(self) -> None:
+        while True:
+            if not self.heap:
+                if self.cursor != END:
+                    self.load()
+                    continue
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            now = time.time()
+            delay = self.heap[0][0] - now
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), min(delay, MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            row_ids = []
+            while self.heap and self.heap[0][0] <= now and len(row_ids) < self.batch:
+                row_ids.append(heapq.heappop(self.heap)[1])
+            try:
+                await self.fire(row_ids)
+            except Exception as e:
+                print(f'Failed to run timed actions: {e!r}')
+                # rows which weren't removed or rescheduled are loaded again
+                self.heap.clear()
+                self.cursor = (-math.inf, 0)
+                await asyncio.sleep(RETRY_DELAY)
+
+    async def fire(self, row_ids: list[int]) -> None:
+        """
+        run due actions, remove done ones and reschedule re-armed and failed ones
+        :param row_ids: ids of the rows
+        :return:
+        """
+        rows = self.store.reader.execute(
+            'SELECT id, guild_id, user_id, action, role_id, until FROM timed_actions '
+            f'WHERE id IN ({", ".join("?" * len(row_ids))})', row_ids).fetchall()
+        done = []
+        later = []
+
+        async def run(row: tuple) -> None:
+            row_id, guild_id, user_id, action, role_id, until = row
+            try:
+                due = await self.execute(guild_id, user_id, action, role_id, until)
+            except (discord.NotFound, discord.Forbidden) as e:
+                # the member left, was already unbanned, or the bot can't do it anymore
+                print(f'Dropped timed action {action} of {user_id} in {guild_id}: {e}')
+                due = None
+            except (discord.HTTPException, discord.RateLimited) as e:
+                print(f'Failed timed action {action} of {user_id} in {guild_id}: {e}')
+                self.retried += 1
+                due = time.time() + RETRY_DELAY
+            if due is None:
+                done.append((row_id,))
+            else:
+                later.append((due, row_id))
+
+        await run_bulk(rows, run, concurrency=self.concurrency)
+        self.done += len(done)
+        await self.store.write_many('DELETE FROM timed_actions WHERE id = ?', done)
+        await self.store.write_many('UPDATE timed_actions SET due = ? WHERE id = ?', later)
+        for due, row_id in later:
+            self.push(due, row_id)
+
+    async def execute(self, guild_id: int, user_id: int, action: int, role_id: int, until: float) -> float | None:
+        """
+        the guild and member may not be cached (or belong to another process), so requests are made by id
+        :return: unix time the action runs again at, None if it is done
+        """
+        reason = 'Time is up'
+        if action == UNBAN:
+            await self.http.unban(user_id, guild_id, reason=reason)
+        elif action == REMOVE_ROLE:
+            await self.http.remove_role(guild_id, user_id, role_id, reason=reason)
+        elif action == MUTE:
+            now = time.time()
+            if until <= now:
+                return None
+            end = min(until, now + MAX_TIMEOUT.total_seconds())
+            timeout = datetime.datetime.fromtimestamp(end, datetime.timezone.utc)
+            await self.http.edit_member(guild_id, user_id, reason='Mute continues',
+                                        communication_disabled_until=timeout.isoformat())
+            if end < until:
+                return end - REARM_MARGIN
+        return None